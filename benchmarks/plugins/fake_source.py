@@ -0,0 +1,111 @@
+"""
+A deterministic stand-in for a metadata provider
+
+The provider answers from the names of the files being processed, so it knows
+every series of a synthetic library. Latency, pagination and rate limits are
+simulated with sleeps, which yield to the other sources when gevent is in use.
+"""
+
+import re
+import sys
+import time
+from typing import Any, Dict, Iterable, List, Tuple
+
+from mediama.managers import Source
+
+FILE_RE = re.compile(r"^(?P<series>.+) - S(?P<season>\d+)E(?P<episode>\d+)$")
+
+
+def parse(path: Any) -> Tuple[str, int, int]:
+    """
+    Return the series, season and episode of a library file
+    """
+    match = FILE_RE.match(str(path).rsplit("/", 1)[-1].rsplit(".", 1)[0])
+    if not match:
+        raise ValueError(f"Not a library file: {path}")
+    return match["series"], int(match["season"]), int(match["episode"])
+
+
+def sleep(seconds: float):
+    if seconds <= 0:
+        return
+    gevent = sys.modules.get("gevent")
+    if gevent is not None:
+        gevent.sleep(seconds)
+    else:
+        time.sleep(seconds)
+
+
+class RateLimiter:
+    """
+    Spaces requests at most ``rate`` per second apart, like a provider that
+    answers 429 until the client backs off
+    """
+
+    def __init__(self, rate: float):
+        self.interval = 1 / rate
+        self.next = 0.0
+        self.throttled = 0
+
+    def wait(self):
+        now = time.monotonic()
+        delay = max(self.next - now, 0)
+        self.next = max(self.next, now) + self.interval
+        if delay:
+            self.throttled += 1
+            sleep(delay)
+
+
+# Limiters are shared by every task of a rate, like the quota of an API key
+limiters: Dict[float, RateLimiter] = {}
+
+
+def request(latency: float, rate: float):
+    if rate:
+        limiters.setdefault(rate, RateLimiter(rate)).wait()
+    sleep(latency)
+
+
+class FakeSource(Source):
+    def fetch_series(
+        self,
+        num_ranks: int = 5,
+        latency: float = 0.0,
+        rate: float = 0,
+        **kwargs: Any,
+    ) -> List[Dict[str, Any]]:
+        """
+        Return the series of the files followed by look-alikes
+        """
+        series = parse(self.metadata["filepaths"][0])[0]
+        request(latency, rate)
+        ranking = [{"name": series, "year": 2000}]
+        ranking += [
+            {"name": f"{series} ({2000 + i})", "year": 2000 + i}
+            for i in range(1, num_ranks)
+        ]
+        return ranking
+
+    def fetch_episodes(
+        self,
+        episodes: int = 24,
+        page_size: int = 50,
+        latency: float = 0.0,
+        rate: float = 0,
+        **kwargs: Any,
+    ) -> Iterable[List[Dict[str, Any]]]:
+        """
+        Yield the episodes of the series a page at a time
+        """
+        series = self.metadata["name"]
+        for start in range(0, episodes, page_size):
+            request(latency, rate)
+            yield [
+                {
+                    "series": series,
+                    "season": 1,
+                    "episode": number,
+                    "title": f"Episode {number}",
+                }
+                for number in range(start + 1, min(start + page_size, episodes) + 1)
+            ]
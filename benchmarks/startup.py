@@ -0,0 +1,122 @@
+"""
+Check the import time of the CLI against a budget
+
+Each command is run with ``python -X importtime`` and the cumulative import
+time of every top-level module is summed, less the imports of a bare
+interpreter, such as site hooks. The script exits with 1 if a command
+exceeds its budget or imports a module that should only be imported once files
+are processed.
+
+Budgets are multiples of the import time of a few standard modules, so they
+hold on slower machines and other Python versions. Every run of a command is
+paired with a run of the reference, which keeps the ratio steady while the
+load of the machine changes. ``--scale``, or the ``MEDIAMA_STARTUP_SCALE``
+environment variable, multiplies the budgets further.
+
+    python benchmarks/startup.py [--runs N] [--scale X] [--json]
+"""
+
+import os
+import re
+import sys
+import json
+import argparse
+import statistics
+import subprocess
+from typing import Dict, List, Tuple
+
+# (name, python arguments, budget as a multiple of the reference)
+COMMANDS: List[Tuple[str, List[str], float]] = [
+    ("help", ["-m", "mediama", "--help"], 2.5),
+    ("submit --help", ["-m", "mediama", "submit", "--help"], 2.5),
+    ("import mediama", ["-c", "import mediama"], 2.5),
+    ("import mediama.core", ["-c", "import mediama.core"], 3.5),
+]
+# Standard modules that the budgets are relative to
+REFERENCE = [
+    "-c",
+    "import argparse, email.parser, http.client, json, logging, sqlite3, typing, "
+    "urllib.request",
+]
+# Modules that no command above needs
+FORBIDDEN = ("gevent", "requests", "requests_cache", "asyncio")
+
+LINE_RE = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)")
+
+
+def measure(args: List[str]) -> Tuple[float, List[str]]:
+    """
+    :returns: the total import time in milliseconds and the imported modules
+    """
+    out = subprocess.run(
+        [sys.executable, "-X", "importtime", *args],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    total = 0
+    modules = []
+    for line in out.stderr.splitlines():
+        match = LINE_RE.match(line)
+        if not match:
+            continue
+        _, cumulative, indent, name = match.groups()
+        modules.append(name)
+        # Nested imports are already included in their parent's time
+        if len(indent) == 1:
+            total += int(cumulative)
+    return total / 1000, modules
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument(
+        "--scale",
+        type=float,
+        default=float(os.environ.get("MEDIAMA_STARTUP_SCALE", 1)),
+        help="multiply the budgets",
+    )
+    parser.add_argument("--json", action="store_true")
+    args = parser.parse_args()
+
+    results: Dict[str, dict] = {}
+    failed = False
+    for name, command, factor in COMMANDS:
+        times = []
+        references = []
+        for _ in range(args.runs):
+            baseline = measure(["-c", "pass"])[0]
+            references.append(measure(REFERENCE)[0] - baseline)
+            ms, modules = measure(command)
+            times.append(ms - baseline)
+        ms = statistics.median(times)
+        ratio = statistics.median(t / r for t, r in zip(times, references))
+        forbidden = sorted(m for m in FORBIDDEN if m in modules)
+        ok = ratio <= factor * args.scale and not forbidden
+        failed |= not ok
+        results[name] = {
+            "ms": round(ms, 1),
+            "ratio": round(ratio, 2),
+            "budget": factor * args.scale,
+            "forbidden": forbidden,
+            "ok": ok,
+        }
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        for name, result in results.items():
+            status = "ok" if result["ok"] else "FAIL"
+            line = (
+                f"{name:<22} {result['ms']:>7.1f} ms {result['ratio']:>5.2f}x "
+                f"/ {result['budget']:.2f}x  {status}"
+            )
+            if result["forbidden"]:
+                line += f"  imports {', '.join(result['forbidden'])}"
+            print(line)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,342 @@
+"""
+Benchmark the hot paths of mediama against synthetic libraries
+
+Libraries of each size are made of series of 24 episodes whose files are
+named like ``Amber Harbor 0001 - S01E02.mkv``. The files are never read, so
+they are not created on disk. Metadata comes from the fake provider in
+benchmarks/plugins, so results only depend on the code and the machine.
+
+Each case is run ``--repeat`` times and the fastest run is kept. Results are
+written as JSON with ``--save`` and compared to an earlier result with
+``--compare``, in which case the script exits with 1 if a case got slower by
+more than ``--tolerance``.
+
+    python benchmarks/suite.py [--sizes 1000,10000,100000] [--cases ...]
+        [--save results.json] [--compare baseline.json]
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import logging
+import argparse
+import platform
+import tempfile
+import subprocess
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+HERE = Path(__file__).resolve().parent
+sys.path.insert(0, str(HERE.parent))
+sys.path.insert(0, str(HERE / "plugins"))
+
+from mediama.config import normalize_config  # noqa: E402
+from mediama.metadata import VariablePool  # noqa: E402
+from mediama.managers import SourceManager  # noqa: E402
+from fake_source import parse  # noqa: E402
+import startup  # noqa: E402
+
+EPISODES = 24
+WORDS = (
+    "Amber Harbor Silent Crimson Paper Moon Iron Garden Falling Star Hidden "
+    "Tide Winter Clock Golden Road Broken Signal Velvet Forest Glass River"
+).split()
+
+Result = Dict[str, float]
+# A case takes the library and returns (seconds, operations)
+Case = Callable[[List[Path]], Tuple[float, int]]
+
+
+def library(size: int, seed: int = 0) -> List[Path]:
+    """
+    Return the files of a synthetic library of about size files
+    """
+    rng = random.Random(seed)
+    root = Path("/library")
+    files = []
+    for i in range((size + EPISODES - 1) // EPISODES):
+        series = f"{rng.choice(WORDS)} {rng.choice(WORDS)} {i:04d}"
+        for episode in range(1, EPISODES + 1):
+            files.append(root / series / f"{series} - S01E{episode:02d}.mkv")
+    return files[:size]
+
+
+def batches(files: List[Path]) -> List[List[Path]]:
+    """
+    Split the library by series, the way the daemon batches files
+    """
+    groups: Dict[str, List[Path]] = {}
+    for path in files:
+        groups.setdefault(parse(path)[0], []).append(path)
+    return list(groups.values())
+
+
+def config(**source_kwargs: Any) -> Dict[str, Any]:
+    kwargs = {"page_size": 10, **source_kwargs}
+    return normalize_config(
+        {
+            "sources": [
+                {"name": "FakeSource", "id": "fake_0", "kwargs": kwargs},
+                {"name": "FakeSource", "id": "fake_1", "kwargs": kwargs},
+            ],
+            "search_dirs": [str(HERE / "plugins")],
+            "cache": None,
+            "state": None,
+            "memory": None,
+            "episodes": None,
+            "misses": None,
+            "prompt": False,
+        }
+    )
+
+
+class BenchSourceManager(SourceManager):
+    """
+    Disambiguates by the names of the library files, since mediama itself
+    leaves disambiguation to the user
+    """
+
+    def _files(self) -> Dict[Tuple[int, int], Path]:
+        pool = self.metadata
+        if getattr(self, "_pool", None) is not pool:
+            self._pool = pool
+            self._index = {parse(p)[1:]: p for p in pool["filepaths"]}
+        return self._index
+
+    def disambiguate_series(self, ranking: List[Dict[str, Any]]) -> int:
+        series = parse(self.metadata["filepaths"][0])[0]
+        names = [result["name"] for result in ranking]
+        return names.index(series) if series in names else 0
+
+    def disambiguate_episodes(self, page: List[Dict[str, Any]]) -> Dict[Path, Any]:
+        files = self._files()
+        matches = {}
+        for episode in page:
+            path = files.get((episode["season"], episode["episode"]))
+            if path:
+                matches[path] = episode
+        return matches
+
+
+def timed(func: Callable[[], int]) -> Tuple[float, int]:
+    start = time.perf_counter()
+    ops = func()
+    return time.perf_counter() - start, ops
+
+
+def bench_startup(files: List[Path]) -> Tuple[float, int]:
+    ms, _ = startup.measure(["-c", "import mediama.core"])
+    return ms / 1000, 1
+
+
+def bench_discovery(files: List[Path]) -> Tuple[float, int]:
+    """
+    Discover the plugins of a folder of 50 plugin modules
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        for i in range(50):
+            Path(tmp, f"bench_plugin_{i}.py").write_text(
+                "from mediama.managers import Source\n\n\n"
+                f"class BenchSource{i}(Source):\n    pass\n"
+            )
+        cfg = normalize_config({"search_dirs": [tmp], "ranks": 5})
+
+        def discover() -> int:
+            tasks = SourceManager(cfg, None).discover_tasks()
+            for i in range(50):
+                sys.modules.pop(f"bench_plugin_{i}", None)
+            return len(tasks)
+
+        return timed(discover)
+
+
+def bench_varpool(files: List[Path]) -> Tuple[float, int]:
+    """
+    Write, read and snapshot a value per file
+    """
+    cfg = config()
+
+    def run() -> int:
+        pool = VariablePool(cfg, id_="mediama")
+        for i, path in enumerate(files):
+            pool.set_({f"key_{i}": {"path": path, "title": "Episode"}}, "fake_0")
+        for i in range(len(files)):
+            pool[f"key_{i}"]
+        pool.snapshot()
+        return len(files) * 2 + 1
+
+    return timed(run)
+
+
+def bench_aggregation(files: List[Path]) -> Tuple[float, int]:
+    """
+    Aggregate the series rankings of three sources for every series
+    """
+    mgr = SourceManager(config(), None)
+    rankings = []
+    for batch in batches(files):
+        series = parse(batch[0])[0]
+        ranking = [{"name": f"{series} ({i})", "year": i} for i in range(5)]
+        rankings.append([(f"fake_{i}", ranking[i:] + ranking[:i], 1) for i in range(3)])
+    return timed(lambda: sum(len(mgr.aggregate(*r)) for r in rankings))
+
+
+def bench_matching(files: List[Path]) -> Tuple[float, int]:
+    """
+    Stream the episode pages of two sources and match them to every series
+    """
+    from fake_source import FakeSource
+
+    cfg = config()
+    mgr = BenchSourceManager(cfg, None)
+
+    def run() -> int:
+        matched = 0
+        for batch in batches(files):
+            pool = VariablePool(cfg, id_="mediama")
+            pool["filepaths"] = batch
+            pool["name"] = parse(batch[0])[0]
+            bound = mgr.bind(pool)
+            source = FakeSource(pool)
+            producers = {
+                id_: lambda: source.fetch_episodes(page_size=10)
+                for id_ in ("fake_0", "fake_1")
+            }
+            pages = bound.stream_episodes(producers)
+            matched += sum(1 for _ in bound.match_episodes(pages, batch, producers))
+        return matched
+
+    return timed(run)
+
+
+def end_to_end(**source_kwargs: Any) -> Case:
+    def bench(files: List[Path]) -> Tuple[float, int]:
+        from unittest import mock
+
+        import mediama.core as core
+
+        with mock.patch.object(core, "SourceManager", BenchSourceManager):
+            engine = core.Engine(config(**source_kwargs))
+
+        def run() -> int:
+            matched = 0
+            for batch in batches(files):
+                pool = engine.run(batch)
+                matched += len(pool.files("episodes", "mediama"))
+            return matched
+
+        return timed(run)
+
+    return bench
+
+
+# (case, function, whether the case depends on the library size)
+CASES: List[Tuple[str, Case, bool]] = [
+    ("startup", bench_startup, False),
+    ("discovery", bench_discovery, False),
+    ("varpool", bench_varpool, True),
+    ("aggregation", bench_aggregation, True),
+    ("matching", bench_matching, True),
+    ("end_to_end", end_to_end(), True),
+    # A slow, paginated and rate limited provider on a fixed library, where
+    # the time is dominated by how well requests overlap
+    ("end_to_end_provider", end_to_end(latency=0.005, rate=400), False),
+]
+PROVIDER_LIBRARY = 240
+
+
+def run_cases(
+    sizes: List[int], names: Optional[List[str]], repeat: int
+) -> Dict[str, Result]:
+    results = {}
+    for name, case, sized in CASES:
+        if names and name not in names:
+            continue
+        for size in sizes if sized else [PROVIDER_LIBRARY]:
+            files = library(size)
+            runs = [case(files) for _ in range(repeat)]
+            seconds, ops = min(runs)
+            key = f"{name}/{size}" if sized else name
+            results[key] = {
+                "seconds": round(seconds, 6),
+                "ops": ops,
+                "ops_per_second": round(ops / seconds, 1) if seconds else 0,
+            }
+            print(
+                f"{key:<28} {seconds * 1000:>10.1f} ms {ops / seconds:>14.1f} ops/s",
+                file=sys.stderr,
+            )
+    return results
+
+
+def metadata() -> Dict[str, Any]:
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=HERE,
+            capture_output=True,
+            text=True,
+        ).stdout.strip()
+    except OSError:
+        commit = ""
+    return {
+        "commit": commit,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+    }
+
+
+def compare(
+    results: Dict[str, Result], baseline: Dict[str, Result], tolerance: float
+) -> List[str]:
+    """
+    Return the cases that are slower than the baseline by more than tolerance
+    """
+    regressions = []
+    for key, result in results.items():
+        old = baseline.get(key)
+        if not old or not old["seconds"]:
+            continue
+        change = result["seconds"] / old["seconds"] - 1
+        status = "REGRESSION" if change > tolerance else "ok"
+        print(f"{key:<28} {change:>+8.1%}  {status}", file=sys.stderr)
+        if change > tolerance:
+            regressions.append(key)
+    return regressions
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--sizes", default="1000,10000")
+    parser.add_argument("--cases", help="comma-separated cases to run")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--save", type=Path, help="write the results to a file")
+    parser.add_argument("--compare", type=Path, help="earlier results to compare")
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    args = parser.parse_args()
+    # Unmatched files are expected in some cases and would flood the output
+    logging.getLogger("mediama").setLevel(logging.ERROR)
+
+    sizes = [int(size) for size in args.sizes.split(",")]
+    names = args.cases.split(",") if args.cases else None
+    results = run_cases(sizes, names, args.repeat)
+
+    data = {"meta": metadata(), "results": results}
+    if args.save:
+        args.save.write_text(json.dumps(data, indent=2))
+    else:
+        print(json.dumps(data, indent=2))
+
+    if args.compare:
+        baseline = json.loads(args.compare.read_text())["results"]
+        if compare(results, baseline, args.tolerance):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
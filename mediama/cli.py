@@ -0,0 +1,124 @@
+import argparse
+from pathlib import Path
+from typing import List, Optional
+
+from .__about__ import __version__
+from .config import discover_config, load_config
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        prog="mediama",
+        description="Identify, rename and tag media files using metadata "
+        "aggregated from multiple sources",
+    )
+    parser.add_argument("--version", action="version", version=__version__)
+    parser.add_argument("-c", "--config", type=Path, help="path to a config file")
+    parser.add_argument(
+        "--trace", type=Path, help="write a trace of the spans of the run to this path"
+    )
+    parser.add_argument(
+        "--trace-format",
+        choices=("json", "chrome"),
+        help="format of the trace, by default from the config",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="report the time, memory and requests of each plugin",
+    )
+    parser.add_argument(
+        "--isolate",
+        action="store_true",
+        help="run the tasks of plugins in worker processes",
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run = commands.add_parser("run", help="process files once")
+    run.add_argument("files", nargs="+", type=Path)
+    run.add_argument(
+        "--plan",
+        nargs="?",
+        const=True,
+        type=Path,
+        help="only write a plan of the changes to this path, or print it",
+    )
+
+    apply = commands.add_parser("apply", help="make the changes of a plan")
+    apply.add_argument("plan", type=Path)
+
+    commands.add_parser("daemon", help="watch folders and process files as they arrive")
+    commands.add_parser("serve", help="process files submitted over a local HTTP API")
+
+    submit = commands.add_parser("submit", help="submit files to a running server")
+    submit.add_argument("files", nargs="+", type=Path)
+    submit.add_argument("--url", help="server url, by default from the config")
+    submit.add_argument(
+        "--no-wait", action="store_true", help="return once the job is queued"
+    )
+
+    forget = commands.add_parser(
+        "forget-misses",
+        help="forget the source lookups that found nothing, so they are sent again",
+    )
+    forget.add_argument(
+        "titles", nargs="*", help="only forget the misses of these titles"
+    )
+    forget.add_argument("--source", help="only forget the misses of this source id")
+
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[List[str]] = None):
+    args = parse_args(argv)
+    path = args.config or discover_config()
+    if args.command == "submit" and args.url:
+        cfg = None
+    else:
+        cfg = load_config(path)
+        if args.trace:
+            cfg["trace"]["path"] = str(args.trace)
+        if args.trace_format:
+            cfg["trace"]["format"] = args.trace_format
+        if args.profile:
+            cfg["profile"]["enabled"] = True
+        if args.isolate:
+            cfg["isolation"]["enabled"] = True
+
+    if args.command == "run":
+        from .core import main as run
+
+        run(args.files, cfg, args.plan)
+    elif args.command == "apply":
+        from .core import apply
+
+        apply(args.plan, cfg)
+    elif args.command == "daemon":
+        from .core import configure_logger
+        from .daemon import run_daemon
+
+        configure_logger(cfg)
+        run_daemon(cfg, path)
+    elif args.command == "serve":
+        from .core import configure_logger
+        from .server import run_server
+
+        configure_logger(cfg)
+        run_server(cfg, path)
+    elif args.command == "forget-misses":
+        from .memory import normalize_title
+        from .misses import MissCache
+
+        misses = MissCache.from_config(cfg)
+        if misses is None:
+            print("Misses are not cached")
+            return
+        titles = [normalize_title(title) for title in args.titles]
+        print(f"Forgot {misses.forget(titles, args.source)} miss(es)")
+    elif args.command == "submit":
+        import json
+        from .server import submit
+
+        url = args.url or "http://{host}:{port}".format(**cfg["server"])
+        job = submit([file.resolve() for file in args.files], url, not args.no_wait)
+        print(json.dumps(job, indent=4))
@@ -0,0 +1,93 @@
+import threading
+from logging import getLogger
+from typing import Any, Callable, List, Optional
+
+from .utils import wait_event
+
+logger = getLogger(__name__)
+
+
+class _Batch:
+    def __init__(self):
+        self.items: List[Any] = []
+        self.results: List[Any] = []
+        self.done = threading.Event()
+        self.flushed = False
+        self.timer: Optional[threading.Timer] = None
+
+
+class Loader:
+    """
+    Coalesce the items that concurrent callers load into batched calls, like a
+    dataloader
+
+    The first item of a batch opens a window of ``window`` seconds; the items
+    loaded meanwhile are passed to ``call`` together once the window closes or
+    ``max_size`` items are waiting. ``call`` returns the result of each item
+    in the same order, where a result that is an exception fails only its
+    item.
+    """
+
+    def __init__(
+        self,
+        call: Callable[[List[Any]], List[Any]],
+        max_size: int = 50,
+        window: float = 0.02,
+    ):
+        self.call = call
+        self.max_size = max_size
+        self.window = window
+        self._lock = threading.Lock()
+        self._batch: Optional[_Batch] = None
+
+    def load(self, item: Any, timeout: Optional[float] = None) -> Any:
+        """
+        Return the result of the item once its batch was called
+
+        :raises TimeoutError: if the batch did not return within the timeout
+        """
+        with self._lock:
+            batch = self._batch
+            if batch is None:
+                batch = self._batch = _Batch()
+                batch.timer = threading.Timer(self.window, self._flush, (batch,))
+                batch.timer.daemon = True
+                batch.timer.start()
+            index = len(batch.items)
+            batch.items.append(item)
+            full = len(batch.items) >= self.max_size
+            if full:
+                self._batch = None
+        if full:
+            assert batch.timer is not None
+            batch.timer.cancel()
+            # The batch is called in its own thread, so that it completes even
+            # if the caller that filled it is cancelled
+            threading.Thread(target=self._flush, args=(batch,), daemon=True).start()
+
+        if not wait_event(batch.done, timeout):
+            raise TimeoutError(f"The batch did not return within {timeout}s")
+        result = batch.results[index]
+        if isinstance(result, BaseException):
+            raise result
+        return result
+
+    def _flush(self, batch: _Batch):
+        with self._lock:
+            if batch.flushed:
+                return
+            batch.flushed = True
+            if self._batch is batch:
+                self._batch = None
+        items = batch.items
+        try:
+            results = list(self.call(items))
+            if len(results) != len(items):
+                raise ValueError(
+                    f"Expected {len(items)} results but the batch returned "
+                    f"{len(results)}"
+                )
+        except Exception as e:
+            results = [e] * len(items)
+        batch.results = results
+        batch.done.set()
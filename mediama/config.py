@@ -1,6 +1,17 @@
-from typing import List, Union, Dict, Any, TypedDict, Callable
+from typing import List, Union, Dict, Any, TypedDict, Callable, Optional, Tuple
 from pathlib import Path
+from logging import getLogger
+import os
+import copy
+import json
+import pickle
+import hashlib
+import threading
 
+from .__about__ import __version__
+from .utils import dirs, get_project_root, import_module_from_path, unload_module
+
+logger = getLogger(__name__)
 
 TaskSettings = List[Union[str, Dict[str, Any]]]
 
@@ -23,14 +34,215 @@ class NormalizedConfig(TypedDict):
     limit: int
 
 
-def normalize_config(cfg: Config):
-    default_config = load_config(Path(__file__).parent.joinpath("default_config.json"))
-    for key, value in default_config:
-        cfg.setdefault(key, value)
+DEFAULT_CONFIG = Path(__file__).parent.joinpath("default_config.json")
+# Config file names in the order they are looked for in each config folder
+CONFIG_NAMES = ("config.json", "config.jsonc", "config.py")
+# Bumped whenever normalization changes so stale cached configs are ignored
+CACHE_VERSION = 1
 
-    normalize_pres(cfg["pres"])
-    normalize_sources(cfg["sources"])
-    normalize_posts(cfg["posts"])
+Validator = Callable[[Any, str], None]
+
+
+class Optional_:
+    """
+    Schema node for a value that may also be null
+    """
+
+    def __init__(self, schema: Any):
+        self.schema = schema
+
+
+class AnyOf:
+    """
+    Schema node for a value that matches any of the schemas
+    """
+
+    def __init__(self, *schemas: Any):
+        self.schemas = schemas
+
+
+Number = AnyOf(int, float)
+TaskList = [AnyOf(str, {"name": str})]
+StrLists = {str: [str]}
+
+# Every key must be present once the defaults are merged in. A dict with the
+# single key ``str`` describes a mapping with arbitrary keys; other dicts
+# list their required keys and allow extra ones.
+SCHEMA = {
+    "name": str,
+    "pres": TaskList,
+    "sources": TaskList,
+    "posts": TaskList,
+    "key_sources": StrLists,
+    "aliases": StrLists,
+    "limit": int,
+    "ranks": int,
+    "search_dirs": [str],
+    "log": dict,
+    "cache": Optional_(dict),
+    "state": Optional_(dict),
+    "memory": Optional_(dict),
+    "episodes": Optional_(dict),
+    "misses": Optional_(dict),
+    "watch": {
+        "paths": [str],
+        "recursive": bool,
+        "extensions": [str],
+        "debounce": Number,
+        "max_wait": Number,
+        "metrics_port": Optional_(int),
+    },
+    "server": {
+        "host": str,
+        "port": int,
+        "workers": int,
+        "queue_size": int,
+        "history": int,
+        "metrics": bool,
+    },
+    "trace": {"path": Optional_(str), "format": str},
+    "profile": {
+        "enabled": bool,
+        "cprofile": bool,
+        "memory": bool,
+        "top": int,
+        "path": Optional_(str),
+        "budgets": {str: dict},
+    },
+    "isolation": {
+        "enabled": bool,
+        "workers": int,
+        "max_tasks": Optional_(int),
+        "max_memory": Optional_(Number),
+        "builtins": bool,
+    },
+    "early_exit": {"margin": Optional_(Number), "exact": bool, "background": bool},
+    "coalesce": {"window": Optional_(Number), "max_size": int},
+    "health": {
+        "enabled": bool,
+        "failures": int,
+        "cooldown": Number,
+        "initial": int,
+        "maximum": int,
+        "latency": Optional_(Number),
+        "backoff": Number,
+    },
+    "prefetch": {"enabled": bool, "lead": Number, "interval": Number},
+    "prompt": bool,
+    "timeout": Optional_(Number),
+}
+# Sections that are merged with their defaults key by key instead of being
+# replaced, so that a config only needs to list the settings it changes
+MERGED_SECTIONS = (
+    "watch",
+    "server",
+    "trace",
+    "profile",
+    "isolation",
+    "early_exit",
+    "coalesce",
+    "health",
+    "prefetch",
+)
+
+TYPE_NAMES = {str: "string", int: "integer", float: "number", bool: "boolean"}
+
+
+def _describe(schema: Any) -> str:
+    if isinstance(schema, type):
+        return TYPE_NAMES.get(schema, schema.__name__)
+    if isinstance(schema, AnyOf):
+        return " or ".join(_describe(s) for s in schema.schemas)
+    if isinstance(schema, list):
+        return "list"
+    return "object"
+
+
+def compile_schema(schema: Any) -> Validator:
+    """
+    Compile a schema into a function that validates a value against it
+
+    The schema is walked once here rather than on every validation.
+
+    :returns: a function of the value and its dotted path that raises
+        ValueError if the value does not match
+    """
+    if isinstance(schema, Optional_):
+        inner = compile_schema(schema.schema)
+
+        def validate(value: Any, path: str):
+            if value is not None:
+                inner(value, path)
+
+        return validate
+
+    if isinstance(schema, AnyOf):
+        options = [compile_schema(s) for s in schema.schemas]
+        expected = _describe(schema)
+
+        def validate(value: Any, path: str):
+            for option in options:
+                try:
+                    return option(value, path)
+                except ValueError:
+                    continue
+            raise ValueError(f"{path}: expected {expected}")
+
+        return validate
+
+    if isinstance(schema, type):
+        expected = _describe(schema)
+
+        def validate(value: Any, path: str):
+            # bool is a subclass of int but never a valid integer setting
+            if not isinstance(value, schema) or (
+                isinstance(value, bool) and schema is not bool
+            ):
+                raise ValueError(
+                    f"{path}: expected {expected}, got {type(value).__name__}"
+                )
+
+        return validate
+
+    if isinstance(schema, list):
+        item = compile_schema(schema[0])
+
+        def validate(value: Any, path: str):
+            if not isinstance(value, list):
+                raise ValueError(f"{path}: expected list, got {type(value).__name__}")
+            for i, element in enumerate(value):
+                item(element, f"{path}[{i}]")
+
+        return validate
+
+    if set(schema) == {str}:
+        key_validator = compile_schema(str)
+        value_validator = compile_schema(schema[str])
+
+        def validate(value: Any, path: str):
+            if not isinstance(value, dict):
+                raise ValueError(f"{path}: expected object, got {type(value).__name__}")
+            for key, element in value.items():
+                key_validator(key, f"{path} key")
+                value_validator(element, f"{path}.{key}")
+
+        return validate
+
+    fields = [(key, compile_schema(sub)) for key, sub in schema.items()]
+
+    def validate(value: Any, path: str):
+        if not isinstance(value, dict):
+            raise ValueError(f"{path}: expected object, got {type(value).__name__}")
+        for key, validator in fields:
+            name = f"{path}.{key}" if path else key
+            if key not in value:
+                raise ValueError(f"{name}: missing")
+            validator(value[key], name)
+
+    return validate
+
+
+validate_config = compile_schema(SCHEMA)
 
 
 def _base_normalizer(task_name: str) -> Callable:
@@ -61,16 +273,21 @@ def _base_normalizer(task_name: str) -> Callable:
     return normalize_tasks
 
 
+_normalize_sources = _base_normalizer("src")
+_normalize_pres = _base_normalizer("pre")
+_normalize_posts = _base_normalizer("post")
+
+
 def normalize_sources(sources: TaskSettings):
-    _base_normalizer("src")(sources)
+    _normalize_sources(sources)
 
 
 def normalize_pres(pres: TaskSettings):
-    _base_normalizer("pre")(pres)
+    _normalize_pres(pres)
 
 
 def normalize_posts(posts: TaskSettings):
-    _base_normalizer("post")(posts)
+    _normalize_posts(posts)
 
 
 def filter_duplicate_ids(tasks: List[NormalizedTaskSettings]):
@@ -83,9 +300,202 @@ def filter_duplicate_ids(tasks: List[NormalizedTaskSettings]):
             ids.add(task["id"])
 
 
-def load_config(path: Path) -> dict:
-    raise NotImplementedError
+_default_config: Optional[Config] = None
+
+
+def default_config() -> Config:
+    """
+    Return a copy of the built-in config, which is only read once
+    """
+    global _default_config
+    if _default_config is None:
+        with open(DEFAULT_CONFIG) as f:
+            _default_config = json.load(f)
+    return copy.deepcopy(_default_config)
+
+
+def normalize_config(cfg: Config) -> NormalizedConfig:
+    """
+    Fill in the defaults of a config, validate it and normalize its tasks
+
+    :raises ValueError: if the config does not match the schema
+    """
+    defaults = default_config()
+    for key, value in defaults.items():
+        if key in MERGED_SECTIONS and isinstance(cfg.get(key), dict):
+            cfg[key] = {**value, **cfg[key]}
+        else:
+            cfg.setdefault(key, value)
+
+    validate_config(cfg, "")
+
+    normalize_pres(cfg["pres"])
+    normalize_sources(cfg["sources"])
+    normalize_posts(cfg["posts"])
+    return cfg  # type: ignore[return-value]
+
+
+def read_config(path: Path) -> Config:
+    """
+    Read a config file without normalizing it
+
+    JSON configs may contain comments. Python configs must define a top-level
+    ``config`` dict.
+
+    :raises ValueError: if the file is not a valid config
+    """
+    path = Path(path)
+    if path.suffix == ".py":
+        module = import_module_from_path(path)
+        try:
+            cfg = getattr(module, "config", None)
+        finally:
+            unload_module(module)
+        if not isinstance(cfg, dict):
+            raise ValueError(f"{path} does not define a config dict")
+        return copy.deepcopy(cfg)
+
+    if path.suffix not in (".json", ".jsonc"):
+        raise ValueError(f"Unsupported config format: {path}")
+    with open(path) as f:
+        text = f.read()
+    try:
+        # Most configs have no comments, so try the fast parser first
+        cfg = json.loads(text)
+    except ValueError:
+        import jstyleson  # type: ignore[import]
+
+        cfg = jstyleson.loads(text)
+    if not isinstance(cfg, dict):
+        raise ValueError(f"{path} does not contain a config object")
+    return cfg
+
+
+def _stat_key(path: Path) -> Tuple[int, int]:
+    st = path.stat()
+    return st.st_mtime_ns, st.st_size
+
+
+def _cache_path(data: bytes) -> Path:
+    digest = hashlib.sha1()
+    digest.update(f"{CACHE_VERSION}:{__version__}:".encode())
+    digest.update(DEFAULT_CONFIG.read_bytes())
+    digest.update(data)
+    return Path(dirs.user_cache_dir) / "config" / f"{digest.hexdigest()}.pickle"
+
+
+def _read_cache(path: Path) -> Optional[NormalizedConfig]:
+    try:
+        with open(path, "rb") as f:
+            return pickle.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logger.debug(f"Ignoring the unreadable config cache {path}: {e}")
+        return None
+
+
+def _write_cache(path: Path, cfg: NormalizedConfig):
+    part = path.with_name(f".{path.name}.{os.getpid()}")
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(part, "wb") as f:
+            pickle.dump(cfg, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(part, path)
+    except OSError as e:
+        logger.debug(f"Failed to cache the config at {path}: {e}")
+        part.unlink(missing_ok=True)
+
+
+# Normalized configs of this process keyed by path, with the stat they were
+# loaded at
+_loaded: Dict[Path, Tuple[Tuple[int, int], NormalizedConfig]] = {}
+_lock = threading.Lock()
+
+
+def load_config(path: Path) -> NormalizedConfig:
+    """
+    Load and normalize a config file
+
+    Configs are cached in memory until the file changes. Normalized JSON
+    configs are also cached on disk, keyed by the hash of the file, so that
+    new processes skip parsing and validating them. Python configs are
+    executed every time a new process loads them, since they may depend on
+    more than their own source.
+
+    :raises ValueError: if the config is not valid
+    """
+    path = Path(path).resolve()
+    stat = _stat_key(path)
+    with _lock:
+        loaded = _loaded.get(path)
+    if loaded and loaded[0] == stat:
+        return copy.deepcopy(loaded[1])
+
+    cache = None
+    cfg: Optional[NormalizedConfig] = None
+    if path.suffix != ".py":
+        cache = _cache_path(path.read_bytes())
+        cfg = _read_cache(cache)
+    if cfg is None:
+        try:
+            cfg = normalize_config(read_config(path))
+        except ValueError as e:
+            raise ValueError(f"Invalid config {path}: {e}")
+        if cache:
+            _write_cache(cache, cfg)
+
+    with _lock:
+        _loaded[path] = (stat, cfg)
+    return copy.deepcopy(cfg)
 
 
 def discover_config() -> Path:
-    raise NotImplementedError
+    """
+    Return the user config, or else the system config, or else the built-in
+    config
+    """
+    for folder in (dirs.user_config_dir, dirs.site_config_dir):
+        for name in CONFIG_NAMES:
+            path = Path(folder) / name
+            if path.is_file():
+                return path
+    return get_project_root().joinpath("mediama", "default_config.json")
+
+
+class ConfigReloader:
+    """
+    Reload a config when its file changes
+
+    Long-running modes poll the reloader, which only stats the file unless it
+    changed. A config that fails to load is logged and the previous config is
+    kept.
+    """
+
+    def __init__(self, path: Path, cfg: NormalizedConfig):
+        self.path = Path(path)
+        self.cfg = cfg
+        self._stat = self._current()
+
+    def _current(self) -> Optional[Tuple[int, int]]:
+        try:
+            return _stat_key(self.path)
+        except OSError:
+            return None
+
+    def poll(self) -> Optional[NormalizedConfig]:
+        """
+        Return the new config if the file changed since the last poll
+        """
+        stat = self._current()
+        if stat == self._stat or stat is None:
+            return None
+        self._stat = stat
+        try:
+            cfg = load_config(self.path)
+        except Exception as e:
+            logger.error(f"Keeping the current config, failed to reload: {e}")
+            return None
+        logger.info(f"Reloaded the config from {self.path}")
+        self.cfg = cfg
+        return cfg
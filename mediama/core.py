@@ -1,14 +1,40 @@
+import sys
 import logging.config
+import threading
 from logging import getLogger
 from pathlib import Path
+from functools import partial
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple, Type, Union
 
-import gevent
-import requests_cache
-
-from .utils import dirs
-from .config import NormalizedConfig, discover_config, load_config
-from .metadata import VariablePool, Metadata
+from .utils import dirs, rank_certainty
+from .config import (
+    NormalizedConfig,
+    NormalizedTaskSettings,
+    discover_config,
+    load_config,
+)
+from .metadata import VariablePool, Metadata, PerFile
+from .decisions import Ambiguous, Decision, Decisions, Rankings
+from .trace import Metrics, Tracer, record_response
+from .profiling import Profiler
+from .isolation import WorkerPool
+from .health import Health
 from .managers import PreProcessManager, SourceManager, PostProcessManager
+from .memory import SeriesMemory, normalize_title
+from .episodes import EpisodeCache
+from .misses import MissCache
+from .prefetch import Prefetcher
+from .state import RunState, STAGES, Fingerprints, Rows, stage_fingerprints
+from .plan import (
+    Changes,
+    Plan,
+    build_plan,
+    load_plan,
+    plan_changes,
+    plan_pool,
+    save_plan,
+    unchanged_files,
+)
 
 
 logger = getLogger(__name__)
@@ -24,33 +50,58 @@ def configure_requests_cache(cfg: NormalizedConfig):
     if not cfg["cache"]:
         return
 
+    # requests_cache pulls in the whole requests stack, so it is only imported
+    # once a source is about to run
+    import requests_cache
+
     path = Path(config["path"])
     if not path.is_absolute():
         path = Path(dirs.user_data_dir) / (path or "cache")
 
-    requests_cache.install_cache(path)
+    class TracedSession(requests_cache.CachedSession):
+        # Count the requests, bytes and cache hits of the current span
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.hooks["response"].append(record_response)
+
+    # Expired responses with an ETag or Last-Modified date are revalidated
+    # with a conditional request rather than fetched again
+    expire_after = config.get("expire_after")
+    requests_cache.install_cache(
+        path,
+        session_factory=TracedSession,
+        expire_after=-1 if expire_after is None else expire_after,
+    )
 
 
 def execute_process(
-    mgr, task, name: str = "main", set_metadata: bool = True
+    mgr, task, name: str = "main", set_metadata: bool = True, **kwargs
 ) -> Metadata:
-    try:
-        logger.debug(f"Loading {task.name} with id: {task.id}")
-        t = mgr.load_task(task)
-    except Exception as e:
-        logger.error(f"Error while loading {task.name}: {e}")
-        raise e
+    with mgr.tracer.span(name, mgr.stage, task["id"], plugin=task["name"]):
+        try:
+            logger.debug(f"Loading {task['name']} with id: {task['id']}")
+            t = mgr.load_task(mgr.discover_tasks()[task["name"]])
+        except Exception as e:
+            logger.error(f"Error while loading {task['name']}: {e}")
+            raise e
 
-    try:
-        logger.debug(f"Executing {task.id} with {task.kwargs}")
-        id_ = task.id if set_metadata else None
-        return mgr.execute_task(t, id_=id_, name=name, **task.kwargs)
-    except Exception as e:
-        logger.error(f"Error while executing {task.id}: {e}")
-        raise e
+        try:
+            logger.debug(f"Executing {task['id']} with {task['kwargs']}")
+            id_ = task["id"] if set_metadata else None
+            return mgr.execute_task(
+                t, id_=id_, name=name, task_id=task["id"], **task["kwargs"], **kwargs
+            )
+        except Exception as e:
+            logger.error(f"Error while executing {task['id']}: {e}")
+            raise e
 
 
 def execute_disambiguator(mgr, ranking, name, cfg):
+    """
+    Return the candidate chosen by a disambiguator of the manager
+
+    :raises Ambiguous: if it fails and the choice is left to the user
+    """
     try:
         func = getattr(mgr, name)
         idx = func(ranking)
@@ -58,121 +109,871 @@ def execute_disambiguator(mgr, ranking, name, cfg):
         logger.debug("Automatic disambiguation failed")
         if not cfg["prompt"]:
             raise e
-        idx = int(input())
+        raise Ambiguous(ranking) from e
     return ranking[idx]
 
 
-def main(filepaths: list, cfg: NormalizedConfig):
-    # Note that the logger is not yet loaded since it depends on the cfg
-    # Import the config if not given
-    if not cfg:
-        cfg_path = discover_config()
-        cfg = load_config(cfg_path)
-
-    # Configure the logger
-    configure_logger(cfg)
-    # Log missed functions
-    logger.debug(f"Config path loaded: {cfg_path}")
-    logger.debug(f"Config settings: {cfg}")
-    logger.debug(f"File args: {[str(file) for file in filepaths]}")
-
-    # Setup requests cache
-    configure_requests_cache(cfg)
-
-    # Setup the varpool
-    logger.debug("Setting up variable pool")
-    varpool = VariablePool(cfg, id_="mediama")
-    varpool["filepaths"] = filepaths
-
-    # Initialize the managers
-    logger.debug("Setting up managers")
-    try:
-        pre_mgr = PreProcessManager(cfg, metadata=varpool)
-        src_mgr = SourceManager(cfg, metadata=varpool)
-        post_mgr = PreProcessManager(cfg, metadata=varpool)
-    except Exception as e:
-        logger.critical(f"Failed to setup managers: {e}")
-        raise e
-
-    # Discover the tasks early to catch errors early
-    logger.debug("Discovering tasks")
-    try:
-        pre_mgr.discover_tasks()
-        src_mgr.discover_tasks()
-        post_mgr.discover_tasks()
-    except Exception as e:
-        logger.critical(f"Failed to discover tasks: {e}")
-        raise e
-
-    # Begin execution
-    # Preprocess
+def run_pres(pre_mgr: PreProcessManager, cfg: NormalizedConfig) -> bool:
+    """
+    Execute the preprocess tasks and return whether every task succeeded
+    """
     logger.debug("Executing preprocess tasks")
+    ok = True
     for task in cfg["pres"]:
         try:
             execute_process(pre_mgr, task)
         except Exception:
             # The errors are captured in execute_process
+            ok = False
             continue
+    return ok
+
+
+def is_certain(
+    src_mgr: SourceManager,
+    rankings: Rankings,
+    title: Optional[str],
+    cfg: NormalizedConfig,
+) -> bool:
+    """
+    Return whether the partial aggregate of the rankings is certain enough
+    to stop waiting for the other sources, see ``cfg["early_exit"]``
+
+    :param title: the normalized title of the files, if known
+    """
+    policy = cfg["early_exit"]
+    if not rankings:
+        return False
+    names = [[result["name"] for result in ranking] for _, ranking in rankings]
+    weights = [1 for _ in rankings]  # TODO: RESERVED FOR FUTURE
+    margin = policy["margin"]
+    if margin is not None and rank_certainty(names, weights) >= margin:
+        return True
+    if policy["exact"] and title:
+        # The best series is named exactly like the files and no other is
+        matches = {
+            name
+            for ranking in names
+            for name in ranking
+            if normalize_title(name) == title
+        }
+        best = src_mgr.aggregate(*[(id_, ranking, 1) for id_, ranking in rankings])
+        return len(matches) == 1 and normalize_title(best[0]["name"]) == title
+    return False
+
+
+def fetch_series(
+    src_mgr: SourceManager, cfg: NormalizedConfig, title: Optional[str] = None
+) -> Tuple[Rankings, Dict[str, Any]]:
+    """
+    Fetch the series rankings of every source concurrently, leaving out the
+    sources that failed or timed out
+
+    If early exit is enabled, the search stops as soon as the sources of the
+    highest priorities that answered are certain of the series. The sources
+    still searching are then cancelled or, in the background, left to finish
+    while the episodes of the others are fetched.
+
+    Sources run in greenlets and mediama does not monkey patch the standard
+    library, so only sources that wait on gevent, e.g. with gevent's sockets,
+    run concurrently and can be interrupted. A source blocked in plain I/O,
+    such as a requests call, keeps the other sources from running until it
+    returns, and cancelling it only stops waiting for its result.
+
+    :param title: the normalized title of the files, if known
+    :returns: the rankings and the greenlets of the sources left searching in
+        the background
+    """
+    import gevent
 
-    # Source
-    # Fetch series metadata
     logger.debug("Fetching series metadata")
-    src_ids = [task.id for task in cfg["sources"]]
-    src_wts = [1 for task in cfg["sources"]]  # TODO: RESERVED FOR FUTURE
-    tasks = [
-        gevent.spawn(execute_process, src_mgr, task, name="fetch_series")
-        for task in cfg["sources"]
+    policy = cfg["early_exit"]
+    early = policy["margin"] is not None or policy["exact"]
+    sources = src_mgr.route(cfg["sources"], "fetch_series")
+    order = [task["id"] for task in sources]
+    greenlets = {
+        task["id"]: gevent.spawn(execute_process, src_mgr, task, name="fetch_series")
+        for task in sources
+    }
+    decided = False
+    if not early:
+        gevent.joinall(list(greenlets.values()), cfg["timeout"])
+    else:
+        for _ in gevent.iwait(list(greenlets.values()), cfg["timeout"]):
+            # Lower priority sources only decide once every source above
+            # them answered
+            answered = []
+            for id_ in order:
+                if not greenlets[id_].ready():
+                    break
+                if greenlets[id_].successful():
+                    answered.append((id_, greenlets[id_].value))
+            if len(answered) < len(order) and is_certain(src_mgr, answered, title, cfg):
+                decided = True
+                break
+
+    rankings = [
+        (id_, greenlet.value)
+        for id_, greenlet in greenlets.items()
+        if greenlet.ready() and greenlet.successful()
     ]
-    gevent.joinall(tasks, cfg["timeout"])
-    # Collect results
-    rankings = zip(src_ids, [task.value for task in tasks])
+    pending = {
+        id_: greenlet for id_, greenlet in greenlets.items() if not greenlet.ready()
+    }
+    if not decided and src_mgr.health is not None:
+        for id_ in pending:
+            src_mgr.health.timed_out(id_)
+    if not early or not pending:
+        return rankings, {}
+    if policy["background"]:
+        logger.debug(f"Leaving {list(pending)} to search in the background")
+        return rankings, pending
+    logger.debug(f"Cancelling the series search of {list(pending)}")
+    gevent.killall(list(pending.values()), block=False)
+    return rankings, {}
+
+
+def choose_series(
+    src_mgr: SourceManager, rankings: Rankings, cfg: NormalizedConfig
+) -> str:
+    """
+    Aggregate the rankings of the sources and return the name of the series
+
+    :raises Ambiguous: if the series cannot be chosen automatically and the
+        choice is left to the user
+    """
+    tracer = src_mgr.tracer
+    weights = {task["id"]: 1 for task in cfg["sources"]}  # TODO: RESERVED FOR FUTURE
     # Aggregate series metadata
     logger.debug("Aggregating series metadata")
-    ranking = src_mgr.aggregate(zip(*rankings, src_wts))
+    with tracer.span("aggregate", "sources"):
+        ranking = src_mgr.aggregate(
+            *[(id_, ranking, weights[id_]) for id_, ranking in rankings]
+        )
     # Disambiguate
     logger.debug("Disambiguating series")
     try:
-        name = execute_disambiguator(src_mgr, ranking, "disambiguate_series", cfg)[
-            "name"
-        ]
-    except Exception as e:
-        # Logging occurs in the executor
+        with tracer.span("disambiguate_series", "sources"):
+            return execute_disambiguator(src_mgr, ranking, "disambiguate_series", cfg)[
+                "name"
+            ]
+    except Ambiguous as e:
+        e.rankings = rankings
         raise e
-    # Add series metadata to the variable pool
+
+
+def set_series(varpool: VariablePool, rankings: Rankings, name: str):
+    """
+    Add the metadata of the chosen series from each source to the pool
+    """
     for id_, ranking in rankings:
-        data = tuple(filter(lambda result: result["name"] == name, ranking))[0]
-        varpool.set_(data, id_)
+        data = [result for result in ranking if result["name"] == name]
+        if data:
+            varpool.set_(data[0], id_)
+
+
+def fetch_episode_metadata(
+    src_mgr: SourceManager,
+    varpool: VariablePool,
+    filepaths: list,
+    cfg: NormalizedConfig,
+    before: Optional[Dict[str, Callable[[], None]]] = None,
+) -> List[Tuple[str, Metadata]]:
+    """
+    Fetch the episode metadata of every source and match it to the files
+
+    Pages are streamed from every source and matched to files as they arrive,
+    so only the current pages are held in memory.
+
+    :param before: functions to call, by source id, before the episodes of
+        the source are fetched
 
-    # Fetch episode metadata
+    :returns: the episodes that could not be matched automatically if some
+        files are left unmatched and the choice is left to the user, or else
+        an empty list
+    """
+    tracer = src_mgr.tracer
     logger.debug("Fetching episode metadata")
-    tasks = [
-        gevent.spawn(execute_process, src_mgr, task, name="fetch_episodes")
-        for task in cfg["sources"]
-    ]
-    gevent.joinall(tasks, cfg["timeout"])
-    # Aggregate episode metadata
-    logger.debug("Aggregating episode metadata")
-    episodes = src_mgr.aggregate(
-        [
-            task.value if isinstance(tasks.value, list) else [task.value]
-            for task in tasks
-        ]
-    )
 
-    # Disambiguate
-    logger.debug("Disambiguating episodes")
-    try:
-        data = execute_disambiguator(src_mgr, episodes, "disambiguate_episodes", cfg)
-    except Exception as e:
-        # Logging occurs in the executor
-        raise e
-    logger.debug(f"Episode metadata: {data}")
+    def fetch_episodes(task: dict):
+        if before and task["id"] in before:
+            before[task["id"]]()
+        # Paginated sources do their work while their pages are consumed, so
+        # the pages are timed separately from the call
+        pages = execute_process(
+            src_mgr, task, name="fetch_episodes", set_metadata=False
+        )
+        return tracer.iterate(pages, "episode_pages", "sources", task=task["id"])
+
+    producers = {
+        task["id"]: partial(fetch_episodes, task)
+        for task in src_mgr.route(cfg["sources"], "fetch_episodes")
+    }
+    pages = src_mgr.stream_episodes(producers, cfg["timeout"])
+    # Match episodes to files, writing the episodes of each file as it matches
+    logger.debug("Matching episode metadata")
+    matched = set()
+    ambiguous: Optional[List[Tuple[str, Metadata]]] = [] if cfg["prompt"] else None
+    matches = src_mgr.match_episodes(pages, filepaths, producers, ambiguous)
+    for path, data in tracer.iterate(matches, "match_episodes", "sources"):
+        logger.debug(f"Episode metadata for {path}: {data}")
+        varpool.set_({"episodes": data}, varpool.id, path)
+        matched.add(Path(path))
+    unmatched = [path for path in filepaths if Path(path) not in matched]
+    for path in unmatched:
+        logger.warning(f"No episode metadata matched {path}")
+    return ambiguous if unmatched and ambiguous else []
+
+
+def run_sources(
+    src_mgr: SourceManager,
+    varpool: VariablePool,
+    filepaths: list,
+    cfg: NormalizedConfig,
+    memory: Optional[SeriesMemory] = None,
+) -> List[Tuple[str, Metadata]]:
+    """
+    Fetch the series and episode metadata of the files from every source
+
+    :param memory: if given, the series of files of a known release is taken
+        from it instead of the sources, and the series chosen for other files
+        is stored in it
+
+    :returns: the episodes left for the user to match, see
+        fetch_episode_metadata
+    :raises Ambiguous: if the series is left for the user to choose
+    """
+    known = None
+    before = None
+    key = SeriesMemory.key(filepaths)
+    sources = src_mgr.route(cfg["sources"], "fetch_series")
+    if memory and key:
+        with src_mgr.tracer.span("recall_series", "sources") as span:
+            known = memory.recall(key, sources)
+            span.attrs["hit"] = known is not None
+    if known:
+        # The series of this release is known, so the sources are not asked
+        for id_, data in known.items():
+            varpool.set_(data, id_)
+    else:
+        rankings, background = fetch_series(src_mgr, cfg, key[0] if key else None)
+        try:
+            name = choose_series(src_mgr, rankings, cfg)
+        except Exception:
+            for greenlet in background.values():
+                greenlet.kill(block=False)
+            raise
+        set_series(varpool, rankings, name)
+
+        def enrich(id_: str):
+            # Sources that were still searching add their metadata of the
+            # chosen series before their episodes are fetched
+            greenlet = background[id_]
+            greenlet.join(cfg["timeout"])
+            if greenlet.ready() and greenlet.successful():
+                rankings.append((id_, greenlet.value))
+                set_series(varpool, [(id_, greenlet.value)], name)
+            else:
+                greenlet.kill(block=False)
 
-    # Postprocess
+        before = {id_: partial(enrich, id_) for id_ in background}
+    ambiguous = fetch_episode_metadata(src_mgr, varpool, filepaths, cfg, before)
+    if memory and key and not known:
+        memory.learn(key, name, rankings, sources)
+    return ambiguous
+
+
+def run_posts(post_mgr: PostProcessManager, cfg: NormalizedConfig) -> bool:
+    """
+    Execute the postprocess tasks and return whether every task succeeded
+    """
     logger.debug("Executing postprocess tasks")
-    for task in cfg["pres"]:
+    ok = True
+    for task in cfg["posts"]:
         try:
             execute_process(post_mgr, task)
         except Exception:
             # The errors are captured in execute_process
+            ok = False
+            continue
+    return ok
+
+
+def has_side_effects(tasks: Dict[str, Type], task: NormalizedTaskSettings) -> bool:
+    return getattr(tasks.get(task["name"]), "side_effects", True)
+
+
+def plan_posts(
+    post_mgr: PostProcessManager, cfg: NormalizedConfig, tasks: Dict[str, Type]
+) -> Tuple[Changes, List[str], bool]:
+    """
+    Run the postprocess tasks without side effects and plan the others
+
+    :param tasks: discovered postprocess tasks
+    :returns: the changes planned by each task, the ids of the tasks that
+        cannot be planned and whether every task succeeded
+    """
+    logger.debug("Planning postprocess tasks")
+    changes: Changes = {}
+    deferred = []
+    ok = True
+    for task in cfg["posts"]:
+        try:
+            if not has_side_effects(tasks, task):
+                execute_process(post_mgr, task)
+                continue
+            planned = execute_process(post_mgr, task, name="plan", set_metadata=False)
+        except Exception:
+            # The errors are captured in execute_process
+            ok = False
+            continue
+        if planned is None:
+            logger.info(f"{task['id']} cannot be planned; it runs when applying")
+            deferred.append(task["id"])
+        else:
+            changes[task["id"]] = planned
+    return changes, deferred, ok
+
+
+def apply_posts(
+    post_mgr: PostProcessManager,
+    cfg: NormalizedConfig,
+    tasks: Dict[str, Type],
+    changes: Changes,
+    deferred: List[str],
+) -> bool:
+    """
+    Make the planned changes of the postprocess tasks with side effects and
+    return whether every task succeeded
+
+    The tasks without side effects already ran while planning and their
+    results are part of the restored pool.
+    """
+    logger.debug("Applying postprocess tasks")
+    ok = True
+    for task in cfg["posts"]:
+        if not has_side_effects(tasks, task):
+            continue
+        try:
+            if task["id"] in deferred:
+                execute_process(post_mgr, task)
+            else:
+                execute_process(
+                    post_mgr, task, name="apply", changes=changes.get(task["id"], {})
+                )
+        except Exception:
+            ok = False
+            continue
+    return ok
+
+
+def restore_pool(
+    varpool: VariablePool,
+    state: RunState,
+    filepaths: list,
+    ids: Optional[Iterable[str]] = None,
+):
+    """
+    Restore the pool as it was after the sources stage from the run state
+
+    :param ids: only restore the values of these task ids, e.g. those of the
+        preprocess tasks when the sources run again
+    """
+    ids = None if ids is None else set(ids)
+    for path in filepaths:
+        for id_, key, value, *file in state.pool(path):
+            if ids is not None and id_ not in ids:
+                continue
+            if file:
+                varpool.load([(id_, key, value, *file)])
+            elif key == "episodes":
+                # States recorded before episodes were scoped to their file
+                varpool.set_({key: PerFile(value)}, id_)
+            elif key != "filepaths":
+                varpool.load([(id_, key, value)])
+
+
+def record_state(
+    varpool: VariablePool,
+    state: RunState,
+    filepaths: list,
+    fingerprints: Fingerprints,
+    pool: Rows,
+    cfg: NormalizedConfig,
+):
+    """
+    Record every file that was matched in this run
+
+    Files moved by the postprocess tasks are recorded at their destination,
+    so the next run of the moved file finds its state.
+    """
+    post_ids = {task["id"] for task in cfg["posts"]}
+    outputs = [row for row in varpool.dump() if row[0] in post_ids]
+    moved: Dict[Path, Path] = {}
+    for moves in varpool.get_all("moved").values():
+        moved.update({Path(src): Path(dst) for src, dst in moves.items()})
+    matched = {file[0] for _, key, _, *file in pool if key == "episodes" and file}
+    for path in map(Path, filepaths):
+        if str(path) not in matched:
+            continue
+        destination = moved.get(path, path)
+        # Only keep the values of the batch and the values of this file
+        rows: Rows = [
+            (id_, key, value, str(destination)) if file else (id_, key, value)
+            for id_, key, value, *file in pool
+            if not file or file == [str(path)]
+        ]
+        state.record(destination, fingerprints, rows, outputs)
+
+
+class Engine:
+    """
+    The managers, discovered tasks and run state of a config
+
+    These are set up once so that many runs can share them, e.g. in the
+    daemon. Each run gets its own variable pool.
+    """
+
+    def __init__(
+        self,
+        cfg: NormalizedConfig,
+        metrics: Optional[Metrics] = None,
+        decisions: Optional[Decisions] = None,
+    ):
+        self.cfg = cfg
+        # Choices left to the user, which long-running modes keep across
+        # engines
+        self.decisions = decisions if decisions is not None else Decisions()
+        # Spans are kept for a trace file if one is configured, and totalled
+        # into the metrics of long-running modes
+        self.tracer = Tracer(bool(cfg["trace"]["path"]), metrics)
+        self.profiler = Profiler.from_config(cfg["profile"])
+        self.workers = WorkerPool.from_config(cfg)
+        # Circuit breakers and concurrency limits of the sources, whose state
+        # is shown by the server and the metrics
+        self.health = Health.from_config(cfg["health"])
+        if metrics is not None:
+            metrics.health = self.health
+        # The requests cache is set up before the sources first run, so runs
+        # that skip every file never import it
+        self._requests_cache = False
+        self._requests_cache_lock = threading.Lock()
+
+        # Initialize the managers
+        # A pool is bound to the managers at the start of each run
+        logger.debug("Setting up managers")
+        try:
+            self.pre_mgr = PreProcessManager(cfg, metadata=None)
+            self.src_mgr = SourceManager(cfg, metadata=None)
+            self.post_mgr = PostProcessManager(cfg, metadata=None)
+        except Exception as e:
+            logger.critical(f"Failed to setup managers: {e}")
+            raise e
+        for mgr in (self.pre_mgr, self.src_mgr, self.post_mgr):
+            mgr.tracer = self.tracer
+            mgr.profiler = self.profiler
+            mgr.workers = self.workers
+        self.src_mgr.health = self.health
+
+        # Discover the tasks early to catch errors early
+        logger.debug("Discovering tasks")
+        try:
+            self.tasks = {
+                "pres": self.pre_mgr.discover_tasks(),
+                "sources": self.src_mgr.discover_tasks(),
+                "posts": self.post_mgr.discover_tasks(),
+            }
+        except Exception as e:
+            logger.critical(f"Failed to discover tasks: {e}")
+            raise e
+
+        self.state = RunState.from_config(cfg)
+        self.memory = SeriesMemory.from_config(cfg)
+        self.episodes = EpisodeCache.from_config(cfg)
+        self.src_mgr.episode_cache = self.episodes
+        self.misses = MissCache.from_config(cfg)
+        self.src_mgr.misses = self.misses
+        self.fingerprints = stage_fingerprints(cfg, self.tasks)
+        # Long-running modes refresh airing series in the background
+        self.prefetcher: Optional[Prefetcher] = None
+        # Workers import the plugins while the engine waits for files
+        if self.workers:
+            self.workers.start()
+
+    def close(self):
+        """
+        Stop the prefetcher and the worker processes of the plugins, if any
+        """
+        if self.prefetcher:
+            self.prefetcher.close()
+        if self.workers:
+            self.workers.close()
+
+    def start_prefetch(self):
+        """
+        Start refreshing the episodes of airing series in the background, if
+        prefetching and the episode cache are enabled
+        """
+        if self.prefetcher is None:
+            self.prefetcher = Prefetcher.from_config(self)
+            if self.prefetcher:
+                self.prefetcher.start()
+
+    def _setup_requests_cache(self):
+        with self._requests_cache_lock:
+            if not self._requests_cache:
+                configure_requests_cache(self.cfg)
+                self._requests_cache = True
+
+    def save_trace(self):
+        """
+        Write the spans recorded so far to the configured trace file
+        """
+        config = self.cfg["trace"]
+        if config["path"]:
+            self.tracer.save(Path(config["path"]), config["format"])
+
+    def report_profile(self) -> Optional[str]:
+        """
+        Return the cost of the plugins since the last report, or None if they
+        are not profiled
+
+        The function profiles are also written to the configured folder.
+        """
+        config = self.cfg["profile"]
+        if not self.profiler or not config["enabled"]:
+            return None
+        report = self.profiler.report(config["top"])
+        if config["path"]:
+            self.profiler.dump(Path(config["path"]))
+        self.profiler.reset()
+        return report
+
+    def _identify(self, filepaths: list) -> Optional[Tuple]:
+        """
+        Run the stages before the postprocess tasks
+
+        :returns: the pool, the bound postprocess manager, the files left to
+            process, the pool rows after the sources stage and whether every
+            task succeeded, or None if every file was skipped
+        """
+        cfg = self.cfg
+        state = self.state
+        logger.debug(f"File args: {[str(file) for file in filepaths]}")
+
+        # Setup the varpool
+        logger.debug("Setting up variable pool")
+        varpool = VariablePool(cfg, id_="mediama")
+        pre_mgr = self.pre_mgr.bind(varpool)
+        src_mgr = self.src_mgr.bind(varpool)
+        post_mgr = self.post_mgr.bind(varpool)
+
+        # Skip the files that are unchanged since their last successful run and
+        # resume the rest from the first stage whose inputs changed
+        stage = STAGES[0]
+        if state:
+            stages = {path: state.stage(path, self.fingerprints) for path in filepaths}
+            for path, stage_ in stages.items():
+                if stage_ is None:
+                    logger.info(f"Skipping unchanged file: {path}")
+                else:
+                    logger.debug(f"Resuming {path} from {stage_}")
+            filepaths = [path for path in filepaths if stages[path]]
+            if not filepaths:
+                return None
+            stage = min((stages[path] for path in filepaths), key=STAGES.index)
+            # The outputs of the skipped stages are restored: every value when
+            # only the posts run, and those of the pres when the sources do
+            if stage == "posts":
+                restore_pool(varpool, state, filepaths)
+            elif stage != STAGES[0]:
+                pres = [task["id"] for task in cfg["pres"]]
+                restore_pool(varpool, state, filepaths, pres)
+        varpool["filepaths"] = filepaths
+
+        # Begin execution
+        ok = True
+        if STAGES.index(stage) <= STAGES.index("pres"):
+            ok = run_pres(pre_mgr, cfg) and ok
+        if STAGES.index(stage) <= STAGES.index("sources"):
+            self._setup_requests_cache()
+            try:
+                ambiguous = run_sources(src_mgr, varpool, filepaths, cfg, self.memory)
+            except Ambiguous as e:
+                # The other batches go on while this one waits for the user
+                self.decisions.park(
+                    Decision(
+                        "series", filepaths, e.candidates, varpool.dump(), e.rankings
+                    )
+                )
+                return None
+            self._park_episodes(varpool, filepaths, ambiguous)
+        return varpool, post_mgr, filepaths, varpool.dump(), ok
+
+    def _park_episodes(
+        self,
+        varpool: VariablePool,
+        filepaths: list,
+        ambiguous: List[Tuple[str, Metadata]],
+    ):
+        """
+        Park the choice of the episodes of the files left unmatched
+        """
+        if not ambiguous:
+            return
+        episodes = varpool.files("episodes", varpool.id)
+        unmatched = [path for path in filepaths if Path(path) not in episodes]
+        self.decisions.park(Decision("episodes", unmatched, ambiguous, varpool.dump()))
+
+    def _finish(
+        self,
+        varpool: VariablePool,
+        post_mgr: PostProcessManager,
+        filepaths: list,
+        pool: Rows,
+        ok: bool,
+    ):
+        """
+        Run the postprocess tasks and record the run if it succeeded
+        """
+        ok = run_posts(post_mgr, self.cfg) and ok
+        # Only successful runs are recorded
+        if self.state and ok:
+            record_state(
+                varpool, self.state, filepaths, self.fingerprints, pool, self.cfg
+            )
+
+    def run(self, filepaths: list) -> Optional[VariablePool]:
+        """
+        Process the files and return the pool of the run or None if every
+        file was skipped or the series is left for the user to choose
+
+        Files whose series or episodes are left for the user to choose are
+        parked in ``decisions`` while the others are processed.
+        """
+        with self.tracer.span("run", "run", files=len(filepaths)):
+            identified = self._identify(filepaths)
+            if identified is None:
+                return None
+            self._finish(*identified)
+            return identified[0]
+
+    def resolve(self, id_: str, choice: Any) -> VariablePool:
+        """
+        Resume the run of a parked decision with the user's answer and return
+        the pool of the run
+
+        A series choice resumes from the episodes of the sources. An episode
+        choice only needs the postprocess tasks; the files it leaves out stay
+        unmatched.
+
+        :param choice: the index of the series, or the index of the episode of
+            each file
+        :raises KeyError: if there is no pending decision with the id
+        :raises ValueError: if the answer is invalid
+        """
+        decision, answer = self.decisions.take(id_, choice)
+        cfg = self.cfg
+        with self.tracer.span("resolve", "run", files=len(decision.files)):
+            varpool = VariablePool(cfg, id_="mediama")
+            # The files that matched were already processed by the parked run
+            varpool.load(
+                row for row in decision.pool if row[1] != "episodes" or not row[3:]
+            )
+            if decision.kind == "series":
+                filepaths = decision.files
+                varpool["filepaths"] = filepaths
+                name = decision.candidates[answer]["name"]
+                set_series(varpool, decision.rankings, name)
+                key = self.memory.key(filepaths) if self.memory else None
+                if self.memory and key:
+                    # The user's answer is trusted at once
+                    self.memory.learn(
+                        key, name, decision.rankings, cfg["sources"], answered=True
+                    )
+                self._setup_requests_cache()
+                ambiguous = fetch_episode_metadata(
+                    self.src_mgr.bind(varpool), varpool, filepaths, cfg
+                )
+                self._park_episodes(varpool, filepaths, ambiguous)
+            else:
+                filepaths = list(answer)
+                varpool["filepaths"] = filepaths
+                episodes = {
+                    path: dict([decision.candidates[index]])
+                    for path, index in answer.items()
+                }
+                varpool.set_({"episodes": PerFile(episodes)}, varpool.id)
+            post_mgr = self.post_mgr.bind(varpool)
+            self._finish(varpool, post_mgr, filepaths, varpool.dump(), True)
+            return varpool
+
+    def plan(self, filepaths: list) -> Optional[Plan]:
+        """
+        Identify the files and plan the postprocess tasks without making any
+        change to the files, or return None if every file was skipped
+        """
+        with self.tracer.span("plan", "run", files=len(filepaths)):
+            identified = self._identify(filepaths)
+            if identified is None:
+                return None
+            varpool, post_mgr, filepaths, _, ok = identified
+            changes, deferred, planned = plan_posts(
+                post_mgr, self.cfg, self.tasks["posts"]
+            )
+            return build_plan(
+                varpool,
+                filepaths,
+                self.cfg,
+                changes,
+                deferred,
+                self.fingerprints,
+                ok and planned,
+            )
+
+    def apply(self, plan: Plan) -> VariablePool:
+        """
+        Make the changes of a plan without querying the sources again
+
+        Files that changed since the plan was made are skipped.
+        """
+        with self.tracer.span("apply", "run", files=len(plan["files"])):
+            if plan["fingerprints"].get("posts") != self.fingerprints["posts"]:
+                logger.warning("The config or plugins changed since the plan was made")
+
+            filepaths = unchanged_files(plan)
+            varpool = VariablePool(self.cfg, id_="mediama")
+            varpool.load(plan_pool(plan, filepaths))
+            varpool["filepaths"] = filepaths
+            post_mgr = self.post_mgr.bind(varpool)
+
+            post_ids = {task["id"] for task in self.cfg["posts"]}
+            pool = [row for row in varpool.dump() if row[0] not in post_ids]
+            ok = apply_posts(
+                post_mgr,
+                self.cfg,
+                self.tasks["posts"],
+                plan_changes(plan, filepaths),
+                plan["deferred"],
+            )
+
+            if self.state and ok:
+                record_state(
+                    varpool, self.state, filepaths, self.fingerprints, pool, self.cfg
+                )
+            return varpool
+
+
+def _ask(question: str) -> Optional[int]:
+    """
+    Read an index from the user, or None if the answer is blank
+    """
+    while True:
+        try:
+            answer = input(question).strip()
+        except EOFError:
+            return None
+        if not answer:
+            return None
+        try:
+            return int(answer)
+        except ValueError:
+            print("Please enter a number", file=sys.stderr)
+
+
+def prompt_decisions(engine: Engine):
+    """
+    Ask the user to make the choices parked by the runs of the engine and
+    resume those runs
+
+    The choices are asked together once every file was processed. Skipped
+    choices stay pending.
+    """
+    for decision in engine.decisions.pending():
+        print(
+            f"\nChoose the {decision.kind} of {len(decision.files)} file(s), "
+            f"e.g. {decision.files[0]}:",
+            file=sys.stderr,
+        )
+        if decision.kind == "series":
+            for i, candidate in enumerate(decision.candidates):
+                print(f"  [{i}] {candidate.get('name')}", file=sys.stderr)
+            answer: Any = _ask("Series (blank to skip): ")
+        else:
+            for i, (id_, data) in enumerate(decision.candidates):
+                details = ", ".join(f"{key}={value}" for key, value in data.items())
+                print(f"  [{i}] {id_}: {details}", file=sys.stderr)
+            answer = {}
+            for path in decision.files:
+                index = _ask(f"Episode of {path.name} (blank to skip): ")
+                if index is not None:
+                    answer[path] = index
+        if answer is None or answer == {}:
             continue
+        try:
+            engine.resolve(decision.id, answer)
+        except ValueError as e:
+            logger.error(f"Invalid choice: {e}")
+
+
+def main(filepaths: list, cfg: NormalizedConfig, plan: Union[None, bool, Path] = None):
+    """
+    Process the files, or only plan what processing them would do
+
+    :param plan: write the plan to this path instead of processing the files,
+        or print it if True
+    """
+    # Note that the logger is not yet loaded since it depends on the cfg
+    # Import the config if not given
+    cfg_path = None
+    if not cfg:
+        cfg_path = discover_config()
+        cfg = load_config(cfg_path)
+
+    # Configure the logger
+    configure_logger(cfg)
+    # Log missed functions
+    logger.debug(f"Config path loaded: {cfg_path}")
+    logger.debug(f"Config settings: {cfg}")
+
+    engine = Engine(cfg)
+    try:
+        if not plan:
+            engine.run(filepaths)
+            prompt_decisions(engine)
+            return
+
+        plan_ = engine.plan(filepaths)
+        if engine.decisions:
+            # Resuming would run the postprocess tasks, which a plan must not
+            logger.warning(
+                f"{len(engine.decisions)} choice(s) are left to the user; "
+                "process the files without --plan to make them"
+            )
+        if plan_ is None:
+            if not engine.decisions:
+                logger.info("Every file is unchanged; there is nothing to plan")
+            return
+        save_plan(plan_, None if plan is True else plan)
+    finally:
+        engine.close()
+        engine.save_trace()
+        report = engine.report_profile()
+        if report:
+            print(report, file=sys.stderr)
+
+
+def apply(plan_path: Path, cfg: NormalizedConfig):
+    """
+    Make the changes of a plan written by main
+    """
+    configure_logger(cfg)
+    engine = Engine(cfg)
+    try:
+        engine.apply(load_plan(plan_path))
+    finally:
+        engine.close()
+        engine.save_trace()
+        report = engine.report_profile()
+        if report:
+            print(report, file=sys.stderr)
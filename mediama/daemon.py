@@ -0,0 +1,406 @@
+import os
+import re
+import select
+import signal
+import struct
+import time
+import threading
+import ctypes
+import ctypes.util
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from logging import getLogger
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from .config import ConfigReloader, NormalizedConfig
+from .trace import Metrics, send_metrics
+
+logger = getLogger(__name__)
+
+# inotify(7) event masks
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE_SELF
+EVENT_HEADER = struct.Struct("iIII")
+
+# Seconds between checks of the config file for changes, and the longest wait
+# for file events so that the daemon notices when it is stopped
+RELOAD_INTERVAL = 5
+
+# Episode markers such as S01E02, 1x02, "- 02" or "E02" and anything after them
+EPISODE_RE = re.compile(
+    r"([\s._-]+(s\d+\s*e\d+|\d+x\d+|ep?\s*\d+|-\s*\d+)\b|\s+\d{1,4}$).*$",
+    re.IGNORECASE,
+)
+# Bracketed tags such as release groups, resolutions and checksums
+TAG_RE = re.compile(r"\[[^\]]*\]|\([^)]*\)")
+
+
+def series_key(path: Path) -> str:
+    """
+    Guess a key that groups the files of the same series together
+
+    The key is the normalized file name up to the episode marker. Release
+    groups and other bracketed tags are ignored.
+    """
+    name = TAG_RE.sub(" ", Path(path).stem)
+    name = re.sub(r"[._]+", " ", name).strip()
+    name = EPISODE_RE.sub("", name)
+    return re.sub(r"\W+", " ", name).strip().lower()
+
+
+class Watcher:
+    """
+    Watch folders for new or modified files
+    """
+
+    def __init__(self, paths: Iterable[Path], recursive: bool = True):
+        self.paths = [Path(path) for path in paths]
+        self.recursive = recursive
+
+    def poll(self, timeout: Optional[float]) -> Set[Path]:
+        """
+        Wait up to timeout seconds and return the files that changed
+        """
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def _dirs(self, path: Path) -> Iterable[Path]:
+        yield path
+        if self.recursive:
+            for root, dirs, _ in os.walk(path):
+                for dir_ in dirs:
+                    yield Path(root) / dir_
+
+
+class InotifyWatcher(Watcher):
+    """
+    Watch folders using inotify(7)
+    """
+
+    def __init__(self, paths: Iterable[Path], recursive: bool = True):
+        super().__init__(paths, recursive)
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = (ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32)
+
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+        self.wds: Dict[int, Path] = {}
+        for path in self.paths:
+            for dir_ in self._dirs(path):
+                self.watch(dir_)
+
+    def watch(self, path: Path):
+        wd = self._add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+        if wd < 0:
+            logger.warning(f"Failed to watch {path}: {os.strerror(ctypes.get_errno())}")
+            return
+        self.wds[wd] = path
+
+    def poll(self, timeout: Optional[float]) -> Set[Path]:
+        changed: Set[Path] = set()
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return changed
+
+        try:
+            buf = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return changed
+
+        offset = 0
+        while offset < len(buf):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(buf, offset)
+            offset += EVENT_HEADER.size
+            name = buf[offset : offset + length].rstrip(b"\0")
+            offset += length
+
+            if mask & IN_Q_OVERFLOW:
+                logger.warning("inotify queue overflowed; rescanning watched folders")
+                for path in self.paths:
+                    changed.update(scan(path, self.recursive))
+                continue
+            if mask & IN_IGNORED:
+                self.wds.pop(wd, None)
+                continue
+            if wd not in self.wds or not name:
+                continue
+
+            path = self.wds[wd] / os.fsdecode(name)
+            if mask & IN_ISDIR:
+                # Files may already be in a folder that was moved in
+                if self.recursive and mask & (IN_CREATE | IN_MOVED_TO):
+                    for dir_ in self._dirs(path):
+                        self.watch(dir_)
+                    changed.update(scan(path, self.recursive))
+            else:
+                changed.add(path)
+        return changed
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PollingWatcher(Watcher):
+    """
+    Watch folders by periodically comparing their listings
+
+    This is the fallback on platforms without inotify.
+    """
+
+    def __init__(
+        self, paths: Iterable[Path], recursive: bool = True, interval: float = 5
+    ):
+        super().__init__(paths, recursive)
+        self.interval = interval
+        self._snapshot = self._scan()
+
+    def _scan(self) -> Dict[Path, Tuple[int, int]]:
+        snapshot = {}
+        for path in self.paths:
+            for file in scan(path, self.recursive):
+                try:
+                    st = file.stat()
+                except OSError:
+                    continue
+                snapshot[file] = (st.st_size, st.st_mtime_ns)
+        return snapshot
+
+    def poll(self, timeout: Optional[float]) -> Set[Path]:
+        time.sleep(self.interval if timeout is None else min(timeout, self.interval))
+        snapshot = self._scan()
+        changed = {
+            path for path, stat in snapshot.items() if self._snapshot.get(path) != stat
+        }
+        self._snapshot = snapshot
+        return changed
+
+
+def scan(path: Path, recursive: bool = True) -> Iterable[Path]:
+    """
+    Return the files within the folder
+    """
+    if recursive:
+        return (Path(root) / file for root, _, files in os.walk(path) for file in files)
+    return (file for file in Path(path).iterdir() if file.is_file())
+
+
+def create_watcher(paths: Iterable[Path], recursive: bool = True) -> Watcher:
+    try:
+        return InotifyWatcher(paths, recursive)
+    except (OSError, AttributeError, TypeError) as e:
+        logger.info(f"inotify is unavailable, polling instead: {e}")
+        return PollingWatcher(paths, recursive)
+
+
+class Debouncer:
+    """
+    Hold changed files until they stop changing and batch them by series
+
+    A file is settled once it has not changed for ``debounce`` seconds. A
+    series is released once all of its files are settled, or once its oldest
+    file has waited ``max_wait`` seconds so a busy series cannot starve.
+    """
+
+    def __init__(self, debounce: float = 5, max_wait: float = 60):
+        self.debounce = debounce
+        self.max_wait = max_wait
+        # path -> (first seen, last changed, (size, mtime))
+        self._pending: Dict[Path, Tuple[float, float, Optional[Tuple[int, int]]]] = {}
+
+    def __len__(self):
+        return len(self._pending)
+
+    @staticmethod
+    def _stat(path: Path) -> Optional[Tuple[int, int]]:
+        try:
+            st = path.stat()
+        except OSError:
+            return None
+        return st.st_size, st.st_mtime_ns
+
+    def add(self, path: Path, now: Optional[float] = None):
+        now = time.monotonic() if now is None else now
+        first = self._pending.get(path, (now,))[0]
+        self._pending[path] = (first, now, self._stat(path))
+
+    def _settled(self, path: Path, now: float) -> bool:
+        first, changed, stat = self._pending[path]
+        if now - changed < self.debounce:
+            return False
+        # Writers do not always produce events, so make sure the file is
+        # really done growing before it is released
+        current = self._stat(path)
+        if current != stat:
+            self._pending[path] = (first, now, current)
+            return False
+        return True
+
+    def ready(self, now: Optional[float] = None) -> List[List[Path]]:
+        """
+        Pop the batches of files that are ready to be processed
+        """
+        now = time.monotonic() if now is None else now
+
+        # Files that were deleted before they settled are dropped
+        for path in [path for path in self._pending if not path.exists()]:
+            del self._pending[path]
+
+        groups: Dict[str, List[Path]] = {}
+        for path in self._pending:
+            groups.setdefault(series_key(path), []).append(path)
+
+        batches = []
+        for paths in groups.values():
+            settled = [path for path in paths if self._settled(path, now)]
+            oldest = min(self._pending[path][0] for path in paths)
+            if len(settled) == len(paths) or (
+                settled and now - oldest >= self.max_wait
+            ):
+                for path in settled:
+                    del self._pending[path]
+                batches.append(sorted(settled))
+        return batches
+
+    def timeout(self, now: Optional[float] = None) -> Optional[float]:
+        """
+        Return how long to wait before a pending file could settle
+        """
+        if not self._pending:
+            return None
+        now = time.monotonic() if now is None else now
+        changed = min(changed for _, changed, _ in self._pending.values())
+        return max(changed + self.debounce - now, 0.1)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    server: "MetricsServer"
+
+    def do_GET(self):
+        if self.path == "/metrics":
+            send_metrics(self, self.server.metrics)
+        else:
+            self.send_error(404)
+
+    def log_message(self, format, *args):
+        logger.debug(f"{self.address_string()} {format % args}")
+
+
+class MetricsServer(ThreadingHTTPServer):
+    """
+    Serve ``GET /metrics`` of the daemon from a background thread
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address, metrics: Metrics):
+        super().__init__(address, MetricsHandler)
+        self.metrics = metrics
+        self._thread = threading.Thread(
+            target=self.serve_forever, name="mediama-metrics", daemon=True
+        )
+        self._thread.start()
+
+    def close(self):
+        self.shutdown()
+        self.server_close()
+
+
+def run_daemon(cfg: NormalizedConfig, config_path: Optional[Path] = None):
+    """
+    Watch the configured folders and process files as they arrive
+
+    The engine is set up once so plugins, caches and the run state stay warm
+    between batches. It is set up again whenever the config file at
+    config_path changes.
+    """
+    from .core import Engine, configure_logger
+
+    config = cfg["watch"]  # type: ignore[typeddict-item]
+    paths = [Path(path) for path in config["paths"]]
+    if not paths:
+        raise ValueError("No watch paths are configured")
+    extensions = {ext.lower() for ext in config["extensions"]}
+
+    metrics = None
+    metrics_server = None
+    if config["metrics_port"] is not None:
+        metrics = Metrics()
+        metrics_server = MetricsServer(("127.0.0.1", config["metrics_port"]), metrics)
+        logger.info(f"Serving metrics on port {config['metrics_port']}")
+
+    engine = Engine(cfg, metrics)
+    engine.start_prefetch()
+    reloader = ConfigReloader(config_path, cfg) if config_path else None
+    watcher = create_watcher(paths, config["recursive"])
+    debouncer = Debouncer(config["debounce"], config["max_wait"])
+
+    running = True
+
+    def stop(signum, frame):
+        nonlocal running
+        logger.info("Stopping daemon")
+        running = False
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    logger.info(f"Watching {[str(path) for path in paths]}")
+    try:
+        while running:
+            if reloader:
+                new = reloader.poll()
+                if new:
+                    configure_logger(new)
+                    engine.close()
+                    engine = Engine(new, metrics)
+                    engine.start_prefetch()
+                    if new["watch"] != config:  # type: ignore[typeddict-item]
+                        logger.warning("Restart the daemon to apply watch settings")
+
+            # The wait is always bounded: the signal handlers only clear
+            # running, and select is retried after a signal (PEP 475)
+            timeout = debouncer.timeout()
+            if timeout is None or timeout > RELOAD_INTERVAL:
+                timeout = RELOAD_INTERVAL
+            changed = watcher.poll(timeout)
+            for path in changed:
+                if not extensions or path.suffix.lower() in extensions:
+                    debouncer.add(path)
+
+            for batch in debouncer.ready():
+                logger.info(f"Processing {len(batch)} file(s): {batch}")
+                try:
+                    engine.run(batch)
+                    # Nobody can answer the daemon, so the choices are dropped
+                    # rather than kept for a later run, see the prompt docs
+                    for decision in engine.decisions.drain():
+                        logger.warning(
+                            f"Skipped {len(decision.files)} file(s) whose "
+                            f"{decision.kind} must be chosen by hand, run them "
+                            f"with the CLI or the server to choose: "
+                            f"{[str(file) for file in decision.files]}"
+                        )
+                    engine.save_trace()
+                    report = engine.report_profile()
+                    if report:
+                        logger.info(f"Plugin costs of the batch:\n{report}")
+                except Exception as e:
+                    logger.error(f"Failed to process {batch}: {e}")
+    finally:
+        engine.close()
+        watcher.close()
+        if metrics_server:
+            metrics_server.close()
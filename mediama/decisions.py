@@ -0,0 +1,156 @@
+import time
+import uuid
+import threading
+from collections import OrderedDict
+from logging import getLogger
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+logger = getLogger(__name__)
+
+# (source id, ranking) pairs of every source that found the series
+Rankings = List[Tuple[str, List[Dict[str, Any]]]]
+
+
+class Ambiguous(Exception):
+    """
+    Raised when the series of a batch cannot be chosen automatically and the
+    choice is left to the user
+    """
+
+    def __init__(self, candidates: List[Dict[str, Any]], rankings: Rankings = None):
+        super().__init__(f"{len(candidates)} candidate series")
+        self.candidates = candidates
+        self.rankings = rankings or []
+
+
+class Decision:
+    """
+    A choice parked until the user makes it
+
+    For a series choice, ``candidates`` is the aggregated ranking and the
+    answer is the index of the series. For an episode choice, candidates are
+    (source id, episode) pairs and the answer maps some of the files to the
+    index of their episode.
+
+    ``pool`` holds the rows of the run when it was parked, so that it can
+    resume without running the earlier stages again.
+    """
+
+    def __init__(
+        self,
+        kind: str,
+        files: List[Path],
+        candidates: List[Any],
+        pool: List[Tuple[str, str, Any]],
+        rankings: Optional[Rankings] = None,
+    ):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.files = [Path(file) for file in files]
+        self.candidates = candidates
+        self.pool = pool
+        self.rankings = rankings or []
+        self.created = time.time()
+
+    def check(self, choice: Any) -> Any:
+        """
+        Return the answer normalized, with files as paths
+
+        :raises ValueError: if the answer is not one of the candidates
+        """
+        count = len(self.candidates)
+        if self.kind == "series":
+            if isinstance(choice, bool) or not isinstance(choice, int):
+                raise ValueError("The choice of a series must be an index")
+            if not 0 <= choice < count:
+                raise ValueError(f"The choice must be between 0 and {count - 1}")
+            return choice
+
+        if not isinstance(choice, dict):
+            raise ValueError("The choice of episodes must map files to indexes")
+        answers = {}
+        for file, index in choice.items():
+            path = Path(file)
+            if path not in self.files:
+                raise ValueError(f"{file} is not part of the decision")
+            if isinstance(index, bool) or not isinstance(index, int):
+                raise ValueError(f"The choice of {file} must be an index")
+            if not 0 <= index < count:
+                raise ValueError(
+                    f"The choice of {file} must be between 0 and {count - 1}"
+                )
+            answers[path] = index
+        return answers
+
+    def to_dict(self) -> Dict[str, Any]:
+        if self.kind == "series":
+            candidates = self.candidates
+        else:
+            candidates = [{"source": id_, **data} for id_, data in self.candidates]
+        return {
+            "id": self.id,
+            "kind": self.kind,
+            "files": [str(file) for file in self.files],
+            "candidates": candidates,
+            "created": self.created,
+        }
+
+
+class Decisions:
+    """
+    Decisions parked by the runs of an engine, in the order they were parked
+
+    The decisions outlive the engine, so they are kept when the config is
+    reloaded.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._decisions: "OrderedDict[str, Decision]" = OrderedDict()
+
+    def park(self, decision: Decision) -> Decision:
+        with self._lock:
+            self._decisions[decision.id] = decision
+        logger.info(
+            f"Parked the {decision.kind} choice of {len(decision.files)} file(s) "
+            f"as decision {decision.id}"
+        )
+        return decision
+
+    def pending(self) -> List[Decision]:
+        with self._lock:
+            return list(self._decisions.values())
+
+    def get(self, id_: str) -> Decision:
+        """
+        :raises KeyError: if there is no pending decision with the id
+        """
+        with self._lock:
+            return self._decisions[id_]
+
+    def take(self, id_: str, choice: Any) -> Tuple[Decision, Any]:
+        """
+        Remove a decision to resolve it with the answer
+
+        :raises KeyError: if there is no pending decision with the id
+        :raises ValueError: if the answer is invalid
+        """
+        with self._lock:
+            decision = self._decisions[id_]
+            answer = decision.check(choice)
+            del self._decisions[id_]
+        return decision, answer
+
+    def drain(self) -> List[Decision]:
+        """
+        Remove and return every pending decision
+        """
+        with self._lock:
+            decisions = list(self._decisions.values())
+            self._decisions.clear()
+        return decisions
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._decisions)
@@ -0,0 +1,286 @@
+import json
+import time
+import pickle
+import sqlite3
+import hashlib
+import threading
+from datetime import datetime, timezone
+from logging import getLogger
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+from .utils import dirs
+
+logger = getLogger(__name__)
+
+# Keys of the air date of an episode, as a timestamp or an ISO 8601 date
+AIR_DATE_KEYS = ("air_date", "airdate", "aired", "first_aired")
+
+
+class EpisodeDelta(NamedTuple):
+    """
+    What ``Source.fetch_episodes_delta`` returns
+
+    ``episodes`` are the episodes added or changed since the validator the
+    source was given, or every episode if ``full`` is set. An episode with
+    ``"deleted": true`` is removed. ``validator`` is passed to the next call,
+    e.g. the ETag or Last-Modified date of the response, or the time of the
+    fetch for providers that take "episodes since" queries.
+    """
+
+    episodes: List[Dict[str, Any]]
+    validator: Any
+    full: bool = False
+
+
+def episode_key(episode: Dict[str, Any]) -> Tuple:
+    """
+    Return what identifies an episode across fetches: its id if it has one,
+    or else its season and number
+    """
+    if "id" in episode:
+        return ("id", episode["id"])
+    return ("episode", episode.get("season"), episode.get("episode"))
+
+
+def air_time(episode: Dict[str, Any]) -> Optional[float]:
+    """
+    Return the timestamp of the air date of an episode, or None if it has no
+    valid air date
+
+    Dates without a time zone are taken as UTC.
+    """
+    for key in AIR_DATE_KEYS:
+        value = episode.get(key)
+        if value is None:
+            continue
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            return float(value)
+        try:
+            date = datetime.fromisoformat(str(value))
+        except ValueError:
+            return None
+        if date.tzinfo is None:
+            date = date.replace(tzinfo=timezone.utc)
+        return date.timestamp()
+    return None
+
+
+def merge_episodes(
+    episodes: List[Dict[str, Any]], delta: Iterable[Dict[str, Any]]
+) -> List[Dict[str, Any]]:
+    """
+    Return the episodes updated with a delta, keeping their order and adding
+    new episodes at the end
+    """
+    merged = {episode_key(episode): episode for episode in episodes}
+    for episode in delta:
+        key = episode_key(episode)
+        if episode.get("deleted"):
+            merged.pop(key, None)
+        else:
+            merged[key] = {**merged.get(key, {}), **episode}
+    return list(merged.values())
+
+
+def _hash(data: Any) -> str:
+    dumped = json.dumps(data, sort_keys=True, default=str)
+    return hashlib.sha1(dumped.encode()).hexdigest()
+
+
+class EpisodeCache:
+    """
+    Persistent episode lists of the sources that fetch deltas
+
+    The list of each series of a source is kept with the validator of its
+    last fetch. Lists checked less than ``refresh`` seconds ago are used as
+    they are; older lists are revalidated and merged with the episodes that
+    changed since, so refreshing an airing series only fetches its new
+    episodes.
+    """
+
+    def __init__(self, path: Path, refresh: Optional[float] = 24 * 60 * 60):
+        self.path = path
+        self.refresh = refresh
+        # The store is shared by the jobs of the server, which run in threads
+        self.conn = sqlite3.connect(str(path), check_same_thread=False)
+        self._lock = threading.Lock()
+
+        c = self.conn.cursor()
+        c.execute(
+            """
+            CREATE TABLE IF NOT EXISTS episodes (
+                source TEXT NOT NULL,
+                series TEXT NOT NULL,
+                settings TEXT NOT NULL,
+                episodes BLOB NOT NULL,
+                validator BLOB NOT NULL,
+                checked REAL NOT NULL,
+
+                PRIMARY KEY(source, series))
+            """
+        )
+        # The series with episodes yet to air, with the pool their list was
+        # fetched with, so it can be fetched again before the next one airs
+        c.execute(
+            """
+            CREATE TABLE IF NOT EXISTS airing (
+                source TEXT NOT NULL,
+                series TEXT NOT NULL,
+                pool BLOB NOT NULL,
+                next_air REAL NOT NULL,
+                prefetched REAL,
+
+                PRIMARY KEY(source, series))
+            """
+        )
+        c.execute("CREATE INDEX IF NOT EXISTS airing_next_air ON airing (next_air)")
+        self.conn.commit()
+
+    @classmethod
+    def from_config(cls, cfg: Dict[str, Any]) -> Optional["EpisodeCache"]:
+        """
+        Open the store configured by ``cfg["episodes"]`` or None if it is
+        disabled
+        """
+        config = cfg.get("episodes")
+        if not config:
+            return None
+
+        path = Path(config.get("path") or "episodes.db")
+        if not path.is_absolute():
+            path = Path(dirs.user_data_dir) / path
+        path.parent.mkdir(parents=True, exist_ok=True)
+        return cls(path, config.get("refresh", 24 * 60 * 60))
+
+    @staticmethod
+    def series(rows: Iterable[Tuple[Any, ...]], id_: str) -> str:
+        """
+        Return the key of the series a source chose, from the rows of the pool
+        """
+        return _hash(
+            sorted(
+                (key, value)
+                for row_id, key, value, *file in rows
+                if row_id == id_ and not file
+            )
+        )
+
+    def get(
+        self, id_: str, series: str, kwargs: Dict[str, Any]
+    ) -> Optional[Tuple[List[Dict[str, Any]], Any, float]]:
+        """
+        Return the episodes, validator and time of the last check of a series,
+        or None if it is not stored for these settings
+        """
+        with self._lock:
+            c = self.conn.cursor()
+            c.execute(
+                """
+                SELECT
+                    settings, episodes, validator, checked
+                FROM
+                    episodes
+                WHERE
+                    source = ? AND series = ?
+                """,
+                (id_, series),
+            )
+            row = c.fetchone()
+        if row is None or row[0] != _hash(kwargs):
+            return None
+        return pickle.loads(row[1]), pickle.loads(row[2]), row[3]
+
+    def fresh(self, checked: float) -> bool:
+        return self.refresh is not None and time.time() - checked < self.refresh
+
+    def put(
+        self,
+        id_: str,
+        series: str,
+        kwargs: Dict[str, Any],
+        episodes: List[Dict[str, Any]],
+        validator: Any,
+        pool: Optional[List[Tuple[str, str, Any]]] = None,
+    ):
+        """
+        :param pool: the rows of the pool the list was fetched with, kept if
+            an episode is yet to air
+        """
+        now = time.time()
+        upcoming = [
+            air for air in map(air_time, episodes) if air is not None and air > now
+        ]
+        with self._lock:
+            self.conn.execute(
+                """
+                INSERT OR REPLACE INTO episodes
+                    (source, series, settings, episodes, validator, checked)
+                VALUES (?,?,?,?,?,?)
+                """,
+                (
+                    id_,
+                    series,
+                    _hash(kwargs),
+                    pickle.dumps(episodes),
+                    pickle.dumps(validator),
+                    now,
+                ),
+            )
+            if pool is not None and upcoming:
+                self.conn.execute(
+                    """
+                    INSERT INTO airing (source, series, pool, next_air)
+                    VALUES (?,?,?,?)
+                    ON CONFLICT(source, series) DO UPDATE SET
+                        pool = excluded.pool, next_air = excluded.next_air
+                    """,
+                    (id_, series, pickle.dumps(pool), min(upcoming)),
+                )
+            elif pool is not None:
+                self.conn.execute(
+                    "DELETE FROM airing WHERE source = ? AND series = ?",
+                    (id_, series),
+                )
+            self.conn.commit()
+
+    def due(
+        self, lead: float, now: Optional[float] = None
+    ) -> List[Tuple[str, str, List[Tuple[str, str, Any]], float]]:
+        """
+        Return the source id, series key, pool rows and air time of the series
+        whose next episode airs within ``lead`` seconds and that were not
+        prefetched for it yet
+        """
+        now = time.time() if now is None else now
+        with self._lock:
+            c = self.conn.cursor()
+            c.execute(
+                """
+                SELECT
+                    source, series, pool, next_air
+                FROM
+                    airing
+                WHERE
+                    next_air > ? AND next_air <= ?
+                    AND (prefetched IS NULL OR prefetched < next_air)
+                ORDER BY
+                    next_air
+                """,
+                (now, now + lead),
+            )
+            rows = c.fetchall()
+        return [
+            (id_, series, pickle.loads(pool), air) for id_, series, pool, air in rows
+        ]
+
+    def prefetched(self, id_: str, series: str, air: float):
+        """
+        Mark a series as prefetched for the episode that airs at ``air``
+        """
+        with self._lock:
+            self.conn.execute(
+                "UPDATE airing SET prefetched = ? WHERE source = ? AND series = ?",
+                (air, id_, series),
+            )
+            self.conn.commit()
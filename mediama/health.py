@@ -0,0 +1,345 @@
+import time
+import threading
+from collections import deque
+from logging import getLogger
+from typing import Any, Callable, Deque, Dict, Iterator, Optional
+
+from .utils import wait_event
+
+logger = getLogger(__name__)
+
+# Weight of the latest call in the moving average of the latency
+SMOOTHING = 0.2
+
+
+class CircuitOpen(Exception):
+    """
+    Raised instead of calling a source whose circuit breaker is open
+    """
+
+
+class Breaker:
+    """
+    Circuit breaker of a source
+
+    The breaker opens after ``failures`` failures in a row, and calls are
+    short-circuited for ``cooldown`` seconds. Then a single trial call is let
+    through: the breaker closes if it succeeds and opens again if it fails.
+    """
+
+    def __init__(self, failures: int = 5, cooldown: float = 60):
+        self.failures = failures
+        self.cooldown = cooldown
+        self.state = "closed"
+        self.count = 0
+        self.opened = 0.0
+        self.trial = False
+
+    def allow(self, now: float) -> bool:
+        if self.state == "open" and now - self.opened >= self.cooldown:
+            self.state = "half_open"
+            self.trial = False
+        if self.state == "closed":
+            return True
+        if self.state == "half_open" and not self.trial:
+            self.trial = True
+            return True
+        return False
+
+    def success(self):
+        self.state = "closed"
+        self.count = 0
+        self.trial = False
+
+    def failure(self, now: float):
+        self.count += 1
+        self.trial = False
+        if self.state == "half_open" or self.count >= self.failures:
+            self.state = "open"
+            self.opened = now
+
+
+class Limiter:
+    """
+    Limit of the calls of a source that may run at once, adjusted by additive
+    increase and multiplicative decrease
+
+    The limit grows by one after a call that succeeds within the ``latency``
+    target, if any, and is multiplied by ``backoff`` after a call that fails,
+    times out or is slower than the target.
+    """
+
+    def __init__(
+        self,
+        initial: int = 4,
+        minimum: int = 1,
+        maximum: int = 32,
+        latency: Optional[float] = None,
+        backoff: float = 0.5,
+    ):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.latency = latency
+        self.backoff = backoff
+        self.inflight = 0
+        self._waiters: Deque[threading.Event] = deque()
+
+    def adjust(self, ok: bool, latency: Optional[float] = None):
+        if ok and (self.latency is None or latency is None or latency <= self.latency):
+            self.limit = min(self.limit + 1, self.maximum)
+        else:
+            self.limit = max(self.limit * self.backoff, self.minimum)
+
+    def wake(self):
+        # Slots are handed to the waiters in the order they came
+        while self._waiters and self.inflight < int(self.limit):
+            self.inflight += 1
+            self._waiters.popleft().set()
+
+
+class Health:
+    """
+    Flow control and health of each source
+
+    The calls of each source go through its circuit breaker and its adaptive
+    concurrency limit; calls over the limit wait for a slot. Stats of every
+    source are kept for the server and the metrics.
+
+    :param failures: failures in a row that open the breaker of a source
+    :param cooldown: seconds calls are short-circuited once it opens
+    """
+
+    def __init__(
+        self,
+        failures: int = 5,
+        cooldown: float = 60,
+        initial: int = 4,
+        maximum: int = 32,
+        latency: Optional[float] = None,
+        backoff: float = 0.5,
+    ):
+        self.failures = failures
+        self.cooldown = cooldown
+        self.initial = initial
+        self.maximum = maximum
+        self.latency = latency
+        self.backoff = backoff
+        self._lock = threading.Lock()
+        self._breakers: Dict[str, Breaker] = {}
+        self._limiters: Dict[str, Limiter] = {}
+        self._stats: Dict[str, Dict[str, Any]] = {}
+
+    @classmethod
+    def from_config(cls, config: Dict[str, Any]) -> Optional["Health"]:
+        """
+        Return the flow control of the health settings, or None if disabled
+        """
+        if not config["enabled"]:
+            return None
+        return cls(
+            config["failures"],
+            config["cooldown"],
+            config["initial"],
+            config["maximum"],
+            config["latency"],
+            config["backoff"],
+        )
+
+    def _source(self, id_: str):
+        # Must be called with the lock held
+        if id_ not in self._breakers:
+            self._breakers[id_] = Breaker(self.failures, self.cooldown)
+            self._limiters[id_] = Limiter(
+                self.initial, 1, self.maximum, self.latency, self.backoff
+            )
+            self._stats[id_] = {
+                "calls": 0,
+                "errors": 0,
+                "timeouts": 0,
+                "rejected": 0,
+                "latency": None,
+            }
+        return self._breakers[id_], self._limiters[id_], self._stats[id_]
+
+    def _acquire(self, id_: str, timeout: Optional[float]):
+        """
+        :raises CircuitOpen: if the breaker of the source is open
+        :raises TimeoutError: if no slot was free within the timeout
+        """
+        with self._lock:
+            breaker, limiter, stats = self._source(id_)
+            if not breaker.allow(time.monotonic()):
+                stats["rejected"] += 1
+                raise CircuitOpen(
+                    f"{id_} failed {breaker.count} times in a row and is skipped "
+                    f"for up to {self.cooldown}s"
+                )
+            if limiter.inflight < int(limiter.limit):
+                limiter.inflight += 1
+                return
+            event = threading.Event()
+            limiter._waiters.append(event)
+        try:
+            if wait_event(event, timeout):
+                return
+        except BaseException:
+            # The caller was cancelled while it waited, so it gives its slot
+            # back if it was already handed one
+            with self._lock:
+                if event.is_set():
+                    limiter.inflight -= 1
+                    limiter.wake()
+                else:
+                    limiter._waiters.remove(event)
+                breaker.trial = False
+            raise
+        with self._lock:
+            if event.is_set():
+                # The slot was handed over just as the wait timed out
+                return
+            limiter._waiters.remove(event)
+            breaker.trial = False
+            stats["timeouts"] += 1
+        raise TimeoutError(f"No call slot of {id_} was free within {timeout}s")
+
+    def _release(self, id_: str, ok: Optional[bool], latency: Optional[float]):
+        """
+        :param ok: whether the call succeeded, or None if it was cancelled
+        """
+        with self._lock:
+            breaker, limiter, stats = self._source(id_)
+            limiter.inflight -= 1
+            if ok is None:
+                breaker.trial = False
+            else:
+                stats["calls"] += 1
+                if ok:
+                    breaker.success()
+                else:
+                    stats["errors"] += 1
+                    self._fail(id_, breaker)
+                limiter.adjust(ok, latency)
+                if latency is not None:
+                    average = stats["latency"]
+                    stats["latency"] = (
+                        latency
+                        if average is None
+                        else average + SMOOTHING * (latency - average)
+                    )
+            limiter.wake()
+
+    def _fail(self, id_: str, breaker: Breaker):
+        was_open = breaker.state == "open"
+        breaker.failure(time.monotonic())
+        if breaker.state == "open" and not was_open:
+            logger.warning(f"Skipping {id_} for {self.cooldown}s after it failed")
+
+    def timed_out(self, id_: str):
+        """
+        Count a call of the source that outlived the timeout of the run
+        """
+        with self._lock:
+            breaker, limiter, stats = self._source(id_)
+            stats["timeouts"] += 1
+            self._fail(id_, breaker)
+            limiter.adjust(False)
+
+    def call(self, id_: str, func: Callable[[], Any], timeout: Optional[float]) -> Any:
+        """
+        Call a lookup of the source, along with the pages it yields if it
+        returns a generator, which hold the slot of the call until they end
+
+        :raises CircuitOpen: if the breaker of the source is open
+        :raises TimeoutError: if no slot was free within the timeout
+        """
+        self._acquire(id_, timeout)
+        start = time.perf_counter()
+        ok: Optional[bool] = None
+        try:
+            result = func()
+            ok = True
+        except Exception:
+            ok = False
+            raise
+        finally:
+            if ok is not True:
+                self._release(id_, ok, time.perf_counter() - start)
+        if isinstance(result, Iterator):
+            return Stream(self, id_, result, start)
+        self._release(id_, True, time.perf_counter() - start)
+        return result
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        """
+        Return the breaker state, limit and counters of each source
+        """
+        now = time.monotonic()
+        with self._lock:
+            stats = {}
+            for id_, breaker in self._breakers.items():
+                limiter = self._limiters[id_]
+                state = breaker.state
+                if state == "open" and now - breaker.opened >= self.cooldown:
+                    state = "half_open"
+                stats[id_] = {
+                    "state": state,
+                    "limit": int(limiter.limit),
+                    "inflight": limiter.inflight,
+                    **self._stats[id_],
+                }
+            return stats
+
+
+class Stream:
+    """
+    The pages of a call, which hold its slot until they end or are closed
+
+    The latency of a stream is the time to its first page. A stream closed
+    early, e.g. once every file matched, neither succeeded nor failed.
+    """
+
+    def __init__(self, health: Health, id_: str, pages: Iterator, start: float):
+        self.health = health
+        self.id = id_
+        self.pages = pages
+        self.start = start
+        self.latency: Optional[float] = None
+        self.done = False
+
+    def __iter__(self) -> "Stream":
+        return self
+
+    def __next__(self) -> Any:
+        if self.done:
+            raise StopIteration
+        try:
+            page = next(self.pages)
+        except StopIteration:
+            self._end(True)
+            raise
+        except Exception:
+            self._end(False)
+            raise
+        if self.latency is None:
+            self.latency = time.perf_counter() - self.start
+        return page
+
+    def _end(self, ok: Optional[bool]):
+        if self.done:
+            return
+        self.done = True
+        latency = self.latency or time.perf_counter() - self.start
+        self.health._release(self.id, ok, latency)
+        close = getattr(self.pages, "close", None)
+        if close:
+            close()
+
+    def close(self):
+        self._end(None)
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception as e:
+            logger.debug(f"Failed to close the pages of {self.id}: {e}")
@@ -0,0 +1,400 @@
+import os
+import sys
+import pickle
+import threading
+from functools import partial
+from logging import getLogger
+from typing import Any, Dict, List, Optional, Tuple, Type
+
+logger = getLogger(__name__)
+
+# Messages are pickled with the most compact protocol of the interpreter,
+# which parent and workers share
+PROTOCOL = pickle.HIGHEST_PROTOCOL
+_MISSING = object()
+
+
+def _peak_memory() -> int:
+    """
+    Return the peak resident memory of the current process in bytes
+    """
+    try:
+        import resource
+    except ImportError:
+        return 0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def _send(conn: Any, message: Tuple):
+    conn.send_bytes(pickle.dumps(message, PROTOCOL))
+
+
+def _error(e: BaseException) -> BaseException:
+    # Plugin exceptions may not survive pickling, in which case only their
+    # message is sent
+    try:
+        pickle.loads(pickle.dumps(e, PROTOCOL))
+        return e
+    except Exception:
+        return RuntimeError(f"{type(e).__name__}: {e}")
+
+
+def _serve(conn: Any, cfg: Dict[str, Any]):
+    """
+    Main loop of a worker: discover the tasks once, then run the calls sent by
+    the parent until told to stop
+    """
+    import logging.config
+
+    from .managers import PreProcessManager, SourceManager, PostProcessManager
+    from .metadata import VariablePool
+    from .utils import iter_pages
+
+    try:
+        logging.config.dictConfig(cfg["log"])
+    except Exception:
+        pass
+    try:
+        tasks = {
+            mgr.stage: mgr(cfg, None).discover_tasks()
+            for mgr in (PreProcessManager, SourceManager, PostProcessManager)
+        }
+    except Exception as e:
+        _send(conn, ("error", _error(e), [], _peak_memory()))
+        return
+    _send(conn, ("ready", os.getpid()))
+    cache = False
+
+    while True:
+        try:
+            message = pickle.loads(conn.recv_bytes())
+        except (EOFError, OSError):
+            return
+        if message[0] == "stop":
+            return
+        _, stage, name, method, rows, kwargs = message
+        if stage == "sources" and not cache:
+            from .core import configure_requests_cache
+
+            configure_requests_cache(cfg)
+            cache = True
+
+        pool = VariablePool(cfg, id_="mediama")
+        pool.load(rows)
+        before = {(id_, key, *file): value for id_, key, value, *file in rows}
+
+        def changes() -> List[Tuple[Any, ...]]:
+            return [
+                row
+                for row in pool.dump()
+                if before.get((*row[:2], *row[3:]), _MISSING) != row[2]
+            ]
+
+        try:
+            result = getattr(tasks[stage][name](pool), method)(**kwargs)
+            if hasattr(result, "__next__") or hasattr(result, "__aiter__"):
+                # Pages are sent one at a time as the parent asks for them, so
+                # the parent can stop a source early without losing the worker
+                _send(conn, ("pages",))
+                pages = iter_pages(result)
+                while pickle.loads(conn.recv_bytes())[0] == "next":
+                    page = next(pages, None)
+                    if page is None:
+                        break
+                    _send(conn, ("page", page))
+                else:
+                    pages.close()
+                result = None
+        except Exception as e:
+            _send(conn, ("error", _error(e), changes(), _peak_memory()))
+        else:
+            _send(conn, ("result", result, changes(), _peak_memory()))
+
+
+def _wait(conn: Any):
+    # Sources run in greenlets, which must not block the others while their
+    # worker is busy
+    if "gevent" in sys.modules:
+        from gevent.socket import wait_read
+
+        wait_read(conn.fileno())
+
+
+class Worker:
+    """
+    A worker subprocess and the pipe to it
+    """
+
+    def __init__(self, context: Any, cfg: Dict[str, Any]):
+        self.conn, child = context.Pipe()
+        self.process = context.Process(
+            target=_serve, args=(child, cfg), name="mediama-plugins", daemon=True
+        )
+        self.process.start()
+        child.close()
+        self.ready = False
+        self.tasks = 0
+        self.memory = 0
+
+    def send(self, message: Tuple):
+        _send(self.conn, message)
+
+    def recv(self) -> Tuple:
+        """
+        :raises RuntimeError: if the worker died
+        """
+        try:
+            _wait(self.conn)
+            data = self.conn.recv_bytes()
+        except (EOFError, OSError):
+            self.process.join(1)
+            raise RuntimeError(
+                f"Worker {self.process.pid} exited with code {self.process.exitcode}"
+            )
+        return pickle.loads(data)
+
+    def start(self):
+        """
+        Wait until the worker has imported its plugins
+        """
+        if self.ready:
+            return
+        reply = self.recv()
+        if reply[0] == "error":
+            raise reply[1]
+        self.ready = True
+
+    def stop(self):
+        try:
+            self.send(("stop",))
+        except OSError:
+            pass
+        self.process.join(1)
+        self.kill()
+
+    def kill(self):
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join()
+        self.conn.close()
+
+
+class WorkerPool:
+    """
+    Long-lived subprocesses that run the tasks of plugins
+
+    Each worker imports the plugins once when it starts, then runs one call
+    at a time. The pool of the run is sent with each call and the values the
+    task writes are sent back, so tasks behave as if they ran in the parent.
+    A worker that crashes only fails the call it was running. Workers are
+    replaced after ``max_tasks`` calls or once their peak memory exceeds
+    ``max_memory`` MB.
+
+    ``workers`` are kept warm; when they are all busy, e.g. while sources run
+    concurrently, extra workers are started and stopped once idle.
+
+    :param builtins: also isolate the tasks that ship with mediama
+    """
+
+    def __init__(
+        self,
+        cfg: Dict[str, Any],
+        workers: int = 2,
+        max_tasks: Optional[int] = None,
+        max_memory: Optional[float] = None,
+        builtins: bool = False,
+        start_method: str = "spawn",
+    ):
+        import multiprocessing
+
+        self.cfg = cfg
+        self.workers = workers
+        self.max_tasks = max_tasks
+        self.max_memory = max_memory
+        self.builtins = builtins
+        # Workers are spawned rather than forked, since forking a process
+        # that runs gevent and threads is unsafe
+        self._context = multiprocessing.get_context(start_method)
+        self._lock = threading.Lock()
+        self._idle: List[Worker] = []
+        self._closed = False
+        self.recycled = 0
+
+    @classmethod
+    def from_config(cls, cfg: Dict[str, Any]) -> Optional["WorkerPool"]:
+        """
+        Return the pool of the isolation settings, or None if disabled
+        """
+        config = cfg["isolation"]
+        if not config["enabled"]:
+            return None
+        return cls(
+            cfg,
+            config["workers"],
+            config["max_tasks"],
+            config["max_memory"],
+            config["builtins"],
+        )
+
+    def start(self):
+        """
+        Start the warm workers without waiting for them to import the plugins
+        """
+        with self._lock:
+            while len(self._idle) < self.workers:
+                self._idle.append(Worker(self._context, self.cfg))
+
+    def close(self):
+        """
+        Stop the idle workers
+
+        Calls that are running or made later, e.g. by the jobs of an engine
+        that was replaced, still run but their workers are not kept.
+        """
+        with self._lock:
+            self._closed = True
+            idle, self._idle = self._idle, []
+        for worker in idle:
+            worker.stop()
+
+    def isolates(self, task: Type) -> bool:
+        return self.builtins or not task.__module__.startswith("mediama.")
+
+    def task(self, stage: str, name: str, metadata: Any) -> "RemoteTask":
+        return RemoteTask(self, stage, name, metadata)
+
+    def _acquire(self) -> Worker:
+        with self._lock:
+            worker = self._idle.pop() if self._idle else None
+        if worker is None:
+            worker = Worker(self._context, self.cfg)
+        try:
+            worker.start()
+        except BaseException:
+            worker.kill()
+            raise
+        return worker
+
+    def _release(self, worker: Worker):
+        recycle = (self.max_tasks and worker.tasks >= self.max_tasks) or (
+            self.max_memory and worker.memory > self.max_memory * 2**20
+        )
+        if recycle:
+            logger.debug(
+                f"Recycling worker {worker.process.pid} after {worker.tasks} tasks "
+                f"and {worker.memory / 2 ** 20:.0f} MB"
+            )
+            self.recycled += 1
+        with self._lock:
+            keep = not recycle and not self._closed and len(self._idle) < self.workers
+            if keep:
+                self._idle.append(worker)
+        if not keep:
+            worker.stop()
+        if recycle:
+            # Replace the worker now so the next call finds it warm
+            with self._lock:
+                if not self._closed and len(self._idle) < self.workers:
+                    self._idle.append(Worker(self._context, self.cfg))
+
+    def _finish(self, worker: Worker, metadata: Any, reply: Tuple) -> Any:
+        """
+        Write back the pool changes of a call and return its result
+        """
+        kind, value, changes, memory = reply
+        worker.tasks += 1
+        worker.memory = memory
+        self._release(worker)
+        if changes:
+            metadata.load(changes)
+        if kind == "error":
+            raise value
+        return value
+
+    def call(
+        self, stage: str, name: str, method: str, metadata: Any, **kwargs: Any
+    ) -> Any:
+        """
+        Call a task method in a worker
+
+        Tasks that produce pages return a generator that holds the worker
+        until it is exhausted or closed.
+
+        :raises RuntimeError: if the worker died during the call
+        """
+        worker = self._acquire()
+        try:
+            worker.send(("call", stage, name, method, metadata.dump(), kwargs))
+            reply = worker.recv()
+        except BaseException:
+            worker.kill()
+            raise
+        if reply[0] == "pages":
+            return Pages(self, worker, metadata)
+        return self._finish(worker, metadata, reply)
+
+
+class Pages:
+    """
+    The pages of a task streamed from its worker, which is held until the
+    pages are exhausted or closed
+    """
+
+    def __init__(self, workers: WorkerPool, worker: Worker, metadata: Any):
+        self.workers = workers
+        self.worker: Optional[Worker] = worker
+        self.metadata = metadata
+
+    def __iter__(self) -> "Pages":
+        return self
+
+    def _request(self, message: Tuple) -> Tuple:
+        worker = self.worker
+        assert worker is not None
+        try:
+            worker.send(message)
+            reply = worker.recv()
+        except BaseException:
+            self.worker = None
+            worker.kill()
+            raise
+        if reply[0] != "page":
+            self.worker = None
+            self.workers._finish(worker, self.metadata, reply)
+        return reply
+
+    def __next__(self) -> Any:
+        if self.worker is not None:
+            reply = self._request(("next",))
+            if reply[0] == "page":
+                return reply[1]
+        raise StopIteration
+
+    def close(self):
+        if self.worker is not None:
+            self._request(("close",))
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception as e:
+            logger.debug(f"Failed to close the pages of a worker: {e}")
+
+
+class RemoteTask:
+    """
+    Stands in for a task of a plugin that runs in a worker
+    """
+
+    def __init__(self, workers: WorkerPool, stage: str, name: str, metadata: Any):
+        self.workers = workers
+        self.stage = stage
+        self.name = name
+        self.metadata = metadata
+
+    def __getattr__(self, method: str) -> Any:
+        if method.startswith("_"):
+            raise AttributeError(method)
+        return partial(self.workers.call, self.stage, self.name, method, self.metadata)
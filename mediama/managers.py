@@ -1,5 +1,24 @@
-from typing import Set, List, Dict, Any, Type, TypedDict, Optional, Tuple, Iterable
+from typing import (
+    Set,
+    List,
+    Dict,
+    Any,
+    Type,
+    TypedDict,
+    Optional,
+    Tuple,
+    Iterable,
+    AsyncIterable,
+    Union,
+    Callable,
+    Generator,
+    Iterator,
+)
+import re
 import copy
+import time
+import threading
+from functools import partial
 from logging import getLogger
 from pathlib import Path
 
@@ -12,15 +31,44 @@ from .utils import (
     rank_aggregation,
     merge_ranking_metadata,
     normalize_ranking,
+    iter_pages,
+    import_package_modules,
 )
 from .metadata import VariablePool, SourceMetadata, Metadata
 from .config import NormalizedTaskSettings, NormalizedConfig
+from .trace import Tracer
+from .profiling import Profiler
+from .isolation import WorkerPool
+from .coalesce import Loader
+from .health import Health
+from .episodes import EpisodeCache, EpisodeDelta, merge_episodes
+from .memory import SeriesMemory
+from .misses import MissCache
 
 logger = getLogger(__name__)
 
+# Episodes kept per file as the candidates of a choice left to the user
+CANDIDATES_PER_FILE = 10
+NUMBERS = re.compile(r"\d+")
+
+
+def near_files(episode: Metadata, numbers: Set[int]) -> bool:
+    """
+    Return whether the number of an episode is next to one of the numbers in
+    the names of the files, or is unknown
+    """
+    number = episode.get("episode")
+    if not numbers or not isinstance(number, int):
+        return True
+    return any(abs(number - n) <= 1 for n in numbers)
+
+
+Page = List[SourceMetadata]
+
 
 class Task:
-    pass
+    def __init__(self, metadata: VariablePool):
+        self.metadata = metadata
 
 
 class Process(Task):
@@ -33,19 +81,112 @@ class PreProcess(Process):
 
 
 class PostProcess(Process):
-    pass
+    # Whether main changes anything outside of the pool, such as files. Tasks
+    # with side effects are only planned, not run, when making a plan
+    side_effects = True
+
+    def plan(self, **kwargs: Any) -> Optional[Dict[Path, Any]]:
+        """
+        Return the change that main would make to each file without making it,
+        or None if the task cannot be planned
+        """
+        return None
+
+    def apply(self, changes: Dict[Path, Any], **kwargs: Any) -> Metadata:
+        """
+        Make the planned changes, which may have been edited since planning
+
+        The changes are plain JSON values as written to the plan.
+        """
+        return self.main(**kwargs)
 
 
 class Source(Task):
+    # What the provider covers: the "kinds" of media, e.g. "tv", "anime" or
+    # "movie", the "languages" as ISO 639 codes, the "ids" schemes it can look
+    # up, e.g. "tvdb", and the "lookups" it supports. A source is only asked
+    # about files whose features match; capabilities that are left out do not
+    # restrict it. The lookups default to the methods the source implements.
+    capabilities: Dict[str, Iterable[str]] = {}
+
     def fetch_series(self, **kwargs: Any) -> List[SourceMetadata]:
         raise NotImplementedError
 
-    def fetch_episodes(self, **kwargs: Any) -> List[SourceMetadata]:
+    def fetch_episodes(
+        self, **kwargs: Any
+    ) -> Union[List[SourceMetadata], Iterable[Page], AsyncIterable[Page]]:
+        """
+        Return the episode metadata of the series
+
+        Providers that paginate their episode lists may yield each page from a
+        generator or an async generator instead of returning a single list.
+        Pages are consumed as they arrive, so files can be matched before the
+        last page has been fetched.
+        """
+        raise NotImplementedError
+
+    def fetch_episodes_delta(
+        self, validator: Any = None, **kwargs: Any
+    ) -> EpisodeDelta:
+        """
+        Return the episodes of the series that changed since an earlier fetch
+
+        Sources that implement this have their episode lists cached and
+        refreshed with deltas instead of fetched whole. ``validator`` is the
+        one returned by the earlier fetch, or None for the first fetch, which
+        returns every episode.
+        """
         raise NotImplementedError
 
+    def fetch_series_many(
+        self, pools: List[VariablePool], **kwargs: Any
+    ) -> List[List[SourceMetadata]]:
+        """
+        Return the series ranking of the files of each pool, in the same order
+
+        Providers with batch endpoints may implement this to search the series
+        of concurrent runs in one request. It is called on a task without a
+        pool, with copies of the pools of the runs. A result may be an
+        exception, which only fails its run.
+        """
+        raise NotImplementedError
+
+    def fetch_episodes_many(
+        self, pools: List[VariablePool], **kwargs: Any
+    ) -> List[Union[List[SourceMetadata], Iterable[Page]]]:
+        """
+        Return the episode metadata of the series of each pool, in the same
+        order, see fetch_series_many
+        """
+        raise NotImplementedError
+
+
+# The methods of Source that implement each lookup
+LOOKUPS = {
+    "fetch_series": ("fetch_series", "fetch_series_many"),
+    "fetch_episodes": ("fetch_episodes", "fetch_episodes_many", "fetch_episodes_delta"),
+}
+
+
+def implements(task: Type[Task], name: str) -> bool:
+    """
+    Return whether a source overrides one of the methods of Source
+    """
+    return getattr(task, name, None) is not getattr(Source, name, None)
+
 
 class BaseTaskManager:
     _tasks: Optional[Dict[str, Type[Task]]] = None
+    # Package of the tasks that ship with mediama
+    builtin_package: Optional[str] = None
+    # Stage the tasks run in, used to label their spans
+    stage: Optional[str] = None
+    # Replaced by the engine with the tracer of its runs
+    tracer = Tracer()
+    # Set by the engine if plugins are profiled or have budgets
+    profiler: Optional[Profiler] = None
+    # Set by the engine if plugins run in worker processes
+    workers: Optional[WorkerPool] = None
 
     def __init__(
         self, cfg: NormalizedConfig, metadata: VariablePool,
@@ -54,7 +195,7 @@ class BaseTaskManager:
 
         # plugin search directory from lowest priority to highest
         # if no search dirlist is provided use the default
-        self.search_dirs = cfg["search_dirs"] or [Path(d) / "plugins" for d in (dirs.site_data_dir, dirs.user_data_dir)]  # type: ignore[has-type]
+        self.search_dirs = [Path(d) for d in cfg["search_dirs"]] or [Path(d) / "plugins" for d in (dirs.site_data_dir, dirs.user_data_dir)]  # type: ignore[has-type]
 
     def discover_tasks(self):
         """
@@ -82,8 +223,14 @@ class BaseTaskManager:
         except Exception as e:
             logger.critical("Failed to discover modules")
             raise e
-        # We found modules, so load them and scan for any tasks within them
+        # Built-in tasks are added first so that plugins can override them
         self._tasks = {}
+        if self.builtin_package:
+            for module in import_package_modules(self.builtin_package):
+                gen = get_subclasses_from_module(module, t_obj)
+                self._tasks.update({task.__name__: task for task in gen})
+
+        # We found modules, so load them and scan for any tasks within them
         for file in files_gen():
             # attempt to import the file/package
             # if import fails, skip
@@ -104,7 +251,18 @@ class BaseTaskManager:
             self._tasks.update({task.__name__: task for task in gen})
         return self._tasks
 
+    def bind(self, metadata: VariablePool) -> "BaseTaskManager":
+        """
+        Return a copy of the manager that shares the discovered tasks but
+        reads and writes another pool
+        """
+        mgr = copy.copy(self)
+        mgr.metadata = metadata
+        return mgr
+
     def load_task(self, task: Type[Task]) -> Task:
+        if self.workers is not None and self.workers.isolates(task):
+            return self.workers.task(self.stage, task.__name__, self.metadata)  # type: ignore[return-value]
         return task(self.metadata)
 
     def execute_task(
@@ -112,54 +270,481 @@ class BaseTaskManager:
         task: Task,
         id_: Optional[str] = None,
         name: Optional[str] = "main",
+        task_id: Optional[str] = None,
         **kwargs: Any,
     ) -> Metadata:
+        """
+        :param task_id: id of the task the profiler charges the call to, by
+            default id_ or else the name of the task class
+        """
         func = getattr(task, name)
-        data = func(**kwargs)
+        if self.profiler is None:
+            data = func(**kwargs)
+        else:
+            key = task_id or id_ or type(task).__name__
+            data = self.profiler.call(key, func, **kwargs)
         if id_:
-            self.metadata.set(data, id_=id_)
+            self.metadata.set_(data, id_=id_)
         return data
 
 
 class PreProcessManager(BaseTaskManager):
+    builtin_package = "mediama.preprocessors"
+    stage = "pres"
+
     def discover_tasks(self) -> Dict[str, PreProcess]:
         return self._discover_tasks(PreProcess)
 
 
 class PostProcessManager(BaseTaskManager):
+    builtin_package = "mediama.postprocessors"
+    stage = "posts"
+
     def discover_tasks(self) -> Dict[str, PostProcess]:
         return self._discover_tasks(PostProcess)
 
 
 class SourceManager(BaseTaskManager):
+    builtin_package = "mediama.sources"
+    stage = "sources"
+    # Pool keys of the features of the files that sources are routed on, by
+    # capability, as set by preprocessors
+    features_keys = {
+        "kinds": ("kind",),
+        "languages": ("language", "languages"),
+        "ids": ("ids",),
+    }
+    # Set by the engine if sources are under flow control
+    health: Optional[Health] = None
+    # Set by the engine if the episode lists of sources are cached
+    episode_cache: Optional[EpisodeCache] = None
+    # Set by the engine if the lookups that found nothing are cached
+    misses: Optional[MissCache] = None
+
     def __init__(self, cfg: NormalizedConfig, metadata: Metadata):
         super().__init__(cfg, metadata)
+        self.cfg = cfg
         self.num_ranks = cfg["ranks"]
+        self.timeout = cfg["timeout"]
+        self.coalesce = cfg["coalesce"]
+        # Shared by the bound copies of the manager, so that the lookups of
+        # concurrent runs are coalesced
+        self._loaders: Dict[Tuple[str, str], Loader] = {}
+        self._loaders_lock = threading.Lock()
 
     def discover_tasks(self) -> Dict[str, Source]:
         return self._discover_tasks(Source)
 
+    def features(self) -> Dict[str, Set[str]]:
+        """
+        Return the features of the files in the pool, by capability
+
+        The audio languages found by the Probe preprocessor are languages of
+        the files as well. Features that no preprocessor set are left out.
+        """
+        keys = {key for keys in self.features_keys.values() for key in keys}
+        snapshot = self.metadata.snapshot(keys)
+        features: Dict[str, Set[str]] = {}
+        for capability, keys in self.features_keys.items():
+            for key in keys:
+                value = snapshot.get(key)
+                if isinstance(value, str):
+                    value = [value]
+                if value:
+                    # The keys of a mapping, such as the schemes of ids
+                    features.setdefault(capability, set()).update(map(str, value))
+        for info in self.metadata.files("probe").values():
+            languages = set((info or {}).get("audio_languages", [])) - {"und"}
+            if languages:
+                features.setdefault("languages", set()).update(languages)
+        return features
+
+    @staticmethod
+    def lookups(task: Type[Task]) -> Set[str]:
+        """
+        Return the lookups of a source, by default the methods it implements
+        """
+        declared = getattr(task, "capabilities", {}).get("lookups")
+        if declared is not None:
+            return set(declared)
+        return {
+            name
+            for name, methods in LOOKUPS.items()
+            if any(implements(task, method) for method in methods)
+        }
+
+    def route(
+        self, tasks: List[NormalizedTaskSettings], lookup: str
+    ) -> List[NormalizedTaskSettings]:
+        """
+        Return the source tasks capable of the lookup for the files in the
+        pool, in the same order
+
+        Tasks whose source is unknown are kept, so that they fail as before.
+        """
+        discovered = self.discover_tasks()
+        features = self.features()
+        routed = []
+        for task in tasks:
+            source = discovered.get(task["name"])
+            if source is not None:
+                capabilities = getattr(source, "capabilities", {})
+                reason = None
+                if lookup not in self.lookups(source):
+                    reason = f"does not support {lookup}"
+                for capability, values in features.items():
+                    declared = capabilities.get(capability)
+                    if declared is not None and not values & set(declared):
+                        reason = f"does not cover the {capability} {sorted(values)}"
+                if reason:
+                    logger.debug(f"Skipping {task['id']}, which {reason}")
+                    continue
+            routed.append(task)
+        return routed
+
     def execute_task(
         self, task: Task, name: str, id_: Optional[str] = None, **kwargs: Any,
     ) -> List[Metadata]:
         if name == "fetch_series":
+            # Only the chosen series is written to the pool, not the ranking
             return normalize_ranking(
-                super().execute_task(
-                    task, id_, name, **{"num_ranks": self.num_ranks, **kwargs}
-                ),
+                self.lookup(task, name, **{"num_ranks": self.num_ranks, **kwargs}),
                 self.num_ranks,
             )
         elif name == "fetch_episodes":
-            return super().execute_task(task, id_, name, **kwargs)
+            # Pages are streamed, so they are never written to the pool whole
+            if self.revalidates(task):
+                return iter_pages(self.fetch_revalidated(task, **kwargs))
+            return iter_pages(self.lookup(task, name, **kwargs))
         else:
             raise AttributeError
 
+    def revalidates(self, task: Task) -> bool:
+        """
+        Return whether the episodes of a source are fetched as deltas, which
+        is the case if it implements fetch_episodes_delta and either the
+        episode cache is enabled or it only implements deltas
+        """
+        if isinstance(task, Source):
+            source: Optional[Type[Task]] = type(task)
+        else:
+            # Tasks that run in worker processes stand in for their source
+            source = self.discover_tasks().get(getattr(task, "name", ""))
+        if source is None or not implements(source, "fetch_episodes_delta"):
+            return False
+        return self.episode_cache is not None or not implements(
+            source, "fetch_episodes"
+        )
+
+    def fetch_revalidated(
+        self,
+        task: Task,
+        task_id: Optional[str] = None,
+        force: bool = False,
+        **kwargs: Any,
+    ) -> List[SourceMetadata]:
+        """
+        Return the episodes of a source from the episode cache, revalidated
+        and merged with the episodes that changed since the last fetch if
+        the cached list is stale
+
+        :param force: revalidate the cached list even if it is fresh
+        """
+        id_ = task_id or type(task).__name__
+        cache = self.episode_cache
+        rows = self.metadata.dump()
+        series = ""
+        cached = None
+        if cache is not None:
+            series = cache.series(rows, id_)
+            cached = cache.get(id_, series, kwargs)
+            if cached and not force and cache.fresh(cached[2]):
+                logger.debug(f"Using the cached episodes of {id_}")
+                return cached[0]
+
+        delta = EpisodeDelta(
+            *self.lookup(
+                task,
+                "fetch_episodes_delta",
+                task_id,
+                validator=cached[1] if cached else None,
+                **kwargs,
+            )
+        )
+        if cached and not delta.full:
+            logger.debug(f"{id_} changed {len(delta.episodes)} cached episode(s)")
+            episodes = merge_episodes(cached[0], delta.episodes)
+        else:
+            episodes = list(delta.episodes)
+        if cache is not None:
+            cache.put(id_, series, kwargs, episodes, delta.validator, rows)
+        return episodes
+
+    def lookup(
+        self, task: Task, name: str, task_id: Optional[str] = None, **kwargs: Any
+    ) -> Any:
+        """
+        Call a lookup of a source, through its circuit breaker and concurrency
+        limit if the engine set up flow control
+
+        Lookups that recently found nothing for the same query are skipped if
+        misses are cached.
+
+        :raises CircuitOpen: if the source failed too often and is skipped
+        """
+        id_ = task_id or type(task).__name__
+        misses = self.misses
+        query = self.miss_query(name, id_)
+        if misses is not None and query is not None:
+            if misses.missed(id_, name, query[0], kwargs):
+                logger.debug(f"Skipping {id_}, which found nothing for {query[1]}")
+                return []
+
+        if self.health is None:
+            result = self._lookup(task, name, task_id, **kwargs)
+        else:
+            call = partial(self._lookup, task, name, task_id, **kwargs)
+            result = self.health.call(id_, call, self.timeout)
+
+        if misses is None or query is None:
+            return result
+        if isinstance(result, Iterator):
+            return self._watch_misses(misses, result, id_, name, query, kwargs)
+        if not result and not isinstance(result, AsyncIterable):
+            misses.record(id_, name, *query, kwargs)
+        return result
+
+    def miss_query(self, name: str, id_: str) -> Optional[Tuple[str, str]]:
+        """
+        Return the normalized query of a lookup and the title of the files it
+        is for, or None if misses are not cached for it
+
+        Series searches are keyed by the title of the files and episode lists
+        by the series the source chose.
+        """
+        if self.misses is None or name not in ("fetch_series", "fetch_episodes"):
+            return None
+        filepaths = self.metadata.snapshot(["filepaths"]).get("filepaths") or []
+        key = SeriesMemory.key(filepaths)
+        title = key[0] if key else ""
+        if name == "fetch_series":
+            return (title, title) if title else None
+        return EpisodeCache.series(self.metadata.dump(), id_), title
+
+    @staticmethod
+    def _watch_misses(
+        misses: MissCache,
+        pages: Iterator,
+        id_: str,
+        name: str,
+        query: Tuple[str, str],
+        kwargs: Dict[str, Any],
+    ) -> Generator[Any, None, None]:
+        # A stream is a miss if it ends without a single result; streams that
+        # are closed early are not
+        found = False
+        try:
+            for page in pages:
+                found = found or bool(page)
+                yield page
+            if not found:
+                misses.record(id_, name, *query, kwargs)
+        finally:
+            close = getattr(pages, "close", None)
+            if close:
+                close()
+
+    def _lookup(
+        self, task: Task, name: str, task_id: Optional[str] = None, **kwargs: Any
+    ) -> Any:
+        """
+        If the source implements the batched lookup, e.g. fetch_series_many,
+        the lookup is coalesced with the same lookup of concurrent runs.
+        Sources that run in worker processes are always called one at a time.
+        """
+        window = self.coalesce["window"]
+        if not window or not isinstance(task, Source):
+            return super().execute_task(task, None, name, task_id=task_id, **kwargs)
+        source = type(task)
+        if not implements(source, f"{name}_many"):
+            return super().execute_task(task, None, name, task_id=task_id, **kwargs)
+
+        id_ = task_id or source.__name__
+        with self._loaders_lock:
+            loader = self._loaders.get((id_, name))
+            if loader is None:
+                call = partial(self._lookup_many, source, name, id_, kwargs)
+                loader = Loader(call, self.coalesce["max_size"], window)
+                self._loaders[id_, name] = loader
+        # Pools cannot be shared between threads, so the batch gets copies
+        return loader.load(self.metadata.dump(), self.timeout)
+
+    def _lookup_many(
+        self,
+        source: Type[Source],
+        name: str,
+        id_: str,
+        kwargs: Dict[str, Any],
+        rows: List[List[Tuple[str, str, Any]]],
+    ) -> List[Any]:
+        """
+        Call the batched lookup of a source for the pools of the rows, or the
+        lookup of each pool if the batched lookup fails
+        """
+        pools = []
+        for rows_ in rows:
+            pool = VariablePool(self.cfg, id_="mediama")
+            pool.load(rows_)
+            pools.append(pool)
+        func = getattr(source(None), f"{name}_many")  # type: ignore[arg-type]
+        try:
+            with self.tracer.span(f"{name}_many", self.stage, id_, size=len(pools)):
+                if self.profiler is None:
+                    results = func(pools, **kwargs)
+                else:
+                    results = self.profiler.call(id_, func, pools=pools, **kwargs)
+                results = list(results)
+            if len(results) != len(pools):
+                raise ValueError(
+                    f"Expected {len(pools)} results but got {len(results)}"
+                )
+            return results
+        except Exception as e:
+            logger.warning(
+                f"{id_} failed to look up {len(pools)} runs at once, so they are "
+                f"looked up one at a time: {e}"
+            )
+        results = []
+        for pool in pools:
+            try:
+                results.append(
+                    BaseTaskManager.execute_task(
+                        self, source(pool), None, name, task_id=id_, **kwargs
+                    )
+                )
+            except Exception as e:
+                results.append(e)
+        return results
+
+    def stream_episodes(
+        self,
+        producers: Dict[str, Callable[[], Iterable[Page]]],
+        timeout: Optional[float] = None,
+    ) -> Generator[Tuple[str, Optional[Page]], None, None]:
+        """
+        Fetch the episode pages of every source concurrently
+
+        Pages are yielded as (id, page) pairs in arrival order. Once a source
+        is exhausted, (id, None) is yielded. The queue holds at most one page
+        per source so a fast source cannot run far ahead of the consumer.
+        """
+        import gevent
+        from gevent.queue import Queue, Empty
+
+        queue: Queue = Queue(maxsize=max(len(producers), 1))
+
+        def produce(id_: str, producer: Callable[[], Iterable[Page]]):
+            try:
+                for page in producer():
+                    queue.put((id_, page))
+            except Exception as e:
+                logger.error(f"Error while fetching episodes from {id_}: {e}")
+            finally:
+                queue.put((id_, None))
+
+        greenlets = [
+            gevent.spawn(produce, id_, producer) for id_, producer in producers.items()
+        ]
+        deadline = None if timeout is None else time.monotonic() + timeout
+        remaining = set(producers)
+        try:
+            while remaining:
+                wait = None if deadline is None else max(deadline - time.monotonic(), 0)
+                try:
+                    id_, page = queue.get(timeout=wait)
+                except Empty:
+                    logger.warning("Timed out while fetching episode metadata")
+                    if self.health is not None:
+                        for id_ in remaining:
+                            self.health.timed_out(id_)
+                    return
+                if page is None:
+                    remaining.discard(id_)
+                yield id_, page
+        finally:
+            gevent.killall(greenlets, block=False)
+
+    def match_episodes(
+        self,
+        pages: Iterable[Tuple[str, Optional[Page]]],
+        filepaths: Iterable[Path],
+        ids: Iterable[str],
+        ambiguous: Optional[List[Tuple[str, SourceMetadata]]] = None,
+    ) -> Generator[Tuple[Path, Dict[str, SourceMetadata]], None, None]:
+        """
+        Match streamed episode pages to files
+
+        A file is yielded with its metadata from each source as soon as every
+        source still streaming has matched it. Files that are still pending
+        when the stream ends are yielded with whatever matched. The stream is
+        closed early once every file is resolved.
+
+        :param ambiguous: if given, the (id, episode) pairs of the pages that
+            failed to match are added to it, so they can be matched by hand.
+            Only the episodes numbered next to a number in the names of the
+            files are kept, at most CANDIDATES_PER_FILE per file.
+        """
+        pending: Dict[Path, Dict[str, SourceMetadata]] = {
+            Path(path): {} for path in filepaths
+        }
+        active = set(ids)
+        numbers = {int(n) for path in pending for n in NUMBERS.findall(path.stem)}
+        limit = CANDIDATES_PER_FILE * len(pending)
+        try:
+            for id_, page in pages:
+                if page is None:
+                    active.discard(id_)
+                else:
+                    try:
+                        matches = self.disambiguate_episodes(page)
+                    except Exception as e:
+                        logger.debug(f"Failed to match episodes from {id_}: {e}")
+                        matches = {}
+                        if ambiguous is not None:
+                            near = [
+                                (id_, episode)
+                                for episode in page
+                                if near_files(episode, numbers)
+                            ]
+                            ambiguous.extend(near[: max(limit - len(ambiguous), 0)])
+                    for path, data in matches.items():
+                        if Path(path) in pending:
+                            pending[Path(path)].setdefault(id_, data)
+
+                resolved = [
+                    path
+                    for path, data in pending.items()
+                    if data and active.issubset(data)
+                ]
+                for path in resolved:
+                    yield path, pending.pop(path)
+                if not pending:
+                    return
+        finally:
+            close = getattr(pages, "close", None)
+            if close:
+                close()
+
+        for path, data in pending.items():
+            if data:
+                yield path, data
+
     def aggregate(
         # self, *rankings: List[Tuple(str, float, SourceMetadata)]
         self, *rankings
     ) -> List[SourceMetadata]:
         name_rankings = [
-            [result.name for result in ranking] for _, ranking, _ in rankings
+            [result["name"] for result in ranking] for _, ranking, _ in rankings
         ]
         weights = [weight for _, _, weight in rankings]
         names = rank_aggregation(name_rankings, weights)
@@ -0,0 +1,238 @@
+import re
+import json
+import time
+import pickle
+import sqlite3
+import hashlib
+import threading
+from logging import getLogger
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from .utils import dirs
+
+logger = getLogger(__name__)
+
+# (normalized title, release group, path pattern)
+Key = Tuple[str, str, str]
+
+# Tags in brackets, e.g. [Group], (2019) or [1080p]
+BRACKETS = re.compile(r"\[[^\]]*\]|\([^)]*\)|\{[^}]*\}")
+# Where the episode number starts, e.g. S01E02, 1x02, E02, Ep 2 or " - 02"
+EPISODE = re.compile(
+    r"\bs\d{1,2}\s*e\d{1,4}|\b\d{1,2}x\d{2,4}\b|\bep?\s?\d{1,4}\b|\s-\s\d{1,4}\b",
+    re.IGNORECASE,
+)
+LEADING_GROUP = re.compile(r"^\s*\[([^\]]+)\]")
+TRAILING_GROUP = re.compile(r"-([a-z0-9]+)$", re.IGNORECASE)
+DAY = 24 * 60 * 60
+
+
+def normalize_title(title: str) -> str:
+    """
+    Return the title in lower case with punctuation and separators collapsed
+    into single spaces
+    """
+    return re.sub(r"[\W_]+", " ", title).strip().lower()
+
+
+def release_key(path: Path) -> Key:
+    """
+    Return the normalized title, release group and path pattern of a file
+
+    The pattern is the folder of the file with its numbers generalized, so
+    that e.g. every season folder of a show shares it.
+    """
+    path = Path(path)
+    stem = path.stem
+    group = ""
+    match = LEADING_GROUP.match(stem)
+    if match:
+        group = match.group(1)
+        stem = stem[match.end() :]
+    episode = EPISODE.search(stem)
+    title = stem[: episode.start()] if episode else stem
+    if not group and episode:
+        match = TRAILING_GROUP.search(stem[episode.end() :])
+        if match:
+            group = match.group(1)
+    title = normalize_title(BRACKETS.sub(" ", title))
+    pattern = re.sub(r"\d+", "#", str(path.parent).lower())
+    return title, group.lower(), pattern
+
+
+def _settings(task: Dict[str, Any]) -> str:
+    data = json.dumps([task["name"], task["kwargs"]], sort_keys=True, default=str)
+    return hashlib.sha1(data.encode()).hexdigest()
+
+
+class SeriesMemory:
+    """
+    Persistent record of the series that files of each release resolved to
+
+    Files are keyed by their normalized title, release group and path
+    pattern. For each key, the series chosen in earlier runs is stored with
+    its metadata from every source, so later files with the same key skip the
+    series search of the sources.
+
+    A series is trusted once it was chosen ``confidence`` times in a row, or
+    once by the user. Entries that were not confirmed for ``expiry`` days are
+    searched again.
+    """
+
+    def __init__(self, path: Path, confidence: float = 2, expiry: Optional[float] = 90):
+        self.path = path
+        self.confidence = confidence
+        self.expiry = expiry
+        # The store is shared by the jobs of the server, which run in threads
+        self.conn = sqlite3.connect(str(path), check_same_thread=False)
+        self._lock = threading.Lock()
+
+        c = self.conn.cursor()
+        c.execute(
+            """
+            CREATE TABLE IF NOT EXISTS memory (
+                title TEXT NOT NULL,
+                release_group TEXT NOT NULL,
+                pattern TEXT NOT NULL,
+                name TEXT NOT NULL,
+                sources BLOB NOT NULL,
+                confidence REAL NOT NULL,
+                uses INTEGER NOT NULL,
+                updated REAL NOT NULL,
+
+                PRIMARY KEY(title, release_group, pattern))
+            """
+        )
+        self.conn.commit()
+
+    @classmethod
+    def from_config(cls, cfg: Dict[str, Any]) -> Optional["SeriesMemory"]:
+        """
+        Open the store configured by ``cfg["memory"]`` or None if it is
+        disabled
+        """
+        config = cfg.get("memory")
+        if not config:
+            return None
+
+        path = Path(config.get("path") or "memory.db")
+        if not path.is_absolute():
+            path = Path(dirs.user_data_dir) / path
+        path.parent.mkdir(parents=True, exist_ok=True)
+        return cls(path, config.get("confidence", 2), config.get("expiry", 90))
+
+    @staticmethod
+    def key(filepaths: Iterable[Path]) -> Optional[Key]:
+        """
+        Return the key shared by every file, or None if they differ or have no
+        title
+        """
+        keys = {release_key(path) for path in filepaths}
+        if len(keys) != 1:
+            return None
+        key = keys.pop()
+        return key if key[0] else None
+
+    def _get(self, key: Key) -> Optional[Tuple]:
+        c = self.conn.cursor()
+        c.execute(
+            """
+            SELECT
+                name, sources, confidence, updated
+            FROM
+                memory
+            WHERE
+                title = ? AND release_group = ? AND pattern = ?
+            """,
+            key,
+        )
+        return c.fetchone()
+
+    def recall(
+        self, key: Key, sources: List[Dict[str, Any]]
+    ) -> Optional[Dict[str, Any]]:
+        """
+        Return the trusted series metadata of the key from each source, or None
+        if the series must be searched
+
+        :param sources: the source task settings, which must all be the same
+            as when the series was stored
+        """
+        with self._lock:
+            row = self._get(key)
+            if row is None:
+                return None
+            name, stored, confidence, updated = row
+            if confidence < self.confidence:
+                return None
+            if self.expiry is not None and time.time() - updated > self.expiry * DAY:
+                logger.debug(f"The series of {key} expired")
+                return None
+            stored = pickle.loads(stored)
+            data = {}
+            for task in sources:
+                settings, metadata = stored.get(task["id"], (None, None))
+                if settings != _settings(task):
+                    return None
+                data[task["id"]] = metadata
+            self.conn.execute(
+                """
+                UPDATE memory SET uses = uses + 1
+                WHERE title = ? AND release_group = ? AND pattern = ?
+                """,
+                key,
+            )
+            self.conn.commit()
+        logger.debug(f"Recalled the series {name} for {key}")
+        return data
+
+    def learn(
+        self,
+        key: Key,
+        name: str,
+        rankings: List[Tuple[str, List[Dict[str, Any]]]],
+        sources: List[Dict[str, Any]],
+        answered: bool = False,
+    ):
+        """
+        Store the series chosen for the key
+
+        A series chosen again adds to its confidence while another series
+        replaces it. A series answered by the user is trusted at once.
+
+        :param rankings: the (source id, ranking) pairs the series was chosen
+            from
+        """
+        settings = {task["id"]: _settings(task) for task in sources}
+        stored = {}
+        for id_, ranking in rankings:
+            data = [result for result in ranking if result["name"] == name]
+            if data and id_ in settings:
+                stored[id_] = (settings[id_], data[0])
+        with self._lock:
+            row = self._get(key)
+            confidence = row[2] + 1 if row and row[0] == name else 1
+            if answered:
+                confidence = max(confidence, self.confidence)
+            self.conn.execute(
+                """
+                INSERT OR REPLACE INTO memory
+                    (title, release_group, pattern, name, sources, confidence,
+                     uses, updated)
+                VALUES (?,?,?,?,?,?,0,?)
+                """,
+                (*key, name, pickle.dumps(stored), confidence, time.time()),
+            )
+            self.conn.commit()
+
+    def forget(self, key: Key):
+        with self._lock:
+            self.conn.execute(
+                """
+                DELETE FROM memory
+                WHERE title = ? AND release_group = ? AND pattern = ?
+                """,
+                key,
+            )
+            self.conn.commit()
@@ -1,13 +1,31 @@
 import sqlite3
-from typing import List, Tuple, Any, Dict, TypedDict
+import pickle
+from os import PathLike
+from pathlib import Path
+from typing import List, Tuple, Any, Dict, TypedDict, Iterable, Optional, Union
 
 Metadata = Dict[str, Any]
+# (id, key, value) rows, followed by the file of the values scoped to a file
+Row = Tuple[Any, ...]
+
+
+def _scope(file: Optional[Union[str, PathLike]]) -> str:
+    return "" if file is None else str(file)
 
 
 class SourceMetadata(Metadata):
     name: str
 
 
+class PerFile(dict):
+    """
+    Values of a key for each file, as ``{path: value}``
+
+    A key that a task returns with such a value is written to the pool as one
+    value scoped to each file, instead of a single value for the batch.
+    """
+
+
 class VariablePool:
     def __init__(self, cfg: dict, id_: str = None):
         self.cfg = cfg
@@ -22,10 +40,15 @@ class VariablePool:
                 id TEXT NOT NULL,
                 key TEXT NOT NULL,
                 value BLOB NOT NULL,
+                file TEXT NOT NULL DEFAULT '',
                 
-                PRIMARY KEY(id, key))
+                PRIMARY KEY(id, key, file))
             """
         )
+        # Values are mostly looked up by key across every id
+        c.execute("CREATE INDEX IF NOT EXISTS pool_key ON pool (key, file)")
+        # and the values of a file together
+        c.execute("CREATE INDEX IF NOT EXISTS pool_file ON pool (file, key)")
 
         self._resolve_ids(cfg)
 
@@ -36,10 +59,15 @@ class VariablePool:
         """
         Return the default value of a key stored in the database
         """
-        results = self.get_all(key)
+        return self._resolve(key, self.get_all(key))
+
+    def _resolve(self, key: str, results: Dict[str, Any]) -> Any:
+        """
+        Return the value of the id with the greatest priority for the key
+        """
         priority = self._ids.get(key, self._priority)
         if self.id:
-            priority.insert(0, self.id)
+            priority = [self.id] + priority
         for id_ in priority:
             try:
                 return results[id_]
@@ -51,12 +79,12 @@ class VariablePool:
         # TODO: parse cfg for id priority order
 
         # Last > First
-        posts_priority = [task.id for task in cfg["posts"]]
+        posts_priority = [task["id"] for task in cfg["posts"]]
         posts_priority.reverse()
         # First > Last
-        sources_priority = [task.id for task in cfg["sources"]]
+        sources_priority = [task["id"] for task in cfg["sources"]]
         # Last > First
-        pres_priority = [task.id for task in cfg["pres"]]
+        pres_priority = [task["id"] for task in cfg["pres"]]
         pres_priority.reverse()
         self._priority = posts_priority + sources_priority + pres_priority
 
@@ -64,16 +92,26 @@ class VariablePool:
         # This is accomplished by placing the remapping at the beginning of
         # the priority list and deleting the old indices
         self._ids = {}
-        for key, remapping in cfg["key_sources"]:
+        for key, remapping in cfg["key_sources"].items():
             priority = remapping + self._priority
             start_idx = len(remapping)
             for k in remapping:
                 idx = priority.index(k, start_idx)
                 del priority[idx]
-            self._ids.update({key, priority})
+            self._ids.update({key: priority})
 
-    def get(self, key: str, id_: str = None) -> Any:
+    def get(
+        self,
+        key: str,
+        id_: str = None,
+        file: Optional[Union[str, PathLike]] = None,
+    ) -> Any:
+        """
+        :param file: return the value scoped to this file, see scoped
+        """
         if id_ is None:
+            if file is not None:
+                return self.scoped(file)[key]
             return self.__getitem__(key)
 
         c = self.conn.cursor()
@@ -87,28 +125,48 @@ class VariablePool:
                 key = ?
             AND
                 id = ?
+            AND
+                file = ?
             """,
-            (key, id_),
+            (key, id_, _scope(file)),
         )
 
         result = c.fetchone()
         if result:
-            return result[0]  # unpack tuple
+            return pickle.loads(result[0])  # unpack tuple
         raise KeyError(f"({id_}, {key}) not found in database")
 
-    def set_(self, data: Dict[str, Any], id_: str):
+    def set_(
+        self,
+        data: Dict[str, Any],
+        id_: str,
+        file: Optional[Union[str, PathLike]] = None,
+    ):
+        """
+        :param file: the file the values belong to, instead of the whole batch.
+            Values that are PerFile are scoped to each of their files.
+        """
         if id_ is None:
             raise ValueError("No key specified")
+        rows = []
+        for key, value in data.items():
+            if isinstance(value, PerFile):
+                rows += [
+                    (id_, key, pickle.dumps(value_), _scope(path))
+                    for path, value_ in value.items()
+                ]
+            else:
+                rows.append((id_, key, pickle.dumps(value), _scope(file)))
         c = self.conn.cursor()
         c.executemany(
             """
-            INSERT INTO pool (id, key, value)
-            VALUES (?,?,?)
+            INSERT OR REPLACE INTO pool (id, key, value, file)
+            VALUES (?,?,?,?)
             """,
-            [(id_, key, value) for key, value in data.items()],
+            rows,
         )
 
-    def get_all(self, key: str):
+    def get_all(self, key: str, file: Optional[Union[str, PathLike]] = None):
         c = self.conn.cursor()
         c.execute(
             """
@@ -117,9 +175,199 @@ class VariablePool:
             FROM
                 pool
             WHERE
-                key = ?
+                key = ? AND file = ?
+            """,
+            (key, _scope(file)),
+        )
+
+        return {id_: pickle.loads(value) for (id_, value) in c.fetchall()}
+
+    def files(self, key: str, id_: Optional[str] = None) -> Dict[Path, Any]:
+        """
+        Return the value of a key scoped to each file that has one, resolved by
+        priority or of the given id, using a single query
+        """
+        c = self.conn.cursor()
+        c.execute(
+            """
+            SELECT
+                id, file, value
+            FROM
+                pool
+            WHERE
+                key = ? AND file != ''
             """,
             (key,),
         )
 
-        return {id_: value for (id_, value) in c.fetchall()}
+        results: Dict[str, Dict[str, Any]] = {}
+        for row_id, file, value in c.fetchall():
+            results.setdefault(file, {})[row_id] = value
+
+        files = {}
+        for file, values in results.items():
+            try:
+                value = values[id_] if id_ is not None else self._resolve(key, values)
+            except KeyError:
+                continue
+            files[Path(file)] = pickle.loads(value)
+        return files
+
+    def file_snapshots(
+        self, keys: Optional[Iterable[str]] = None
+    ) -> Dict[Path, Dict[str, Any]]:
+        """
+        Return the default value of every key scoped to each file, or only of
+        the given keys, using a single query
+        """
+        c = self.conn.cursor()
+        if keys is None:
+            c.execute("SELECT id, key, file, value FROM pool WHERE file != ''")
+        else:
+            keys = list(keys)
+            c.execute(
+                f"""
+                SELECT
+                    id, key, file, value
+                FROM
+                    pool
+                WHERE
+                    key IN ({",".join("?" * len(keys))}) AND file != ''
+                """,
+                keys,
+            )
+
+        results: Dict[Tuple[str, str], Dict[str, Any]] = {}
+        for id_, key, file, value in c.fetchall():
+            results.setdefault((file, key), {})[id_] = value
+
+        snapshots: Dict[Path, Dict[str, Any]] = {}
+        for (file, key), values in results.items():
+            try:
+                value = self._resolve(key, values)
+            except KeyError:
+                continue
+            snapshots.setdefault(Path(file), {})[key] = pickle.loads(value)
+        return snapshots
+
+    def scoped(self, file: Union[str, PathLike]) -> "ScopedPool":
+        """
+        Return a view of the values of a file, see ScopedPool
+        """
+        return ScopedPool(self, file)
+
+    def dump(self) -> List[Row]:
+        """
+        Return every (id, key, value) row in the pool, with the file last for
+        the values scoped to a file
+        """
+        c = self.conn.cursor()
+        c.execute("SELECT id, key, value, file FROM pool")
+        rows: List[Row] = []
+        for id_, key, value, file in c.fetchall():
+            row = (id_, key, pickle.loads(value))
+            rows.append(row + (file,) if file else row)
+        return rows
+
+    def load(self, rows: Iterable[Row]):
+        """
+        Insert rows as returned by dump into the pool, replacing existing values
+        """
+        c = self.conn.cursor()
+        c.executemany(
+            """
+            INSERT OR REPLACE INTO pool (id, key, value, file)
+            VALUES (?,?,?,?)
+            """,
+            [
+                (id_, key, pickle.dumps(value), _scope(file[0] if file else None))
+                for id_, key, value, *file in rows
+            ],
+        )
+
+    def snapshot(
+        self,
+        keys: Optional[Iterable[str]] = None,
+        file: Optional[Union[str, PathLike]] = None,
+    ) -> Dict[str, Any]:
+        """
+        Return the default value of every key, or only of the given keys, using
+        a single query
+
+        Keys whose values only belong to ids outside of the priority list are
+        left out.
+
+        :param file: return the values scoped to this file instead of the values
+            of the whole batch
+        """
+        c = self.conn.cursor()
+        if keys is None:
+            c.execute("SELECT id, key, value FROM pool WHERE file = ?", (_scope(file),))
+        else:
+            keys = list(keys)
+            c.execute(
+                f"""
+                SELECT
+                    id, key, value
+                FROM
+                    pool
+                WHERE
+                    key IN ({",".join("?" * len(keys))}) AND file = ?
+                """,
+                [*keys, _scope(file)],
+            )
+
+        results: Dict[str, Dict[str, Any]] = {}
+        for id_, key, value in c.fetchall():
+            results.setdefault(key, {})[id_] = value
+
+        snapshot = {}
+        for key, values in results.items():
+            try:
+                snapshot[key] = pickle.loads(self._resolve(key, values))
+            except KeyError:
+                continue
+        return snapshot
+
+
+class ScopedPool:
+    """
+    View of the values of a pool for a single file
+
+    A key resolves to the value scoped to the file if a task set one, or else
+    falls back to the value of the whole batch. The pool of a run holds a
+    single series, so the batch values are those of the series and of the run,
+    such as ``filepaths``. Values set through the view are scoped to the file.
+    """
+
+    def __init__(self, pool: VariablePool, file: Union[str, PathLike]):
+        self.pool = pool
+        self.file = Path(file)
+
+    def __getitem__(self, key: str) -> Any:
+        try:
+            return self.pool._resolve(key, self.pool.get_all(key, self.file))
+        except KeyError:
+            return self.pool[key]
+
+    def __setitem__(self, key: str, value: Any):
+        self.set_({key: value}, self.pool.id)
+
+    def get(self, key: str, id_: str = None) -> Any:
+        if id_ is None:
+            return self[key]
+        try:
+            return self.pool.get(key, id_, self.file)
+        except KeyError:
+            return self.pool.get(key, id_)
+
+    def set_(self, data: Dict[str, Any], id_: str):
+        self.pool.set_(data, id_, self.file)
+
+    def snapshot(self, keys: Optional[Iterable[str]] = None) -> Dict[str, Any]:
+        """
+        Return the default value of every key, or only of the given keys, with
+        the values of the file over those of the batch
+        """
+        keys = None if keys is None else list(keys)
+        return {**self.pool.snapshot(keys), **self.pool.snapshot(keys, self.file)}
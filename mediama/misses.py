@@ -0,0 +1,149 @@
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from logging import getLogger
+from pathlib import Path
+from typing import Any, Dict, Iterable, Optional
+
+from .utils import dirs
+
+logger = getLogger(__name__)
+
+
+def _settings(kwargs: Dict[str, Any]) -> str:
+    data = json.dumps(kwargs, sort_keys=True, default=str)
+    return hashlib.sha1(data.encode()).hexdigest()
+
+
+class MissCache:
+    """
+    Persistent record of the lookups of sources that found nothing
+
+    A lookup is keyed by its source, its name and its normalized query, e.g.
+    the title of the files for a series search. Lookups that found nothing
+    less than ``ttl`` seconds ago are not sent again, so files that no source
+    knows, such as fan-subs or unreleased specials, do not cost requests on
+    every run. Misses are kept apart from the results of the requests cache,
+    with a shorter lifetime, so a show that is added to a provider is soon
+    found.
+    """
+
+    def __init__(self, path: Path, ttl: float = 6 * 60 * 60):
+        self.path = path
+        self.ttl = ttl
+        # The store is shared by the jobs of the server, which run in threads
+        self.conn = sqlite3.connect(str(path), check_same_thread=False)
+        self._lock = threading.Lock()
+
+        c = self.conn.cursor()
+        c.execute(
+            """
+            CREATE TABLE IF NOT EXISTS misses (
+                source TEXT NOT NULL,
+                lookup TEXT NOT NULL,
+                query TEXT NOT NULL,
+                title TEXT NOT NULL,
+                settings TEXT NOT NULL,
+                recorded REAL NOT NULL,
+
+                PRIMARY KEY(source, lookup, query))
+            """
+        )
+        c.execute("CREATE INDEX IF NOT EXISTS misses_title ON misses (title)")
+        self.conn.commit()
+
+    @classmethod
+    def from_config(cls, cfg: Dict[str, Any]) -> Optional["MissCache"]:
+        """
+        Open the store configured by ``cfg["misses"]`` or None if it is
+        disabled
+        """
+        config = cfg.get("misses")
+        if not config:
+            return None
+
+        path = Path(config.get("path") or "misses.db")
+        if not path.is_absolute():
+            path = Path(dirs.user_data_dir) / path
+        path.parent.mkdir(parents=True, exist_ok=True)
+        return cls(path, config.get("ttl", 6 * 60 * 60))
+
+    def missed(
+        self, source: str, lookup: str, query: str, kwargs: Dict[str, Any]
+    ) -> bool:
+        """
+        Return whether the lookup found nothing recently with the same settings
+        """
+        with self._lock:
+            c = self.conn.cursor()
+            c.execute(
+                """
+                SELECT
+                    settings, recorded
+                FROM
+                    misses
+                WHERE
+                    source = ? AND lookup = ? AND query = ?
+                """,
+                (source, lookup, query),
+            )
+            row = c.fetchone()
+        return (
+            row is not None
+            and row[0] == _settings(kwargs)
+            and time.time() - row[1] < self.ttl
+        )
+
+    def record(
+        self,
+        source: str,
+        lookup: str,
+        query: str,
+        title: str,
+        kwargs: Dict[str, Any],
+    ):
+        """
+        Record that the lookup found nothing
+
+        :param title: the normalized title of the files, by which the miss can
+            be forgotten
+        """
+        logger.debug(f"{source} found nothing for {title or query}")
+        with self._lock:
+            self.conn.execute(
+                """
+                INSERT OR REPLACE INTO misses
+                    (source, lookup, query, title, settings, recorded)
+                VALUES (?,?,?,?,?,?)
+                """,
+                (source, lookup, query, title, _settings(kwargs), time.time()),
+            )
+            self.conn.commit()
+
+    def forget(
+        self, titles: Optional[Iterable[str]] = None, source: Optional[str] = None
+    ) -> int:
+        """
+        Forget the misses of the normalized titles, or of every title, and
+        return how many were forgotten
+
+        :param source: only forget the misses of this source id
+        """
+        where = []
+        params: list = []
+        titles = list(titles or [])
+        if titles:
+            where.append(f"title IN ({','.join('?' * len(titles))})")
+            params += titles
+        if source is not None:
+            where.append("source = ?")
+            params.append(source)
+        query = "DELETE FROM misses"
+        if where:
+            query += " WHERE " + " AND ".join(where)
+        with self._lock:
+            count = self.conn.execute(query, params).rowcount
+            self.conn.commit()
+        return count
@@ -0,0 +1,202 @@
+import os
+import json
+from datetime import datetime, timezone
+from logging import getLogger
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional
+
+from .config import NormalizedConfig
+from .metadata import VariablePool
+from .state import Fingerprints, Rows, file_fingerprint
+
+logger = getLogger(__name__)
+
+# Version 1 plans could embed pickled values, which are no longer read
+PLAN_VERSION = 3
+
+# Changes planned by each postprocess task, keyed by task id and file
+Changes = Dict[str, Dict[Path, Any]]
+Plan = Dict[str, Any]
+
+
+def _encode(value: Any) -> Any:
+    """
+    Encode a pool value as JSON without losing its types
+
+    Plans are edited by hand and shared, so only types that can be rebuilt
+    without running code are written.
+
+    :raises TypeError: if the value has an unsupported type
+    """
+    if value is None or isinstance(value, (str, int, float, bool)):
+        return value
+    if isinstance(value, Path):
+        return {"__path__": str(value)}
+    if isinstance(value, list):
+        return [_encode(item) for item in value]
+    if isinstance(value, tuple):
+        return {"__tuple__": [_encode(item) for item in value]}
+    if isinstance(value, dict):
+        return {"__items__": [[_encode(k), _encode(v)] for k, v in value.items()]}
+    if isinstance(value, (set, frozenset)):
+        return {"__set__": [_encode(item) for item in value]}
+    raise TypeError(f"{type(value).__name__} values cannot be written to a plan")
+
+
+def _decode(value: Any) -> Any:
+    if isinstance(value, list):
+        return [_decode(item) for item in value]
+    if not isinstance(value, dict):
+        return value
+    if "__path__" in value:
+        return Path(value["__path__"])
+    if "__tuple__" in value:
+        return tuple(_decode(item) for item in value["__tuple__"])
+    if "__items__" in value:
+        return {_decode(k): _decode(v) for k, v in value["__items__"]}
+    if "__set__" in value:
+        return {_decode(item) for item in value["__set__"]}
+    return value
+
+
+def _plain(value: Any) -> Any:
+    """
+    Convert a value to plain JSON that is easy to review and edit
+    """
+    if isinstance(value, dict):
+        return {str(k): _plain(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple, set)):
+        return [_plain(item) for item in value]
+    if value is None or isinstance(value, (str, int, float, bool)):
+        return value
+    return str(value)
+
+
+def build_plan(
+    varpool: VariablePool,
+    filepaths: Iterable[Path],
+    cfg: NormalizedConfig,
+    changes: Changes,
+    deferred: List[str],
+    fingerprints: Fingerprints,
+    complete: bool = True,
+) -> Plan:
+    """
+    Describe what a run would do to every file
+
+    Each matched file lists its episode match from every source, the share of
+    sources that matched it as the confidence, and the changes planned by each
+    postprocess task. The pool is embedded so the plan can be applied without
+    querying the sources again.
+
+    :param deferred: ids of the postprocess tasks that cannot be planned and
+        are run when the plan is applied
+    :param complete: whether every task succeeded while planning
+    :raises ValueError: if a pool value cannot be written to the plan
+    """
+    episodes = varpool.files("episodes", varpool.id)
+    sources = [task["id"] for task in cfg["sources"]]
+
+    files = {}
+    unmatched = []
+    for path in map(Path, filepaths):
+        matches = episodes.get(path)
+        if not matches:
+            unmatched.append(str(path))
+            continue
+        files[str(path)] = {
+            "fingerprint": file_fingerprint(path),
+            # Only the share of sources that matched, not their ranking scores
+            "confidence": round(len(matches) / len(sources), 3) if sources else 0,
+            "matches": _plain(matches),
+            "changes": {
+                id_: _plain(changes_[path])
+                for id_, changes_ in changes.items()
+                if path in changes_
+            },
+        }
+
+    pool = []
+    for id_, key, value, *file in varpool.dump():
+        try:
+            pool.append([id_, key, _encode(value), *file])
+        except TypeError as e:
+            raise ValueError(f"Cannot write {key} of {id_} to the plan: {e}") from e
+
+    return {
+        "version": PLAN_VERSION,
+        "created": datetime.now(timezone.utc).isoformat(),
+        "complete": complete,
+        "fingerprints": fingerprints,
+        "files": files,
+        "unmatched": unmatched,
+        "deferred": deferred,
+        "pool": pool,
+    }
+
+
+def plan_pool(plan: Plan, filepaths: Iterable[Path]) -> Rows:
+    """
+    Return the pool rows of the plan, keeping only the values scoped to the
+    files, such as their episodes
+    """
+    keep = set(map(Path, filepaths))
+    return [
+        (id_, key, _decode(value), *file)
+        for id_, key, value, *file in plan["pool"]
+        if not file or Path(file[0]) in keep
+    ]
+
+
+def plan_changes(plan: Plan, filepaths: Iterable[Path]) -> Changes:
+    """
+    Return the planned changes of the files grouped by postprocess task
+
+    Files or changes removed from the plan while reviewing it are left out.
+    """
+    changes: Changes = {}
+    for path in map(Path, filepaths):
+        for id_, change in plan["files"][str(path)]["changes"].items():
+            changes.setdefault(id_, {})[path] = change
+    return changes
+
+
+def unchanged_files(plan: Plan) -> List[Path]:
+    """
+    Return the files of the plan that have not changed since it was made
+    """
+    files = []
+    for path, entry in plan["files"].items():
+        try:
+            fingerprint = file_fingerprint(Path(path))
+        except OSError:
+            fingerprint = None
+        if fingerprint != entry["fingerprint"]:
+            logger.warning(f"Skipping {path}: it changed since the plan was made")
+            continue
+        files.append(Path(path))
+    return files
+
+
+def save_plan(plan: Plan, path: Optional[Path] = None):
+    """
+    Write the plan to a file atomically, or to stdout if no path is given
+    """
+    if path is None:
+        print(json.dumps(plan, indent=2))
+        return
+    part = path.with_name(f".{path.name}.mediama-part")
+    with open(part, "w") as f:
+        json.dump(plan, f, indent=2)
+    os.replace(part, path)
+
+
+def load_plan(path: Path) -> Plan:
+    """
+    :raises ValueError: if the plan was made by an incompatible version
+    """
+    with open(path) as f:
+        plan = json.load(f)
+    if plan.get("version") != PLAN_VERSION:
+        raise ValueError(f"Unsupported plan version: {plan.get('version')}")
+    return plan
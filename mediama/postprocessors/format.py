@@ -0,0 +1,39 @@
+from pathlib import Path
+from typing import Optional
+
+from mediama import PostProcess
+from mediama.template import compile_template, render_files, sanitize
+
+
+class Format(PostProcess):
+    """
+    Plan the destination of every matched file from a format string
+
+    The format is compiled once, e.g. ``{series}/Season {season|pad:2}/{series}
+    - S{season|pad:2}E{episode|pad:2} - {title}``, and only the keys it uses
+    are read from the pool. Field values are made safe for file names, while
+    slashes in the format itself create folders. The destinations are relative
+    to ``root``, or to the folder of each file, and keep the file extension.
+    They are written to the ``destinations`` key read by Rename. Fields of the
+    ``probe`` key, such as ``{resolution}``, and fields set for a single file
+    are available per file.
+    """
+
+    side_effects = False
+
+    def main(self, format: str, root: Optional[str] = None, **kwargs):
+        template = compile_template(format, sanitize)
+        snapshot = self.metadata.snapshot(template.fields)
+        episodes = self.metadata.files("episodes", "mediama")
+        # The probed metadata and the fields set for each file
+        files = self.metadata.file_snapshots(template.fields)
+        for path, probe in self.metadata.files("probe").items():
+            files[path] = {**probe, **files.get(path, {})}
+        names = render_files(template, episodes, snapshot, files)
+        return {
+            "destinations": {
+                Path(path): (Path(root) if root else Path(path).parent)
+                / f"{name}{Path(path).suffix}"
+                for path, name in names.items()
+            }
+        }
@@ -0,0 +1,48 @@
+from pathlib import Path
+from typing import Dict
+import uuid
+
+from mediama import PostProcess
+from mediama.rename import plan_moves, execute_moves, CHUNK_SIZE
+from mediama.utils import dirs
+
+
+class Rename(PostProcess):
+    """
+    Move every file of the batch to its planned destination
+
+    Destinations are read from the ``destinations`` key of every task, a
+    mapping of source paths to destination paths. All of the moves are
+    validated together before any file is touched and are rolled back if any
+    of them fails.
+
+    When planning, the change of each file is its destination.
+    """
+
+    def _moves(self) -> Dict[Path, Path]:
+        moves = {}
+        for destinations in self.metadata.get_all("destinations").values():
+            moves.update(destinations)
+        return {Path(src): Path(dst) for src, dst in moves.items()}
+
+    def main(self, workers: int = 8, chunk_size: int = CHUNK_SIZE, **kwargs):
+        return self.apply(self._moves(), workers, chunk_size)
+
+    def plan(self, **kwargs):
+        moves = self._moves()
+        # Collisions are reported while planning rather than when applying
+        plan_moves(moves.items())
+        return {src: dst for src, dst in moves.items() if src != dst}
+
+    def apply(
+        self,
+        changes: Dict[Path, str],
+        workers: int = 8,
+        chunk_size: int = CHUNK_SIZE,
+        **kwargs,
+    ):
+        moves = {Path(src): Path(dst) for src, dst in changes.items()}
+        steps = plan_moves(moves.items())
+        journal = Path(dirs.user_data_dir) / "journals" / f"{uuid.uuid4().hex}.jsonl"
+        execute_moves(steps, journal, workers, chunk_size)
+        return {"moved": moves}
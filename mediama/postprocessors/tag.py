@@ -0,0 +1,95 @@
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from mediama import PostProcess
+from mediama.tags import (
+    file_snapshot,
+    resolve_tags,
+    read_tags,
+    write_all,
+    Tags,
+    BUFFER_SIZE,
+    PADDING,
+)
+
+
+class Tag(PostProcess):
+    """
+    Write metadata tags into every matched file of the batch
+
+    ``tags`` maps tag names to metadata keys, e.g. ``{"title": "title"}``.
+    The pool is snapshot once for the whole batch and the per-file episode
+    metadata is layered on top of it. Files that are already tagged are left
+    untouched and the others are written in parallel, in place whenever the
+    container has room for them. If a rename ran before, the files are tagged
+    at their new paths.
+
+    When planning, the change of each file is ``{TAG: [old, new]}`` for every
+    tag that differs.
+    """
+
+    def _moved(self) -> Dict[Path, Path]:
+        moved: Dict[Path, Path] = {}
+        for moves in self.metadata.get_all("moved").values():
+            moved.update(moves)
+        return moved
+
+    def _files(self, tags: Dict[str, str]) -> Dict[Path, Tags]:
+        snapshot = self.metadata.snapshot()
+        scoped = self.metadata.file_snapshots()
+        episodes = self.metadata.files("episodes", "mediama")
+        return {
+            path: resolve_tags(
+                file_snapshot({**snapshot, **scoped.get(path, {})}, data), tags
+            )
+            for path, data in episodes.items()
+        }
+
+    def main(
+        self,
+        tags: Dict[str, str],
+        io_concurrency: int = 4,
+        padding: int = PADDING,
+        buffer_size: int = BUFFER_SIZE,
+        **kwargs,
+    ):
+        moved = self._moved()
+        files = {
+            moved.get(path, path): tags_ for path, tags_ in self._files(tags).items()
+        }
+        results = write_all(files, io_concurrency, padding, buffer_size)
+        return {"tagged": results}
+
+    def plan(self, tags: Dict[str, str], **kwargs):
+        changes: Dict[Path, Dict[str, List[Optional[str]]]] = {}
+        for path, tags_ in self._files(tags).items():
+            try:
+                existing = read_tags(path)
+            except (OSError, ValueError):
+                existing = {}
+            diff = {
+                name.upper(): [existing.get(name.upper()), value]
+                for name, value in tags_.items()
+                if existing.get(name.upper()) != value
+            }
+            if diff:
+                changes[path] = diff
+        return changes
+
+    def apply(
+        self,
+        changes: Dict[Path, Dict[str, List[Optional[str]]]],
+        io_concurrency: int = 4,
+        padding: int = PADDING,
+        buffer_size: int = BUFFER_SIZE,
+        **kwargs,
+    ):
+        moved = self._moved()
+        files = {
+            moved.get(Path(path), Path(path)): {
+                name: new for name, (_, new) in diff.items() if new is not None
+            }
+            for path, diff in changes.items()
+        }
+        results = write_all(files, io_concurrency, padding, buffer_size)
+        return {"tagged": results}
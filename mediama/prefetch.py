@@ -0,0 +1,97 @@
+import threading
+from logging import getLogger
+from typing import Any, Dict, Optional
+
+from .metadata import VariablePool
+
+logger = getLogger(__name__)
+
+
+class Prefetcher:
+    """
+    Background refresh of the episode lists of airing series
+
+    The episode cache keeps the air date of the next episode of each series,
+    with the pool its list was fetched with. Every ``interval`` seconds, the
+    series whose next episode airs within ``lead`` seconds are revalidated
+    once, so the run that follows the download of the episode finds its
+    metadata in the episode and requests caches instead of waiting on the
+    source.
+    """
+
+    def __init__(self, engine: Any, lead: float = 2 * 60 * 60, interval: float = 600):
+        self.engine = engine
+        self.lead = lead
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    @classmethod
+    def from_config(cls, engine: Any) -> Optional["Prefetcher"]:
+        """
+        Return the prefetcher configured by ``cfg["prefetch"]``, or None if it
+        or the episode cache is disabled
+        """
+        config = engine.cfg["prefetch"]
+        if not config["enabled"] or engine.episodes is None:
+            return None
+        return cls(engine, config["lead"], config["interval"])
+
+    def run_once(self, now: Optional[float] = None) -> int:
+        """
+        Revalidate the series whose next episode is due and return how many
+        were refreshed
+        """
+        engine = self.engine
+        cache = engine.episodes
+        due = cache.due(self.lead, now)
+        if not due:
+            return 0
+
+        engine._setup_requests_cache()
+        tasks: Dict[str, Any] = {task["id"]: task for task in engine.cfg["sources"]}
+        count = 0
+        for id_, series, rows, air in due:
+            task = tasks.get(id_)
+            if task is None:
+                # The source was removed from the config
+                continue
+            # Pools are bound to the thread that created them
+            pool = VariablePool(engine.cfg, id_="mediama")
+            pool.load(rows)
+            mgr = engine.src_mgr.bind(pool)
+            with mgr.tracer.span("prefetch", mgr.stage, id_, plugin=task["name"]):
+                try:
+                    source = mgr.load_task(mgr.discover_tasks()[task["name"]])
+                    mgr.fetch_revalidated(source, id_, force=True, **task["kwargs"])
+                    count += 1
+                except Exception as e:
+                    logger.warning(f"Failed to prefetch the episodes of {id_}: {e}")
+            # Failed series are not retried before their next episode, so a
+            # source that is down is not called every interval
+            cache.prefetched(id_, series, air)
+        logger.info(f"Prefetched the episodes of {count} airing series")
+        return count
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self._run, name="mediama-prefetch", daemon=True
+        )
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                self.run_once()
+            except Exception as e:
+                logger.error(f"Failed to prefetch episodes: {e}")
+            if self._stop.wait(self.interval):
+                return
+
+    def close(self):
+        """
+        Stop prefetching, waiting briefly for a refresh in progress
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(1)
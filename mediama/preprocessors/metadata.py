@@ -5,5 +5,5 @@ class Metadata(PreProcess):
     Allows the user to set metadata
     """
     def main(self, **kwargs):
-        for key, value in kwargs:
+        for key, value in kwargs.items():
             self.metadata[key] = value
@@ -0,0 +1,23 @@
+from mediama import PreProcess
+from mediama.metadata import PerFile
+from mediama.probe import ProbeCache, probe_all
+
+
+class Probe(PreProcess):
+    """
+    Read the duration, resolution, codecs and languages of every file
+
+    Only the container headers and indexes are read, across ``workers``
+    threads. Results are cached by file fingerprint in ``cache``, relative to
+    the user data directory; a falsy value disables the cache. The metadata of
+    each file is written to the ``probe`` key, scoped to the file.
+    """
+
+    def main(self, workers: int = 8, cache: str = "probe.db", **kwargs):
+        store = ProbeCache.from_path(cache)
+        try:
+            probed = probe_all(self.metadata["filepaths"], workers, store)
+            return {"probe": PerFile(probed)}
+        finally:
+            if store:
+                store.close()
@@ -0,0 +1,488 @@
+import json
+import mmap
+import sqlite3
+import struct
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from logging import getLogger
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from .state import file_fingerprint
+from .tags import (
+    EBML_SEGMENT,
+    EBML_SEEKHEAD,
+    EBML_SEEK,
+    EBML_SEEKID,
+    EBML_SEEKPOSITION,
+    Atom,
+    Element,
+    atoms,
+    children,
+    read_element,
+)
+from .utils import dirs
+
+logger = getLogger(__name__)
+
+Info = Dict[str, Any]
+
+#
+# Matroska
+#
+
+EBML_CLUSTER = 0x1F43B675
+EBML_INFO = 0x1549A966
+EBML_TIMECODESCALE = 0x2AD7B1
+EBML_DURATION = 0x4489
+EBML_TRACKS = 0x1654AE6B
+EBML_TRACKENTRY = 0xAE
+EBML_TRACKTYPE = 0x83
+EBML_CODECID = 0x86
+EBML_LANGUAGE = 0x22B59C
+EBML_LANGUAGEBCP47 = 0x22B59D
+EBML_NAME = 0x536E
+EBML_VIDEO = 0xE0
+EBML_PIXELWIDTH = 0xB0
+EBML_PIXELHEIGHT = 0xBA
+EBML_AUDIO = 0xE1
+EBML_CHANNELS = 0x9F
+EBML_SAMPLINGFREQUENCY = 0xB5
+EBML_CUES = 0x1C53BB6B
+EBML_CUEPOINT = 0xBB
+EBML_CUETIME = 0xB3
+
+TRACK_TYPES = {1: "video", 2: "audio", 17: "subtitle"}
+
+CODECS = {
+    "V_MPEG4/ISO/AVC": "h264",
+    "V_MPEGH/ISO/HEVC": "hevc",
+    "V_AV1": "av1",
+    "V_VP8": "vp8",
+    "V_VP9": "vp9",
+    "V_MPEG2": "mpeg2",
+    "A_AAC": "aac",
+    "A_AC3": "ac3",
+    "A_EAC3": "eac3",
+    "A_DTS": "dts",
+    "A_TRUEHD": "truehd",
+    "A_OPUS": "opus",
+    "A_VORBIS": "vorbis",
+    "A_FLAC": "flac",
+    "A_MPEG/L3": "mp3",
+    "S_TEXT/UTF8": "srt",
+    "S_TEXT/ASS": "ass",
+    "S_TEXT/SSA": "ssa",
+    "S_TEXT/WEBVTT": "webvtt",
+    "S_HDMV/PGS": "pgs",
+    "S_VOBSUB": "vobsub",
+    b"avc1": "h264",
+    b"avc3": "h264",
+    b"hvc1": "hevc",
+    b"hev1": "hevc",
+    b"av01": "av1",
+    b"vp09": "vp9",
+    b"mp4a": "aac",
+    b"ac-3": "ac3",
+    b"ec-3": "eac3",
+    b"Opus": "opus",
+    b"fLaC": "flac",
+    b".mp3": "mp3",
+    b"tx3g": "tx3g",
+    b"wvtt": "webvtt",
+    b"c608": "cea608",
+}
+
+
+def _uint(buf, element: Element) -> int:
+    return int.from_bytes(buf[element.data : element.end], "big")
+
+
+def _float(buf, element: Element) -> float:
+    fmt = ">f" if element.size == 4 else ">d"
+    return struct.unpack(fmt, buf[element.data : element.end])[0]
+
+
+def _string(buf, element: Element) -> str:
+    return (
+        bytes(buf[element.data : element.end]).rstrip(b"\0").decode("utf-8", "replace")
+    )
+
+
+def _top_level(buf, segment: Element, wanted: Iterable[int]) -> Dict[int, Element]:
+    """
+    Find top-level elements of the segment without reading any cluster
+
+    The elements before the first cluster are read in order and the SeekHead
+    locates the others, e.g. cues at the end of the file. Cluster headers are
+    spread over the whole file, so walking them would read most of it.
+    """
+    wanted = set(wanted)
+    end = len(buf) if segment.size is None else segment.end
+    found: Dict[int, Element] = {}
+    seekheads = []
+    pos = segment.data
+    while pos < end:
+        element = read_element(buf, pos)
+        if element.id == EBML_CLUSTER or element.size is None:
+            break
+        if element.id in wanted:
+            found.setdefault(element.id, element)
+        elif element.id == EBML_SEEKHEAD:
+            seekheads.append(element)
+        pos = element.end
+
+    for seekhead in seekheads:
+        for seek in children(buf, seekhead.data, seekhead.end):
+            if seek.id != EBML_SEEK:
+                continue
+            id_ = position = None
+            for child in children(buf, seek.data, seek.end):
+                if child.id == EBML_SEEKID:
+                    id_ = _uint(buf, child)
+                elif child.id == EBML_SEEKPOSITION:
+                    position = segment.data + _uint(buf, child)
+            if id_ in wanted and id_ not in found and position is not None:
+                if position < end:
+                    element = read_element(buf, position)
+                    if element.id == id_:
+                        found[id_] = element
+    return found
+
+
+def _matroska_track(buf, entry: Element) -> Optional[Info]:
+    # Tracks without a language are English according to the specification
+    track: Info = {"language": "eng"}
+    for child in children(buf, entry.data, entry.end):
+        if child.id == EBML_TRACKTYPE:
+            track["type"] = TRACK_TYPES.get(_uint(buf, child))
+        elif child.id == EBML_CODECID:
+            codec = _string(buf, child)
+            track["codec"] = CODECS.get(codec, codec)
+        elif child.id == EBML_LANGUAGE and "bcp47" not in track:
+            track["language"] = _string(buf, child)
+        elif child.id == EBML_LANGUAGEBCP47:
+            track["language"] = track["bcp47"] = _string(buf, child)
+        elif child.id == EBML_NAME:
+            track["name"] = _string(buf, child)
+        elif child.id == EBML_VIDEO:
+            for video in children(buf, child.data, child.end):
+                if video.id == EBML_PIXELWIDTH:
+                    track["width"] = _uint(buf, video)
+                elif video.id == EBML_PIXELHEIGHT:
+                    track["height"] = _uint(buf, video)
+        elif child.id == EBML_AUDIO:
+            for audio in children(buf, child.data, child.end):
+                if audio.id == EBML_CHANNELS:
+                    track["channels"] = _uint(buf, audio)
+                elif audio.id == EBML_SAMPLINGFREQUENCY:
+                    track["sample_rate"] = int(_float(buf, audio))
+    track.pop("bcp47", None)
+    return track if track.get("type") else None
+
+
+def probe_matroska(buf) -> Info:
+    """
+    Read the duration and tracks of a Matroska file from its headers
+    """
+    pos = 0
+    while True:
+        segment = read_element(buf, pos)
+        if segment.id == EBML_SEGMENT:
+            break
+        if segment.size is None:
+            raise ValueError("No Matroska segment found")
+        pos = segment.end
+
+    found = _top_level(buf, segment, (EBML_INFO, EBML_TRACKS, EBML_CUES))
+    info: Info = {"container": "matroska", "duration": None, "tracks": []}
+
+    scale = 1000000
+    duration = None
+    if EBML_INFO in found:
+        element = found[EBML_INFO]
+        for child in children(buf, element.data, element.end):
+            if child.id == EBML_TIMECODESCALE:
+                scale = _uint(buf, child)
+            elif child.id == EBML_DURATION:
+                duration = _float(buf, child)
+    if duration is None and EBML_CUES in found:
+        # Fall back to the time of the last cue point
+        element = found[EBML_CUES]
+        cues = children(buf, element.data, element.end)
+        for cue in reversed(cues):
+            if cue.id != EBML_CUEPOINT:
+                continue
+            times = [
+                c for c in children(buf, cue.data, cue.end) if c.id == EBML_CUETIME
+            ]
+            if times:
+                duration = _uint(buf, times[0])
+                break
+    if duration is not None:
+        info["duration"] = round(duration * scale / 1e9, 3)
+
+    if EBML_TRACKS in found:
+        element = found[EBML_TRACKS]
+        for entry in children(buf, element.data, element.end):
+            if entry.id == EBML_TRACKENTRY:
+                track = _matroska_track(buf, entry)
+                if track:
+                    info["tracks"].append(track)
+    return info
+
+
+#
+# MP4
+#
+
+HANDLERS = {
+    b"vide": "video",
+    b"soun": "audio",
+    b"subt": "subtitle",
+    b"text": "subtitle",
+    b"sbtl": "subtitle",
+    b"clcp": "subtitle",
+}
+
+
+def _child(buf, parent: Atom, type_: bytes, skip: int = 0) -> Optional[Atom]:
+    return next(
+        (a for a in atoms(buf, parent.data + skip, parent.end) if a.type == type_),
+        None,
+    )
+
+
+def _path(buf, parent: Optional[Atom], *types: bytes) -> Optional[Atom]:
+    for type_ in types:
+        if parent is None:
+            return None
+        parent = _child(buf, parent, type_)
+    return parent
+
+
+def _timing(buf, header: Atom) -> Tuple[int, int, int]:
+    """
+    Return the timescale and duration of a mvhd or mdhd atom and the offset
+    of the fields that follow them
+    """
+    pos = header.data
+    if buf[pos] == 1:
+        timescale, duration = struct.unpack_from(">IQ", buf, pos + 20)
+        return timescale, duration, pos + 32
+    timescale, duration = struct.unpack_from(">II", buf, pos + 12)
+    return timescale, duration, pos + 20
+
+
+def _language(code: int) -> str:
+    if not code or code == 0x7FFF:
+        return "und"
+    return "".join(chr(((code >> shift) & 0x1F) + 0x60) for shift in (10, 5, 0))
+
+
+def _mp4_track(buf, trak: Atom) -> Optional[Info]:
+    hdlr = _path(buf, trak, b"mdia", b"hdlr")
+    if hdlr is None:
+        return None
+    handler = bytes(buf[hdlr.data + 8 : hdlr.data + 12])
+    track: Info = {"type": HANDLERS.get(handler)}
+    if not track["type"]:
+        return None
+
+    mdhd = _path(buf, trak, b"mdia", b"mdhd")
+    if mdhd is not None:
+        _, _, pos = _timing(buf, mdhd)
+        track["language"] = _language(struct.unpack_from(">H", buf, pos)[0])
+
+    stsd = _path(buf, trak, b"mdia", b"minf", b"stbl", b"stsd")
+    if stsd is not None:
+        # Skip the version, flags and entry count
+        entries = atoms(buf, stsd.data + 8, stsd.end)
+        if entries:
+            entry = entries[0]
+            track["codec"] = CODECS.get(entry.type, entry.type.decode("latin-1"))
+            if track["type"] == "video":
+                width, height = struct.unpack_from(">HH", buf, entry.pos + 32)
+                track["width"], track["height"] = width, height
+            elif track["type"] == "audio":
+                channels = struct.unpack_from(">H", buf, entry.pos + 24)[0]
+                rate = struct.unpack_from(">I", buf, entry.pos + 32)[0] >> 16
+                track["channels"], track["sample_rate"] = channels, rate
+    return track
+
+
+def probe_mp4(buf) -> Info:
+    """
+    Read the duration and tracks of an MP4 file from its moov atom
+    """
+    moov = next((a for a in atoms(buf, 0, len(buf)) if a.type == b"moov"), None)
+    if moov is None:
+        raise ValueError("No moov atom found")
+
+    info: Info = {"container": "mp4", "duration": None, "tracks": []}
+    mvhd = _child(buf, moov, b"mvhd")
+    if mvhd is not None:
+        timescale, duration, _ = _timing(buf, mvhd)
+        if timescale:
+            info["duration"] = round(duration / timescale, 3)
+    for trak in atoms(buf, moov.data, moov.end):
+        if trak.type == b"trak":
+            track = _mp4_track(buf, trak)
+            if track:
+                info["tracks"].append(track)
+    return info
+
+
+PROBES = {
+    ".mkv": probe_matroska,
+    ".mka": probe_matroska,
+    ".mks": probe_matroska,
+    ".webm": probe_matroska,
+    ".mp4": probe_mp4,
+    ".m4v": probe_mp4,
+    ".m4a": probe_mp4,
+    ".mov": probe_mp4,
+}
+
+
+def summarize(info: Info) -> Info:
+    """
+    Add the fields used for matching and naming, e.g. the resolution and the
+    audio languages, to the probed tracks
+    """
+    tracks = info["tracks"]
+    video = next((track for track in tracks if track["type"] == "video"), {})
+    audio = [track for track in tracks if track["type"] == "audio"]
+    subtitles = [track for track in tracks if track["type"] == "subtitle"]
+    height = video.get("height")
+    return {
+        **info,
+        "width": video.get("width"),
+        "height": height,
+        "resolution": f"{height}p" if height else None,
+        "video_codec": video.get("codec"),
+        "audio_codecs": [track.get("codec") for track in audio],
+        "audio_languages": [track.get("language", "und") for track in audio],
+        "subtitle_languages": [track.get("language", "und") for track in subtitles],
+    }
+
+
+def probe(path: Path) -> Info:
+    """
+    Read the technical metadata of a media file from its headers only
+
+    The file is memory mapped, so only the pages that hold the headers and
+    indexes are read, which matters on network filesystems.
+
+    :raises ValueError: if the container is not supported or is malformed
+    """
+    try:
+        probe_ = PROBES[Path(path).suffix.lower()]
+    except KeyError:
+        raise ValueError(f"Unsupported container: {path}")
+    with open(path, "rb") as f:
+        try:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            raise ValueError(f"{path} is empty")
+        try:
+            return summarize(probe_(buf))
+        except (IndexError, struct.error) as e:
+            raise ValueError(f"{path} is malformed: {e}")
+        finally:
+            buf.close()
+
+
+class ProbeCache:
+    """
+    Probe results keyed by file fingerprint
+
+    Since the fingerprint does not include the path, results survive renames.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.conn = sqlite3.connect(str(path), check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self.conn:
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS probe (
+                    fingerprint TEXT PRIMARY KEY,
+                    info TEXT NOT NULL)
+                """)
+
+    @classmethod
+    def from_path(cls, path: Optional[str]) -> Optional["ProbeCache"]:
+        """
+        Open the cache at a path relative to the user data directory, or
+        return None if the path is falsy
+        """
+        if not path:
+            return None
+        path_ = Path(path)
+        if not path_.is_absolute():
+            path_ = Path(dirs.user_data_dir) / path_
+        return cls(path_)
+
+    def get_many(self, fingerprints: List[str]) -> Dict[str, Info]:
+        result = {}
+        with self._lock:
+            # Stay below the sqlite variable limit
+            for i in range(0, len(fingerprints), 500):
+                chunk = fingerprints[i : i + 500]
+                rows = self.conn.execute(
+                    "SELECT fingerprint, info FROM probe WHERE fingerprint IN "
+                    f"({', '.join('?' * len(chunk))})",
+                    chunk,
+                )
+                result.update((fp, json.loads(info)) for fp, info in rows)
+        return result
+
+    def set_many(self, results: Dict[str, Info]):
+        with self._lock, self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO probe VALUES (?, ?)",
+                [(fp, json.dumps(info)) for fp, info in results.items()],
+            )
+
+    def close(self):
+        self.conn.close()
+
+
+def probe_all(
+    paths: Iterable[Path], workers: int = 8, cache: Optional[ProbeCache] = None
+) -> Dict[Path, Info]:
+    """
+    Probe many files in parallel, skipping those that are cached
+
+    Files that cannot be probed are logged and left out.
+    """
+    fingerprints = {}
+    for path in map(Path, paths):
+        try:
+            fingerprints[path] = file_fingerprint(path)
+        except OSError as e:
+            logger.warning(f"Cannot probe {path}: {e}")
+
+    cached = cache.get_many(list(fingerprints.values())) if cache else {}
+    results = {path: cached[fp] for path, fp in fingerprints.items() if fp in cached}
+    pending = [path for path in fingerprints if path not in results]
+
+    def probe_(path: Path) -> Optional[Info]:
+        try:
+            return probe(path)
+        except (OSError, ValueError) as e:
+            logger.debug(f"Cannot probe {path}: {e}")
+            return None
+
+    with ThreadPoolExecutor(workers) as executor:
+        probed = {
+            path: info
+            for path, info in zip(pending, executor.map(probe_, pending))
+            if info is not None
+        }
+    if cache and probed:
+        cache.set_many({fingerprints[path]: info for path, info in probed.items()})
+    results.update(probed)
+    return results
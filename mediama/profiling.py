@@ -0,0 +1,321 @@
+import io
+import sys
+import time
+import threading
+import tracemalloc
+from contextlib import contextmanager
+from logging import getLogger
+from pathlib import Path
+from typing import Any, Dict, Generator, Iterator, Optional
+
+from .trace import current_span
+
+logger = getLogger(__name__)
+
+ACTIONS = ("warn", "cancel")
+# Budget settings and the stat each one limits
+LIMITS = {"wall": "wall", "cpu": "cpu", "memory": "memory_peak"}
+# Counters of the current span that are attributed to the plugin
+NETWORK_COUNTERS = ("requests", "bytes")
+# Held while a function profile is enabled. Since Python 3.12 only one can be
+# enabled at a time in the whole process, not per thread
+_cprofile_lock = threading.Lock()
+
+
+def _reset_peak() -> int:
+    """
+    Reset the peak of the traced memory and return the memory traced now
+    """
+    if hasattr(tracemalloc, "reset_peak"):
+        tracemalloc.reset_peak()
+        return tracemalloc.get_traced_memory()[0]
+    # Before Python 3.9, the peak is only reset by restarting the trace, which
+    # forgets the memory allocated so far
+    tracemalloc.stop()
+    tracemalloc.start()
+    return 0
+
+
+class Usage:
+    """
+    The cost of a plugin across a batch
+    """
+
+    __slots__ = (
+        "calls",
+        "wall",
+        "cpu",
+        "memory_peak",
+        "requests",
+        "bytes",
+        "errors",
+        "over_budget",
+    )
+
+    def __init__(self):
+        self.calls = 0
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.memory_peak = 0
+        self.requests = 0
+        self.bytes = 0
+        self.errors = 0
+        self.over_budget = 0
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {key: getattr(self, key) for key in self.__slots__}
+
+
+class Profiler:
+    """
+    Account the wall time, CPU time, memory and network use of every plugin
+
+    Costs are summed per task id until ``reset``, e.g. once per batch. The
+    CPU time is that of the thread, so sources that run concurrently in
+    greenlets are also charged for each other's CPU time while they overlap;
+    the same goes for memory.
+
+    :param cprofile: also profile the functions called by each plugin
+    :param memory: trace the peak memory allocated by each call
+    :param budgets: limits of a call by task id, or ``*`` for every task,
+        e.g. ``{"src_0": {"wall": 10, "memory": 200, "action": "cancel"}}``
+        where memory is in MB. Plugins over budget are logged, or fail if the
+        action is ``cancel``.
+    :raises ValueError: if a budget is invalid
+    """
+
+    def __init__(
+        self,
+        cprofile: bool = False,
+        memory: bool = False,
+        budgets: Optional[Dict[str, Dict[str, Any]]] = None,
+    ):
+        self.cprofile = cprofile
+        self.memory = memory
+        self.budgets = budgets or {}
+        for id_, budget in self.budgets.items():
+            unknown = set(budget) - set(LIMITS) - {"action"}
+            if unknown:
+                raise ValueError(f"Unknown budget of {id_}: {', '.join(unknown)}")
+            if budget.get("action", "warn") not in ACTIONS:
+                raise ValueError(f"Unknown budget action of {id_}: {budget['action']}")
+        if memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+        self._lock = threading.Lock()
+        self.usage: Dict[str, Usage] = {}
+        self.profiles: Dict[str, Any] = {}
+
+    @classmethod
+    def from_config(cls, config: Dict[str, Any]) -> Optional["Profiler"]:
+        """
+        Return the profiler of the profile settings, or None if there is
+        nothing to measure
+        """
+        budgets = config["budgets"]
+        if not config["enabled"] and not budgets:
+            return None
+        # Memory budgets need the memory to be traced
+        memory = any("memory" in budget for budget in budgets.values())
+        return cls(
+            config["enabled"] and config["cprofile"],
+            (config["enabled"] and config["memory"]) or memory,
+            budgets,
+        )
+
+    def reset(self):
+        with self._lock:
+            self.usage = {}
+            self.profiles = {}
+
+    def _budget(self, id_: str) -> Dict[str, Any]:
+        return self.budgets.get(id_) or self.budgets.get("*") or {}
+
+    @contextmanager
+    def _profile(self, id_: str) -> Generator[None, None, None]:
+        # Only one profiler can be active at a time, so calls that overlap with
+        # another profiled call, e.g. in another job of the server, are only
+        # accounted, not profiled
+        if not self.cprofile or not _cprofile_lock.acquire(blocking=False):
+            yield
+            return
+        try:
+            import cProfile
+
+            with self._lock:
+                profile = self.profiles.setdefault(id_, cProfile.Profile())
+            try:
+                profile.enable()
+            except ValueError as e:
+                # Another profiling tool is active, e.g. a debugger
+                logger.debug(f"Not profiling {id_}: {e}")
+                yield
+                return
+            try:
+                yield
+            finally:
+                profile.disable()
+        finally:
+            _cprofile_lock.release()
+
+    @contextmanager
+    def measure(self, id_: str) -> Generator[None, None, None]:
+        """
+        Account a call of the plugin of the task id
+        """
+        span = current_span()
+        before = (
+            {key: span.counters.get(key, 0) for key in NETWORK_COUNTERS} if span else {}
+        )
+        memory = 0
+        if self.memory:
+            memory = _reset_peak()
+        wall = time.perf_counter()
+        cpu = time.thread_time()
+        error = False
+        try:
+            with self._profile(id_):
+                yield
+        except Exception:
+            error = True
+            raise
+        finally:
+            cost = {
+                "wall": time.perf_counter() - wall,
+                "cpu": time.thread_time() - cpu,
+                "memory_peak": (
+                    tracemalloc.get_traced_memory()[1] - memory if self.memory else 0
+                ),
+            }
+            with self._lock:
+                usage = self.usage.setdefault(id_, Usage())
+                usage.calls += 1
+                usage.wall += cost["wall"]
+                usage.cpu += cost["cpu"]
+                usage.memory_peak = max(usage.memory_peak, cost["memory_peak"])
+                usage.errors += error
+                for key, value in before.items():
+                    setattr(
+                        usage,
+                        key,
+                        getattr(usage, key) + span.counters.get(key, 0) - value,
+                    )
+        if not error:
+            self._check(id_, cost)
+
+    def _check(self, id_: str, cost: Dict[str, float]):
+        budget = self._budget(id_)
+        exceeded = []
+        for limit, stat in LIMITS.items():
+            if limit not in budget:
+                continue
+            value = cost[stat] / 2**20 if limit == "memory" else cost[stat]
+            if value > budget[limit]:
+                exceeded.append(f"{limit} {value:.3g} > {budget[limit]}")
+        if not exceeded:
+            return
+        with self._lock:
+            self.usage[id_].over_budget += 1
+        message = f"{id_} exceeded its budget: {', '.join(exceeded)}"
+        if budget.get("action", "warn") == "cancel":
+            raise RuntimeError(message)
+        logger.warning(message)
+
+    def call(self, id_: str, func: Any, **kwargs: Any) -> Any:
+        """
+        Call a task method and account it, along with the pages it yields if
+        it returns a generator
+        """
+        budget = self._budget(id_)
+        with self._timeout(budget):
+            with self.measure(id_):
+                result = func(**kwargs)
+        if isinstance(result, Iterator) and hasattr(result, "send"):
+            return self.iterate(id_, result)
+        return result
+
+    def iterate(self, id_: str, pages: Iterator) -> Generator[Any, None, None]:
+        """
+        Account the work done to produce each page of a generator
+
+        A plugin that goes over a budget that cancels is stopped before its
+        next page.
+        """
+        budget = self._budget(id_)
+        try:
+            while True:
+                with self._timeout(budget):
+                    with self.measure(id_):
+                        try:
+                            page = next(pages)
+                        except StopIteration:
+                            return
+                yield page
+        finally:
+            close = getattr(pages, "close", None)
+            if close:
+                close()
+
+    @contextmanager
+    def _timeout(self, budget: Dict[str, Any]) -> Generator[None, None, None]:
+        """
+        Interrupt a call that exceeds a wall budget that cancels
+
+        Only calls that wait on gevent, such as the requests of sources, can
+        be interrupted; other calls fail once they return.
+        """
+        gevent = sys.modules.get("gevent")
+        if gevent is None or budget.get("action") != "cancel" or "wall" not in budget:
+            yield
+            return
+        error = TimeoutError(f"exceeded the wall budget of {budget['wall']}s")
+        with gevent.Timeout(budget["wall"], error):
+            yield
+
+    def report(self, top: int = 10) -> str:
+        """
+        Return a table of the plugins that cost the most wall time
+        """
+        with self._lock:
+            usage = sorted(self.usage.items(), key=lambda item: -item[1].wall)[:top]
+            profiles = dict(self.profiles)
+        lines = [
+            f"{'task':<20} {'calls':>6} {'wall s':>9} {'cpu s':>9} "
+            f"{'peak MB':>8} {'requests':>8} {'KB':>9} {'errors':>6} {'over':>5}"
+        ]
+        for id_, u in usage:
+            lines.append(
+                f"{id_:<20} {u.calls:>6} {u.wall:>9.3f} {u.cpu:>9.3f} "
+                f"{u.memory_peak / 2 ** 20:>8.1f} {u.requests:>8} "
+                f"{u.bytes / 1024:>9.1f} {u.errors:>6} {u.over_budget:>5}"
+            )
+        for id_, _ in usage[:3]:
+            if id_ in profiles:
+                lines.append(f"\nTop functions of {id_}:")
+                lines.append(self._functions(profiles[id_]))
+        return "\n".join(lines)
+
+    @staticmethod
+    def _functions(profile: Any, limit: int = 10) -> str:
+        import pstats
+
+        out = io.StringIO()
+        stats = pstats.Stats(profile, stream=out)
+        stats.sort_stats("cumulative").print_stats(limit)
+        return out.getvalue().strip()
+
+    def dump(self, folder: Path):
+        """
+        Write the function profile of each plugin to ``<task id>.prof``, which
+        can be read with pstats or snakeviz
+        """
+        folder = Path(folder)
+        folder.mkdir(parents=True, exist_ok=True)
+        with self._lock:
+            profiles = dict(self.profiles)
+        for id_, profile in profiles.items():
+            profile.dump_stats(str(folder / f"{id_}.prof"))
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        with self._lock:
+            return {id_: usage.to_dict() for id_, usage in self.usage.items()}
@@ -0,0 +1,266 @@
+import os
+import json
+import shutil
+import threading
+from concurrent.futures import Executor, ThreadPoolExecutor, Future, wait
+from logging import getLogger
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple
+
+logger = getLogger(__name__)
+
+Move = Tuple[Path, Path]
+
+CHUNK_SIZE = 64 * 2**20
+PART_SUFFIX = ".mediama-part"
+TMP_SUFFIX = ".mediama-tmp"
+
+
+def plan_moves(moves: Iterable[Tuple[Path, Path]]) -> List[List[Move]]:
+    """
+    Validate a batch of moves and order them into steps
+
+    The moves within a step are independent of each other and can be executed
+    in parallel. A move is only scheduled once its destination is no longer
+    the source of a pending move. Cycles, e.g. swapping two files, are broken
+    by moving one file to a temporary name first.
+
+    :raises ValueError: if the moves collide with each other or with files
+        that are not part of the batch
+    """
+    pending: Dict[Path, Path] = {}
+    for src, dst in moves:
+        src, dst = Path(src), Path(dst)
+        if src in pending and pending[src] != dst:
+            raise ValueError(f"{src} is moved to both {pending[src]} and {dst}")
+        if src != dst:
+            pending[src] = dst
+
+    owners: Dict[Path, Path] = {}
+    for src, dst in pending.items():
+        if dst in owners:
+            raise ValueError(f"{owners[dst]} and {src} are both moved to {dst}")
+        owners[dst] = src
+        if not src.exists():
+            raise FileNotFoundError(f"{src} does not exist")
+        # Renaming a file to a different case of its own name is allowed
+        if dst.exists() and dst not in pending and not os.path.samefile(src, dst):
+            raise ValueError(f"{dst} already exists")
+
+    steps = []
+    while pending:
+        ready = [(src, dst) for src, dst in pending.items() if dst not in pending]
+        if not ready:
+            # Every remaining move is part of a cycle
+            src, dst = next(iter(pending.items()))
+            tmp = src.with_name(f".{src.name}{TMP_SUFFIX}")
+            steps.append([(src, tmp)])
+            del pending[src]
+            pending[tmp] = dst
+            continue
+        for src, _ in ready:
+            del pending[src]
+        steps.append(ready)
+    return steps
+
+
+def same_filesystem(src: Path, dst: Path) -> bool:
+    """
+    Return whether a file can be renamed from src to dst
+    """
+    parent = dst.parent
+    while not parent.exists():
+        parent = parent.parent
+    return os.stat(src).st_dev == os.stat(parent).st_dev
+
+
+class Journal:
+    """
+    Append-only record of the completed moves, used for rolling back
+
+    Each line is a JSON object ``{"op": ..., "src": ..., "dst": ...}`` where
+    the op is either ``rename`` or ``copy``.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._file = open(path, "a")
+        self._lock = threading.Lock()
+
+    def record(self, op: str, src: Path, dst: Path):
+        with self._lock:
+            self._file.write(json.dumps({"op": op, "src": str(src), "dst": str(dst)}))
+            self._file.write("\n")
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def close(self):
+        self._file.close()
+
+    def remove(self):
+        self.close()
+        self.path.unlink()
+
+
+def _copy_range(src: Path, dst: Path, offset: int, length: int):
+    """
+    Copy a range of src to the same offset of dst in the kernel if possible
+    """
+    fd_in = os.open(src, os.O_RDONLY)
+    try:
+        fd_out = os.open(dst, os.O_WRONLY)
+        try:
+            end = offset + length
+            try:
+                while offset < end:
+                    n = os.copy_file_range(fd_in, fd_out, end - offset, offset, offset)
+                    if not n:
+                        return
+                    offset += n
+                return
+            except (AttributeError, OSError):
+                # Not supported by the platform, kernel or filesystems
+                pass
+            os.lseek(fd_out, offset, os.SEEK_SET)
+            try:
+                while offset < end:
+                    n = os.sendfile(fd_out, fd_in, offset, end - offset)
+                    if not n:
+                        return
+                    offset += n
+                return
+            except (AttributeError, OSError):
+                pass
+            while offset < end:
+                data = os.pread(fd_in, min(end - offset, CHUNK_SIZE), offset)
+                if not data:
+                    return
+                offset += os.pwrite(fd_out, data, offset)
+        finally:
+            os.close(fd_out)
+    finally:
+        os.close(fd_in)
+
+
+def _copy_chunks(
+    src: Path, dst: Path, executor: Optional[Executor], chunk_size: int
+) -> List[Future]:
+    """
+    Preallocate dst and copy src into it in chunks
+
+    If an executor is given, the chunks are submitted to it and their futures
+    are returned; otherwise, the chunks are copied before returning.
+    """
+    size = src.stat().st_size
+    with open(dst, "wb") as f:
+        f.truncate(size)
+    ranges = [
+        (offset, min(chunk_size, size - offset))
+        for offset in range(0, size, chunk_size)
+    ]
+    if executor is None:
+        for offset, length in ranges:
+            _copy_range(src, dst, offset, length)
+        return []
+    return [executor.submit(_copy_range, src, dst, *range_) for range_ in ranges]
+
+
+def copy_file(src: Path, dst: Path, chunk_size: int = CHUNK_SIZE):
+    """
+    Copy a file and its metadata, replacing dst atomically
+    """
+    part = dst.with_name(f".{dst.name}{PART_SUFFIX}")
+    try:
+        _copy_chunks(src, part, None, chunk_size)
+        shutil.copystat(src, part)
+        os.replace(part, dst)
+    except BaseException:
+        part.unlink(missing_ok=True)
+        raise
+
+
+def _execute_step(
+    step: List[Move], executor: Executor, chunk_size: int, journal: Journal
+):
+    for src, dst in step:
+        dst.parent.mkdir(parents=True, exist_ok=True)
+    renames = [(src, dst) for src, dst in step if same_filesystem(src, dst)]
+    copies = [
+        (src, dst, dst.with_name(f".{dst.name}{PART_SUFFIX}"))
+        for src, dst in step
+        if (src, dst) not in renames
+    ]
+    for src, _, _ in copies:
+        if src.is_dir():
+            raise ValueError(f"Cannot move the folder {src} across filesystems")
+
+    futures = [executor.submit(_rename, src, dst, journal) for src, dst in renames]
+    for src, _, part in copies:
+        futures.extend(_copy_chunks(src, part, executor, chunk_size))
+
+    try:
+        wait(futures)
+        for future in futures:
+            future.result()
+    except BaseException:
+        for _, _, part in copies:
+            part.unlink(missing_ok=True)
+        raise
+
+    for src, dst, part in copies:
+        shutil.copystat(src, part)
+        os.replace(part, dst)
+        journal.record("copy", src, dst)
+        os.unlink(src)
+
+
+def _rename(src: Path, dst: Path, journal: Journal):
+    os.rename(src, dst)
+    journal.record("rename", src, dst)
+
+
+def execute_moves(
+    steps: List[List[Move]],
+    journal: Path,
+    workers: int = 8,
+    chunk_size: int = CHUNK_SIZE,
+):
+    """
+    Execute planned moves, rolling every move back if any of them fails
+
+    Moves within a filesystem are renamed. Moves across filesystems are copied
+    in chunks in parallel, in the kernel where possible, then the source is
+    removed. The journal is removed once every move succeeds.
+    """
+    log = Journal(journal)
+    try:
+        with ThreadPoolExecutor(workers) as executor:
+            for step in steps:
+                _execute_step(step, executor, chunk_size, log)
+    except BaseException as e:
+        logger.error(f"Failed to move files, rolling back: {e}")
+        log.close()
+        rollback(journal)
+        raise
+    log.remove()
+
+
+def rollback(journal: Path):
+    """
+    Undo the moves recorded in a journal, most recent first
+
+    The journal is removed once every move is undone.
+    """
+    with open(journal) as f:
+        entries = [json.loads(line) for line in f if line.strip()]
+
+    for entry in reversed(entries):
+        src, dst = Path(entry["src"]), Path(entry["dst"])
+        logger.debug(f"Undoing {entry['op']} of {src} to {dst}")
+        if entry["op"] == "rename":
+            os.rename(dst, src)
+        else:
+            copy_file(dst, src)
+            os.unlink(dst)
+    journal.unlink()
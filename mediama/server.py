@@ -0,0 +1,338 @@
+import json
+import queue
+import threading
+import uuid
+import urllib.request
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from logging import getLogger
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from .config import ConfigReloader, NormalizedConfig
+from .trace import Metrics, send_metrics
+from .decisions import Decisions
+
+logger = getLogger(__name__)
+
+
+class Job:
+    """
+    A list of files submitted to the server, or the answer to a decision
+
+    :param decision: the id of a parked decision and the answer that resumes
+        its run
+    """
+
+    def __init__(self, files: List[Path], decision: Optional[Tuple[str, Any]] = None):
+        self.id = uuid.uuid4().hex
+        self.files = files
+        self.decision = decision
+        self.status = "queued"
+        self.result: Optional[Dict[str, Any]] = None
+        self.error: Optional[str] = None
+        self.done = threading.Event()
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "id": self.id,
+            "files": [str(file) for file in self.files],
+            "status": self.status,
+            "result": self.result,
+            "error": self.error,
+        }
+
+
+class JobQueue:
+    """
+    Bounded queue of jobs that are executed concurrently on a shared engine
+
+    Submitting to a full queue raises ``queue.Full`` so that clients are
+    pushed back instead of piling up work. Only the most recent ``history``
+    jobs are remembered.
+    """
+
+    def __init__(
+        self,
+        engine,
+        workers: int = 4,
+        size: int = 64,
+        history: int = 1000,
+        reload: Optional[Callable[[], Any]] = None,
+    ):
+        self.engine = engine
+        self.reload = reload
+        self.history = history
+        self._queue: queue.Queue = queue.Queue(maxsize=size)
+        self._jobs: "OrderedDict[str, Job]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._workers = [
+            threading.Thread(target=self._work, name=f"mediama-worker-{i}", daemon=True)
+            for i in range(workers)
+        ]
+        for worker in self._workers:
+            worker.start()
+
+    def submit(
+        self, files: List[Path], decision: Optional[Tuple[str, Any]] = None
+    ) -> Job:
+        job = Job(files, decision)
+        with self._lock:
+            self._jobs[job.id] = job
+            try:
+                self._queue.put_nowait(job)
+            except queue.Full:
+                del self._jobs[job.id]
+                raise
+            while len(self._jobs) > self.history:
+                self._jobs.popitem(last=False)
+        return job
+
+    def get(self, id_: str) -> Job:
+        with self._lock:
+            return self._jobs[id_]
+
+    def resolve(self, id_: str, choice: Any) -> Job:
+        """
+        Submit a job that resumes the run of a parked decision
+
+        :raises KeyError: if there is no pending decision with the id
+        :raises ValueError: if the answer is invalid
+        """
+        decision = self.engine.decisions.get(id_)
+        decision.check(choice)
+        return self.submit(decision.files, (id_, choice))
+
+    def qsize(self) -> int:
+        return self._queue.qsize()
+
+    def _engine(self):
+        """
+        Return the engine for the next job, replacing it first if reload
+        returns a new one
+        """
+        if self.reload:
+            with self._lock:
+                engine = self.reload()
+                if engine is not None:
+                    self.engine.close()
+                    self.engine = engine
+        return self.engine
+
+    def _work(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+            job.status = "running"
+            try:
+                engine = self._engine()
+                if job.decision:
+                    varpool = engine.resolve(*job.decision)
+                else:
+                    varpool = engine.run(job.files)
+                job.result = result(varpool, engine.decisions, job.files)
+                job.status = "done"
+                engine.save_trace()
+                report = engine.report_profile()
+                if report:
+                    logger.info(f"Plugin costs up to job {job.id}:\n{report}")
+            except Exception as e:
+                logger.error(f"Job {job.id} failed: {e}")
+                job.error = str(e)
+                job.status = "failed"
+            finally:
+                job.done.set()
+
+    def close(self):
+        for _ in self._workers:
+            self._queue.put(None)
+        for worker in self._workers:
+            worker.join()
+        self.engine.close()
+
+
+def result(
+    varpool, decisions: Optional[Decisions] = None, files: List[Path] = ()
+) -> Dict[str, Any]:
+    """
+    Return the JSON-serializable result of a run
+
+    The ids of the decisions that are pending for some of the files, if any,
+    are listed under ``parked``.
+    """
+    files = {Path(file) for file in files}
+    parked = [
+        decision.id
+        for decision in (decisions.pending() if decisions else [])
+        if files.intersection(decision.files)
+    ]
+    if varpool is None:
+        data: Dict[str, Any] = {"skipped": not parked, "episodes": {}}
+    else:
+        episodes = varpool.files("episodes", "mediama")
+        data = {
+            "skipped": False,
+            "episodes": {str(path): data for path, data in episodes.items()},
+        }
+    if parked:
+        data["parked"] = parked
+    return data
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    """
+    HTTP API of the server
+
+    - ``POST /jobs`` submits ``{"files": [...], "wait": false}``
+    - ``GET /jobs/<id>`` returns the status and result of a job
+    - ``GET /health`` returns the state of the queue and of the sources
+    - ``GET /metrics`` returns the span metrics, if enabled
+    - ``GET /decisions`` lists the choices left to the user
+    - ``POST /decisions/<id>`` answers a choice with ``{"choice": ...}`` and
+      resumes its run as a job, which accepts ``"wait"`` as well
+    """
+
+    server: "Server"
+
+    def _send(self, status: int, body: Any):
+        data = json.dumps(body, default=str).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        jobs = self.server.jobs
+        if self.path == "/health":
+            body = {"status": "ok", "queued": jobs.qsize()}
+            health = jobs.engine.health
+            if health is not None:
+                body["sources"] = health.stats()
+            self._send(200, body)
+        elif self.path == "/metrics" and self.server.metrics is not None:
+            send_metrics(self, self.server.metrics)
+        elif self.path.startswith("/jobs/"):
+            try:
+                job = jobs.get(self.path[len("/jobs/") :])
+            except KeyError:
+                self._send(404, {"error": "Job not found"})
+                return
+            self._send(200, job.to_dict())
+        elif self.path == "/decisions":
+            decisions = jobs.engine.decisions.pending()
+            self._send(200, [decision.to_dict() for decision in decisions])
+        else:
+            self._send(404, {"error": "Not found"})
+
+    def do_POST(self):
+        if self.path != "/jobs" and not self.path.startswith("/decisions/"):
+            self._send(404, {"error": "Not found"})
+            return
+
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            body = json.loads(self.rfile.read(length) or b"{}")
+            if self.path == "/jobs":
+                files = [Path(file) for file in body["files"]]
+            else:
+                choice = body["choice"]
+        except (ValueError, KeyError, TypeError) as e:
+            self._send(400, {"error": f"Invalid request: {e}"})
+            return
+
+        try:
+            if self.path == "/jobs":
+                job = self.server.jobs.submit(files)
+            else:
+                job = self.server.jobs.resolve(self.path[len("/decisions/") :], choice)
+        except queue.Full:
+            self._send(503, {"error": "Job queue is full"})
+            return
+        except KeyError:
+            self._send(404, {"error": "Decision not found"})
+            return
+        except ValueError as e:
+            self._send(400, {"error": f"Invalid choice: {e}"})
+            return
+
+        if body.get("wait"):
+            job.done.wait()
+            self._send(200, job.to_dict())
+        else:
+            self._send(202, job.to_dict())
+
+    def log_message(self, format, *args):
+        logger.debug(f"{self.address_string()} {format % args}")
+
+
+class Server(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, jobs: JobQueue, metrics: Optional[Metrics] = None):
+        super().__init__(address, RequestHandler)
+        self.jobs = jobs
+        self.metrics = metrics
+
+
+def run_server(cfg: NormalizedConfig, config_path: Optional[Path] = None):
+    """
+    Serve the pipeline over a local HTTP API
+
+    The engine is set up once so every job shares the discovered plugins, the
+    requests cache and the run state. It is set up again for the next job
+    whenever the config file at config_path changes.
+    """
+    from .core import Engine, configure_logger
+
+    config = cfg["server"]  # type: ignore[typeddict-item]
+    metrics = Metrics() if config["metrics"] else None
+    decisions = Decisions()
+    engine = Engine(cfg, metrics, decisions)
+    engine.start_prefetch()
+
+    reload: Optional[Callable[[], Any]] = None
+    if config_path:
+        reloader = ConfigReloader(config_path, cfg)
+
+        def reload_engine():
+            new = reloader.poll()
+            if new is None:
+                return None
+            configure_logger(new)
+            if new["server"] != config:  # type: ignore[typeddict-item]
+                logger.warning("Restart the server to apply server settings")
+            engine = Engine(new, metrics, decisions)
+            engine.start_prefetch()
+            return engine
+
+        reload = reload_engine
+
+    jobs = JobQueue(
+        engine, config["workers"], config["queue_size"], config["history"], reload
+    )
+    server = Server((config["host"], config["port"]), jobs, metrics)
+
+    logger.info(f"Serving on http://{config['host']}:{config['port']}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logger.info("Stopping server")
+    finally:
+        server.server_close()
+        jobs.close()
+
+
+def submit(files: List[Path], url: str, wait: bool = True) -> Dict[str, Any]:
+    """
+    Submit files to a running server and return the job
+    """
+    data = json.dumps({"files": [str(file) for file in files], "wait": wait})
+    request = urllib.request.Request(
+        f"{url.rstrip('/')}/jobs",
+        data=data.encode(),
+        headers={"Content-Type": "application/json"},
+    )
+    with urllib.request.urlopen(request) as response:
+        return json.loads(response.read())
@@ -0,0 +1,237 @@
+import sqlite3
+import pickle
+import json
+import hashlib
+import inspect
+import sys
+import time
+import threading
+from logging import getLogger
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional, Tuple, Type
+
+from .config import NormalizedConfig
+from .utils import dirs
+
+logger = getLogger(__name__)
+
+# Stages in execution order. Each stage depends on every stage before it.
+STAGES = ("pres", "sources", "posts")
+
+# The config settings that affect each stage aside from the task list itself
+STAGE_SETTINGS = {
+    "pres": ("pres",),
+    "sources": ("sources", "key_sources", "aliases", "limit", "ranks"),
+    "posts": ("posts",),
+}
+
+Fingerprints = Dict[str, str]
+# (id, key, value) rows of a pool, with the file last for file-scoped values
+Rows = List[Tuple[Any, ...]]
+
+
+def file_fingerprint(path: Path) -> str:
+    """
+    Fingerprint a file using its stat results so the contents are never read
+    """
+    st = Path(path).stat()
+    return f"{st.st_size}:{st.st_mtime_ns}:{st.st_ino}"
+
+
+def plugin_version(task: Type) -> str:
+    """
+    Return the version of the plugin that defines the task
+
+    The module's ``__version__`` is used if it exists; otherwise, the
+    modification time of the plugin file stands in for the version.
+    """
+    module = sys.modules.get(task.__module__)
+    version = getattr(module, "__version__", None)
+    if version is not None:
+        return str(version)
+    try:
+        return str(Path(inspect.getfile(task)).stat().st_mtime_ns)
+    except (TypeError, OSError):
+        return ""
+
+
+def _key(path: Path) -> str:
+    return str(Path(path).resolve())
+
+
+def _hash(obj: Any) -> str:
+    data = json.dumps(obj, sort_keys=True, default=str).encode()
+    return hashlib.sha1(data).hexdigest()
+
+
+def stage_fingerprints(
+    cfg: NormalizedConfig, tasks: Dict[str, Dict[str, Type]]
+) -> Fingerprints:
+    """
+    Fingerprint the config and plugin versions that feed each stage
+
+    Every fingerprint is chained to the previous stage so a change upstream
+    invalidates everything downstream of it.
+
+    :param tasks: discovered tasks of each stage, keyed by stage name
+    """
+    fingerprints = {}
+    previous = ""
+    for stage in STAGES:
+        settings = {key: cfg.get(key) for key in STAGE_SETTINGS[stage]}  # type: ignore[attr-defined]
+        versions = {
+            task["name"]: plugin_version(tasks[stage][task["name"]])
+            for task in cfg[stage]  # type: ignore[literal-required]
+            if task["name"] in tasks[stage]
+        }
+        previous = _hash([previous, settings, versions])
+        fingerprints[stage] = previous
+    return fingerprints
+
+
+class RunState:
+    """
+    Persistent record of the inputs and outputs of successful runs
+
+    For every file, the fingerprint of the file and of each stage is stored
+    with a snapshot of the pool after the sources stage and the final
+    outputs. A re-run can then skip unchanged files and resume changed ones
+    from the first stage whose inputs differ.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        # The store is shared by the jobs of the server, which run in threads
+        self.conn = sqlite3.connect(str(path), check_same_thread=False)
+        self._lock = threading.Lock()
+
+        c = self.conn.cursor()
+        c.execute(
+            """
+            CREATE TABLE IF NOT EXISTS state (
+                path TEXT NOT NULL,
+                file TEXT NOT NULL,
+                pres TEXT NOT NULL,
+                sources TEXT NOT NULL,
+                posts TEXT NOT NULL,
+                pool BLOB NOT NULL,
+                outputs BLOB NOT NULL,
+                updated REAL NOT NULL,
+
+                PRIMARY KEY(path))
+            """
+        )
+        self.conn.commit()
+
+    @classmethod
+    def from_config(cls, cfg: NormalizedConfig) -> Optional["RunState"]:
+        """
+        Open the store configured by ``cfg["state"]`` or None if it is disabled
+        """
+        config = cfg.get("state")  # type: ignore[attr-defined]
+        if not config:
+            return None
+
+        path = Path(config["path"] or "state.db")
+        if not path.is_absolute():
+            path = Path(dirs.user_data_dir) / path
+        path.parent.mkdir(parents=True, exist_ok=True)
+        return cls(path)
+
+    def stage(self, path: Path, fingerprints: Fingerprints) -> Optional[str]:
+        """
+        Return the first stage that must be recomputed for the file or None if
+        the file is unchanged since its last successful run
+        """
+        with self._lock:
+            c = self.conn.cursor()
+            c.execute(
+                """
+                SELECT
+                    file, pres, sources, posts
+                FROM
+                    state
+                WHERE
+                    path = ?
+                """,
+                (_key(path),),
+            )
+            result = c.fetchone()
+        if not result:
+            return STAGES[0]
+
+        file, *stored = result
+        try:
+            if file != file_fingerprint(path):
+                return STAGES[0]
+        except OSError:
+            return STAGES[0]
+        for stage, fingerprint in zip(STAGES, stored):
+            if fingerprint != fingerprints[stage]:
+                return stage
+        return None
+
+    def pool(self, path: Path) -> Rows:
+        """
+        Return the pool snapshot taken after the sources stage of the file
+        """
+        with self._lock:
+            c = self.conn.cursor()
+            c.execute("SELECT pool FROM state WHERE path = ?", (_key(path),))
+            result = c.fetchone()
+        if not result:
+            raise KeyError(f"{path} not found in run state")
+        return pickle.loads(result[0])
+
+    def outputs(self, path: Path) -> Rows:
+        """
+        Return the outputs of the postprocess stage of the file
+        """
+        with self._lock:
+            c = self.conn.cursor()
+            c.execute("SELECT outputs FROM state WHERE path = ?", (_key(path),))
+            result = c.fetchone()
+        if not result:
+            raise KeyError(f"{path} not found in run state")
+        return pickle.loads(result[0])
+
+    def record(
+        self,
+        path: Path,
+        fingerprints: Fingerprints,
+        pool: Rows,
+        outputs: Rows,
+    ):
+        """
+        Record the successful run of a file
+        """
+        row = (
+            _key(path),
+            file_fingerprint(path),
+            *(fingerprints[stage] for stage in STAGES),
+            pickle.dumps(pool),
+            pickle.dumps(outputs),
+            time.time(),
+        )
+        with self._lock:
+            c = self.conn.cursor()
+            c.execute(
+                """
+                INSERT OR REPLACE INTO state
+                    (path, file, pres, sources, posts, pool, outputs, updated)
+                VALUES (?,?,?,?,?,?,?,?)
+                """,
+                row,
+            )
+            self.conn.commit()
+
+    def forget(self, paths: Iterable[Path]):
+        """
+        Drop the recorded state of the files so they are fully reprocessed
+        """
+        with self._lock:
+            c = self.conn.cursor()
+            c.executemany(
+                "DELETE FROM state WHERE path = ?", [(_key(path),) for path in paths]
+            )
+            self.conn.commit()
@@ -0,0 +1,745 @@
+import os
+import mmap
+import struct
+from concurrent.futures import ThreadPoolExecutor
+from logging import getLogger
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Mapping, NamedTuple, Optional, Tuple
+
+from .utils import merge_sources
+
+logger = getLogger(__name__)
+
+Tags = Dict[str, str]
+
+BUFFER_SIZE = 8 * 2**20
+# Space reserved after written tags so that later edits fit in place
+PADDING = 4096
+
+
+def file_snapshot(
+    snapshot: Mapping[str, Any], episodes: Mapping[str, Mapping[str, Any]]
+) -> Dict[str, Any]:
+    """
+    Merge the pool snapshot with the episode metadata of a single file
+
+    :param episodes: episode metadata of the file keyed by source id, in
+        source priority order
+    """
+    return {**snapshot, **merge_sources(episodes)}
+
+
+def resolve_tags(values: Mapping[str, Any], mapping: Mapping[str, str]) -> Tags:
+    """
+    Return the tags of a file given a mapping of tag names to metadata keys
+
+    Tags whose keys have no value are left out.
+    """
+    return {
+        tag: str(values[key])
+        for tag, key in mapping.items()
+        if values.get(key) is not None
+    }
+
+
+def _open(path: Path, write: bool = False):
+    f = open(path, "r+b" if write else "rb")
+    try:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except ValueError:
+        # Empty files cannot be mapped
+        f.close()
+        raise ValueError(f"{path} is empty")
+    return f, mm
+
+
+def _stream_rewrite(
+    path: Path, pieces: Iterable[Any], buffer_size: int = BUFFER_SIZE
+) -> Path:
+    """
+    Rewrite a file from pieces that are either bytes or (start, end) ranges of
+    the original file, replacing the original atomically
+    """
+    part = path.with_name(f".{path.name}.mediama-part")
+    try:
+        with open(path, "rb") as src, open(part, "wb", buffering=0) as dst:
+            for piece in pieces:
+                if isinstance(piece, bytes):
+                    dst.write(piece)
+                    continue
+                start, end = piece
+                src.seek(start)
+                while start < end:
+                    data = src.read(min(buffer_size, end - start))
+                    if not data:
+                        break
+                    dst.write(data)
+                    start += len(data)
+        os.replace(part, path)
+    except BaseException:
+        part.unlink(missing_ok=True)
+        raise
+    return path
+
+
+#
+# Matroska
+#
+
+EBML_SEGMENT = 0x18538067
+EBML_SEEKHEAD = 0x114D9B74
+EBML_SEEK = 0x4DBB
+EBML_SEEKID = 0x53AB
+EBML_SEEKPOSITION = 0x53AC
+EBML_TAGS = 0x1254C367
+EBML_TAG = 0x7373
+EBML_TARGETS = 0x63C0
+EBML_TARGETTYPEVALUE = 0x68CA
+EBML_SIMPLETAG = 0x67C8
+EBML_TAGNAME = 0x45A3
+EBML_TAGSTRING = 0x4487
+EBML_VOID = 0xEC
+# Targets with any of these apply to a track, edition, chapter or attachment
+EBML_TARGET_UIDS = {0x63C5, 0x63C9, 0x63C4, 0x63C6}
+
+
+class Element(NamedTuple):
+    id: int
+    pos: int
+    header: int
+    size: Optional[int]
+
+    @property
+    def data(self) -> int:
+        return self.pos + self.header
+
+    @property
+    def end(self) -> int:
+        return self.data + (self.size or 0)
+
+
+def read_vint(buf, pos: int, marker: bool = False) -> Tuple[Optional[int], int]:
+    """
+    Read a variable length integer and return it with its width
+
+    Sizes whose bits are all set are unknown and returned as None.
+    """
+    first = buf[pos]
+    if not first:
+        raise ValueError(f"Invalid variable length integer at {pos}")
+    width = 9 - first.bit_length()
+    value = first if marker else first & ((1 << (8 - width)) - 1)
+    for byte in buf[pos + 1 : pos + width]:
+        value = (value << 8) | byte
+    if not marker and value == (1 << (7 * width)) - 1:
+        return None, width
+    return value, width
+
+
+def encode_size(size: Optional[int], width: Optional[int] = None) -> bytes:
+    if width is None:
+        width = 1
+        while size is not None and size >= (1 << (7 * width)) - 1:
+            width += 1
+    if size is None:
+        size = (1 << (7 * width)) - 1
+    elif size >= (1 << (7 * width)) - 1:
+        raise ValueError(f"{size} does not fit in {width} bytes")
+    return (size | (1 << (7 * width))).to_bytes(width, "big")
+
+
+def element_header(id_: int, payload: bytes) -> bytes:
+    return id_.to_bytes((id_.bit_length() + 7) // 8, "big") + encode_size(len(payload))
+
+
+def ebml(id_: int, payload: bytes) -> bytes:
+    return element_header(id_, payload) + payload
+
+
+def void_header(length: int) -> bytes:
+    """
+    Return the header of a Void element that spans ``length`` bytes
+    """
+    for width in range(1, 9):
+        size = length - 1 - width
+        if 0 <= size < (1 << (7 * width)) - 1:
+            return bytes([EBML_VOID]) + encode_size(size, width)
+    raise ValueError(f"A Void element cannot span {length} bytes")
+
+
+def read_element(buf, pos: int) -> Element:
+    id_, id_width = read_vint(buf, pos, marker=True)
+    size, size_width = read_vint(buf, pos + id_width)
+    return Element(id_, pos, id_width + size_width, size)  # type: ignore[arg-type]
+
+
+def children(buf, start: int, end: int) -> List[Element]:
+    """
+    Read the headers of the elements between start and end
+    """
+    elements = []
+    pos = start
+    while pos < end:
+        element = read_element(buf, pos)
+        elements.append(element)
+        if element.size is None:
+            # Only the last element may have an unknown size
+            break
+        pos = element.end
+    return elements
+
+
+class MatroskaLayout(NamedTuple):
+    segment: Element
+    elements: List[Element]
+    end: int
+
+
+def matroska_layout(buf) -> MatroskaLayout:
+    """
+    Locate the segment and its top-level elements by reading their headers
+    """
+    pos = 0
+    while pos < len(buf):
+        element = read_element(buf, pos)
+        if element.id == EBML_SEGMENT:
+            end = len(buf) if element.size is None else element.end
+            return MatroskaLayout(element, children(buf, element.data, end), end)
+        if element.size is None:
+            break
+        pos = element.end
+    raise ValueError("No Matroska segment found")
+
+
+def _simple_tag(element: Element, buf) -> Tuple[str, str]:
+    name = value = ""
+    for child in children(buf, element.data, element.end):
+        if child.id == EBML_TAGNAME:
+            name = bytes(buf[child.data : child.end]).decode("utf-8", "replace")
+        elif child.id == EBML_TAGSTRING:
+            value = bytes(buf[child.data : child.end]).decode("utf-8", "replace")
+    return name, value
+
+
+def _is_global(tag: Element, buf) -> bool:
+    for child in children(buf, tag.data, tag.end):
+        if child.id == EBML_TARGETS:
+            targets = children(buf, child.data, child.end)
+            return not any(target.id in EBML_TARGET_UIDS for target in targets)
+    return True
+
+
+def read_matroska_tags(path: Path) -> Tags:
+    """
+    Read the tags that apply to the whole file
+    """
+    f, mm = _open(path)
+    with f, mm:
+        layout = matroska_layout(mm)
+        tags = {}
+        for element in layout.elements:
+            if element.id != EBML_TAGS:
+                continue
+            for tag in children(mm, element.data, element.end):
+                if tag.id != EBML_TAG or not _is_global(tag, mm):
+                    continue
+                for child in children(mm, tag.data, tag.end):
+                    if child.id == EBML_SIMPLETAG:
+                        name, value = _simple_tag(child, mm)
+                        tags[name.upper()] = value
+        return tags
+
+
+def _matroska_tags_element(buf, old: Optional[Element], tags: Tags) -> bytes:
+    """
+    Build a Tags element with the tags merged into the existing ones
+
+    Tags that target a track, edition, chapter or attachment are kept as is.
+    Existing file-wide tags that are not overwritten are kept too.
+    """
+    names = {name.upper() for name in tags}
+    payload = b""
+    if old is not None:
+        for tag in children(buf, old.data, old.end):
+            raw = bytes(buf[tag.pos : tag.end])
+            if tag.id != EBML_TAG or not _is_global(tag, buf):
+                payload += raw
+                continue
+            kept = b""
+            simple_tags = 0
+            for child in children(buf, tag.data, tag.end):
+                raw_child = bytes(buf[child.pos : child.end])
+                if child.id == EBML_SIMPLETAG:
+                    if _simple_tag(child, buf)[0].upper() in names:
+                        continue
+                    simple_tags += 1
+                kept += raw_child
+            if simple_tags:
+                payload += ebml(EBML_TAG, kept)
+
+    targets = ebml(EBML_TARGETS, ebml(EBML_TARGETTYPEVALUE, bytes([50])))
+    simple_tags_ = b"".join(
+        ebml(
+            EBML_SIMPLETAG,
+            ebml(EBML_TAGNAME, name.upper().encode())
+            + ebml(EBML_TAGSTRING, value.encode()),
+        )
+        for name, value in tags.items()
+    )
+    payload += ebml(EBML_TAG, targets + simple_tags_)
+    return ebml(EBML_TAGS, payload)
+
+
+def _seek_position(buf, layout: MatroskaLayout, id_: int) -> Optional[Element]:
+    """
+    Return the SeekPosition element that points to the element id
+    """
+    id_bytes = id_.to_bytes((id_.bit_length() + 7) // 8, "big")
+    for element in layout.elements:
+        if element.id != EBML_SEEKHEAD:
+            continue
+        for seek in children(buf, element.data, element.end):
+            if seek.id != EBML_SEEK:
+                continue
+            position = None
+            match = False
+            for child in children(buf, seek.data, seek.end):
+                if child.id == EBML_SEEKID:
+                    match = bytes(buf[child.data : child.end]) == id_bytes
+                elif child.id == EBML_SEEKPOSITION:
+                    position = child
+            if match and position:
+                return position
+    return None
+
+
+def write_matroska_tags(
+    path: Path, tags: Tags, padding: int = PADDING, buffer_size: int = BUFFER_SIZE
+) -> str:
+    """
+    Write tags to a Matroska file, preferring to patch it in place
+
+    The new Tags element is written over the old one if it fits in the old
+    element and any Void elements that follow it. Otherwise, the old element
+    is turned into a Void and the new one is appended to the segment. Only
+    if the segment cannot be extended in place is the file rewritten.
+
+    :returns: how the tags were written: in-place, appended or rewritten
+    """
+    f, mm = _open(path, write=True)
+    with f, mm:
+        layout = matroska_layout(mm)
+        elements = layout.elements
+        old = next((el for el in elements if el.id == EBML_TAGS), None)
+        new = _matroska_tags_element(mm, old, tags)
+
+        # Find a region to write the tags over: the old tags and the voids
+        # following them, otherwise any void that is large enough
+        regions = []
+        if old is not None:
+            idx = elements.index(old)
+            end = old.end
+            for element in elements[idx + 1 :]:
+                if element.id != EBML_VOID or element.size is None:
+                    break
+                end = element.end
+            regions.append((old.pos, end))
+        regions.extend(
+            (el.pos, el.end)
+            for el in elements
+            if el.id == EBML_VOID and el.size is not None
+        )
+        for start, end in regions:
+            space = end - start
+            if space == len(new) or space - len(new) >= 2:
+                f.seek(start)
+                f.write(new)
+                if space > len(new):
+                    f.write(void_header(space - len(new)))
+                if old is not None and start != old.pos:
+                    f.seek(old.pos)
+                    f.write(void_header(old.end - old.pos))
+                _update_seek(f, mm, layout, start)
+                return "in-place"
+
+        new += ebml(EBML_VOID, bytes(max(padding - 9, 0))) if padding else b""
+        segment = layout.segment
+        size_width = segment.header - ((segment.id.bit_length() + 7) // 8)
+        is_last = layout.end >= len(mm)
+        new_size = (
+            None if segment.size is None else layout.end - segment.data + len(new)
+        )
+        fits = new_size is None or new_size < (1 << (7 * size_width)) - 1
+        if is_last and fits:
+            if old is not None:
+                f.seek(old.pos)
+                f.write(void_header(old.end - old.pos))
+            f.seek(layout.end)
+            f.write(new)
+            f.truncate()
+            if new_size is not None:
+                f.seek(segment.pos + segment.header - size_width)
+                f.write(encode_size(new_size, size_width))
+            _update_seek(f, mm, layout, layout.end)
+            return "appended"
+
+    # Rewrite the file with an 8 byte segment size. Positions within the
+    # segment are relative to its data so nothing else has to be updated.
+    id_ = segment.id.to_bytes(4, "big")
+    size = None if segment.size is None else layout.end - segment.data + len(new)
+    pieces: List[Any] = [(0, segment.pos), id_ + encode_size(size, 8)]
+    if old is not None:
+        pieces += [
+            (segment.data, old.pos),
+            void_header(old.end - old.pos),
+            (old.pos + len(void_header(old.end - old.pos)), layout.end),
+        ]
+    else:
+        pieces.append((segment.data, layout.end))
+    pieces += [new, (layout.end, os.path.getsize(path))]
+    _stream_rewrite(path, pieces, buffer_size)
+
+    f, mm = _open(path, write=True)
+    with f, mm:
+        layout = matroska_layout(mm)
+        tags_ = [el for el in layout.elements if el.id == EBML_TAGS]
+        _update_seek(f, mm, layout, tags_[-1].pos)
+    return "rewritten"
+
+
+def _update_seek(f, buf, layout: MatroskaLayout, pos: int):
+    """
+    Point the SeekHead entry of the Tags element to pos if there is one
+    """
+    position = _seek_position(buf, layout, EBML_TAGS)
+    if position is None or position.size is None:
+        return
+    relative = pos - layout.segment.data
+    if relative >= 1 << (8 * position.size):
+        logger.debug("The SeekHead entry of the tags is too small to update")
+        return
+    f.seek(position.data)
+    f.write(relative.to_bytes(position.size, "big"))
+
+
+#
+# MP4
+#
+
+MP4_ATOMS = {
+    "TITLE": b"\xa9nam",
+    "ARTIST": b"\xa9ART",
+    "ALBUM": b"\xa9alb",
+    "DATE": b"\xa9day",
+    "GENRE": b"\xa9gen",
+    "COMMENT": b"\xa9cmt",
+    "DESCRIPTION": b"desc",
+    "SHOW": b"tvsh",
+    "NETWORK": b"tvnn",
+    "EPISODE_ID": b"tven",
+    "SEASON": b"tvsn",
+    "EPISODE": b"tves",
+}
+MP4_NAMES = {atom: name for name, atom in MP4_ATOMS.items()}
+# Atoms whose values are stored as 32 bit integers
+MP4_INTEGERS = {b"tvsn", b"tves"}
+MP4_FREEFORM_MEAN = b"com.apple.iTunes"
+MP4_FREE = {b"free", b"skip"}
+
+
+class Atom(NamedTuple):
+    type: bytes
+    pos: int
+    header: int
+    size: int
+
+    @property
+    def data(self) -> int:
+        return self.pos + self.header
+
+    @property
+    def end(self) -> int:
+        return self.pos + self.size
+
+
+def atoms(buf, start: int, end: int) -> List[Atom]:
+    """
+    Read the headers of the atoms between start and end
+    """
+    result = []
+    pos = start
+    while pos + 8 <= end:
+        size, type_ = struct.unpack_from(">I4s", buf, pos)
+        header = 8
+        if size == 1:
+            (size,) = struct.unpack_from(">Q", buf, pos + 8)
+            header = 16
+        elif size == 0:
+            size = end - pos
+        if size < header:
+            raise ValueError(f"Invalid atom size at {pos}")
+        result.append(Atom(type_, pos, header, size))
+        pos += size
+    return result
+
+
+def atom(type_: bytes, payload: bytes) -> bytes:
+    return struct.pack(">I4s", len(payload) + 8, type_) + payload
+
+
+def _find(buf, parent: Optional[Atom], type_: bytes, start: int = 0) -> Optional[Atom]:
+    start, end = (
+        (start, len(buf)) if parent is None else (parent.data + start, parent.end)
+    )
+    return next((a for a in atoms(buf, start, end) if a.type == type_), None)
+
+
+def _item_value(buf, item: Atom) -> Tuple[str, Optional[str]]:
+    """
+    Return the tag name and the value of an ilst item
+    """
+    name = MP4_NAMES.get(item.type, item.type.decode("latin-1"))
+    value = None
+    for child in atoms(buf, item.data, item.end):
+        if child.type == b"name":
+            name = bytes(buf[child.data + 4 : child.end]).decode("utf-8", "replace")
+        elif child.type == b"data":
+            type_, _ = struct.unpack_from(">II", buf, child.data)
+            data = bytes(buf[child.data + 8 : child.end])
+            if type_ == 1:
+                value = data.decode("utf-8", "replace")
+            elif type_ == 21 and len(data) in (1, 2, 4, 8):
+                value = str(int.from_bytes(data, "big", signed=True))
+    return name.upper(), value
+
+
+def _mp4_item(name: str, value: str) -> bytes:
+    type_ = MP4_ATOMS.get(name.upper())
+    if type_ in MP4_INTEGERS:
+        try:
+            data = atom(b"data", struct.pack(">IIi", 21, 0, int(value)))
+            return atom(type_, data)  # type: ignore[arg-type]
+        except ValueError:
+            pass
+    data = atom(b"data", struct.pack(">II", 1, 0) + value.encode())
+    if type_ is None:
+        # Freeform tags are stored as ----:com.apple.iTunes:NAME
+        mean = atom(b"mean", bytes(4) + MP4_FREEFORM_MEAN)
+        name_ = atom(b"name", bytes(4) + name.upper().encode())
+        return atom(b"----", mean + name_ + data)
+    return atom(type_, data)
+
+
+def _ilst(buf, moov: Atom) -> Tuple[Optional[Atom], Optional[Atom], Optional[Atom]]:
+    udta = _find(buf, moov, b"udta")
+    meta = udta and _find(buf, udta, b"meta")
+    # meta is a full box so its children follow the version and flags
+    ilst = meta and _find(buf, meta, b"ilst", start=4)
+    return udta, meta, ilst
+
+
+def read_mp4_tags(path: Path) -> Tags:
+    f, mm = _open(path)
+    with f, mm:
+        moov = _find(mm, None, b"moov")
+        if moov is None:
+            raise ValueError("No moov atom found")
+        _, _, ilst = _ilst(mm, moov)
+        if ilst is None:
+            return {}
+        tags = {}
+        for item in atoms(mm, ilst.data, ilst.end):
+            name, value = _item_value(mm, item)
+            if value is not None:
+                tags[name] = value
+        return tags
+
+
+def _mp4_ilst_atom(buf, old: Optional[Atom], tags: Tags) -> bytes:
+    """
+    Build an ilst atom with the tags merged into the existing items
+    """
+    names = {name.upper() for name in tags}
+    payload = b""
+    if old is not None:
+        for item in atoms(buf, old.data, old.end):
+            if _item_value(buf, item)[0] not in names:
+                payload += bytes(buf[item.pos : item.end])
+    payload += b"".join(_mp4_item(name, value) for name, value in tags.items())
+    return atom(b"ilst", payload)
+
+
+def _children_bytes(buf, parent: Atom, skip: int = 0) -> List[Tuple[bytes, bytes]]:
+    return [
+        (child.type, bytes(buf[child.pos : child.end]))
+        for child in atoms(buf, parent.data + skip, parent.end)
+    ]
+
+
+def _mp4_moov_atom(buf, moov: Atom, ilst: bytes, padding: int) -> bytes:
+    """
+    Build a moov atom with the ilst replaced, creating udta and meta if needed
+    """
+    udta, meta, _ = _ilst(buf, moov)
+
+    meta_children = _children_bytes(buf, meta, skip=4) if meta else []
+    meta_children = [
+        (type_, raw)
+        for type_, raw in meta_children
+        if type_ not in MP4_FREE | {b"ilst"}
+    ]
+    if not any(type_ == b"hdlr" for type_, _ in meta_children):
+        hdlr = atom(b"hdlr", bytes(8) + b"mdir" + b"appl" + bytes(9))
+        meta_children.insert(0, (b"hdlr", hdlr))
+    meta_payload = bytes(buf[meta.data : meta.data + 4]) if meta else bytes(4)
+    meta_payload += b"".join(raw for _, raw in meta_children) + ilst
+    if padding:
+        meta_payload += atom(b"free", bytes(max(padding - 8, 0)))
+    new_meta = atom(b"meta", meta_payload)
+
+    udta_children = _children_bytes(buf, udta) if udta else []
+    new_udta = atom(
+        b"udta",
+        b"".join(raw for type_, raw in udta_children if type_ != b"meta") + new_meta,
+    )
+    moov_children = _children_bytes(buf, moov)
+    return atom(
+        b"moov",
+        b"".join(raw for type_, raw in moov_children if type_ != b"udta") + new_udta,
+    )
+
+
+def write_mp4_tags(
+    path: Path, tags: Tags, padding: int = PADDING, buffer_size: int = BUFFER_SIZE
+) -> str:
+    """
+    Write tags to an MP4 file, preferring to patch it in place
+
+    The new ilst is written over the old one if it fits in the old atom and
+    any free atoms that follow it. Otherwise, the moov atom is rebuilt. If it
+    is the last atom, it is rewritten where it is; otherwise, the old moov is
+    turned into a free atom and the new one is appended. The media data never
+    moves so no chunk offsets have to be updated.
+
+    :returns: how the tags were written: in-place or appended
+    """
+    f, mm = _open(path, write=True)
+    with f, mm:
+        top = atoms(mm, 0, len(mm))
+        moov = next((a for a in top if a.type == b"moov"), None)
+        if moov is None:
+            raise ValueError("No moov atom found")
+        _, meta, old = _ilst(mm, moov)
+        ilst = _mp4_ilst_atom(mm, old, tags)
+
+        if old is not None and meta is not None:
+            end = old.end
+            for sibling in atoms(mm, old.end, meta.end):
+                if sibling.type not in MP4_FREE:
+                    break
+                end = sibling.end
+            space = end - old.pos
+            if space == len(ilst) or space - len(ilst) >= 8:
+                f.seek(old.pos)
+                f.write(ilst)
+                if space > len(ilst):
+                    f.write(struct.pack(">I4s", space - len(ilst), b"free"))
+                return "in-place"
+
+        new = _mp4_moov_atom(mm, moov, ilst, padding)
+        last = top[-1]
+        if last is moov:
+            f.seek(moov.pos)
+            f.write(new)
+            f.truncate()
+            return "appended"
+
+        # An atom that extends to the end of the file must be given its size
+        # before anything is appended
+        (size,) = struct.unpack_from(">I", mm, last.pos)
+        if size == 0:
+            if last.size >= 1 << 32:
+                raise ValueError("Cannot append to a file ending in a large atom")
+            f.seek(last.pos)
+            f.write(struct.pack(">I", last.size))
+        f.seek(moov.pos + 4)
+        f.write(b"free")
+        f.seek(0, os.SEEK_END)
+        f.write(new)
+        return "appended"
+
+
+#
+# Dispatch
+#
+
+READERS = {
+    ".mkv": read_matroska_tags,
+    ".mka": read_matroska_tags,
+    ".mks": read_matroska_tags,
+    ".webm": read_matroska_tags,
+    ".mp4": read_mp4_tags,
+    ".m4v": read_mp4_tags,
+    ".m4a": read_mp4_tags,
+}
+WRITERS = {
+    ".mkv": write_matroska_tags,
+    ".mka": write_matroska_tags,
+    ".mks": write_matroska_tags,
+    ".webm": write_matroska_tags,
+    ".mp4": write_mp4_tags,
+    ".m4v": write_mp4_tags,
+    ".m4a": write_mp4_tags,
+}
+
+
+def read_tags(path: Path) -> Tags:
+    try:
+        reader = READERS[Path(path).suffix.lower()]
+    except KeyError:
+        raise ValueError(f"Unsupported container: {path}")
+    return reader(path)
+
+
+def write_tags(
+    path: Path, tags: Tags, padding: int = PADDING, buffer_size: int = BUFFER_SIZE
+) -> str:
+    """
+    Write the tags to the file unless it already has them
+
+    :returns: how the tags were written: unchanged, in-place, appended or
+        rewritten
+    """
+    try:
+        writer = WRITERS[Path(path).suffix.lower()]
+    except KeyError:
+        raise ValueError(f"Unsupported container: {path}")
+    tags = {name.upper(): value for name, value in tags.items()}
+    existing = read_tags(path)
+    if all(existing.get(name) == value for name, value in tags.items()):
+        return "unchanged"
+    return writer(path, tags, padding, buffer_size)
+
+
+def write_all(
+    files: Mapping[Path, Tags],
+    concurrency: int = 4,
+    padding: int = PADDING,
+    buffer_size: int = BUFFER_SIZE,
+) -> Dict[Path, str]:
+    """
+    Write the tags of many files in parallel
+
+    :returns: how each file was written, or the error if it failed
+    """
+
+    def write(item: Tuple[Path, Tags]) -> Tuple[Path, str]:
+        path, tags = item
+        try:
+            return path, write_tags(path, tags, padding, buffer_size)
+        except Exception as e:
+            logger.error(f"Failed to tag {path}: {e}")
+            return path, f"error: {e}"
+
+    with ThreadPoolExecutor(concurrency) as executor:
+        return dict(executor.map(write, files.items()))
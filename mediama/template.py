@@ -0,0 +1,240 @@
+import re
+from functools import lru_cache
+from logging import getLogger
+from typing import Any, Callable, Dict, List, Mapping, Optional, Tuple
+
+from .utils import merge_sources
+
+logger = getLogger(__name__)
+
+Filter = Callable[[Any], Any]
+
+# {field}, {field.attr} or {field|filter|filter:arg}; braces are escaped by
+# doubling them
+FIELD_RE = re.compile(r"{{|}}|{([^{}]*)}")
+# Characters that are not allowed in file names on common filesystems
+UNSAFE_RE = re.compile(r'[<>:"/\\|?*\x00-\x1f]')
+
+
+def _pad(width: str = "2", fill: str = "0") -> Filter:
+    width_ = int(width)
+    return lambda value: str(value).rjust(width_, fill)
+
+
+def _truncate(length: str) -> Filter:
+    length_ = int(length)
+    return lambda value: str(value)[:length_].rstrip()
+
+
+def _replace(old: str, new: str = "") -> Filter:
+    return lambda value: str(value).replace(old, new)
+
+
+def _default(default: str = "") -> Filter:
+    def filter_(value: Any) -> Any:
+        return default if value is None or value == "" else value
+
+    # Unlike other filters, this one is also applied to missing values
+    filter_.handles_missing = True  # type: ignore[attr-defined]
+    return filter_
+
+
+def sanitize(value: Any) -> str:
+    """
+    Replace characters that are not allowed in file names
+    """
+    return UNSAFE_RE.sub("_", str(value)).strip()
+
+
+# Factories that take the arguments of a filter and return the filter
+FILTERS: Dict[str, Callable[..., Filter]] = {
+    "pad": _pad,
+    "lower": lambda: lambda value: str(value).lower(),
+    "upper": lambda: lambda value: str(value).upper(),
+    "title": lambda: lambda value: str(value).title(),
+    "capitalize": lambda: lambda value: str(value).capitalize(),
+    "strip": lambda: lambda value: str(value).strip(),
+    "truncate": _truncate,
+    "replace": _replace,
+    "default": _default,
+    "safe": lambda: sanitize,
+}
+
+
+def _getter(path: List[str]) -> Callable[[Mapping[str, Any]], Any]:
+    """
+    Return a function that looks up a dotted field in a mapping of values
+    """
+    root, attrs = path[0], path[1:]
+    if not attrs:
+        return lambda values: values.get(root)
+
+    def get(values: Mapping[str, Any]) -> Any:
+        value = values.get(root)
+        for attr in attrs:
+            if value is None:
+                return None
+            if isinstance(value, Mapping):
+                value = value.get(attr)
+            elif attr.isdigit():
+                value = value[int(attr)]
+            else:
+                value = getattr(value, attr, None)
+        return value
+
+    return get
+
+
+def _field(
+    expr: str, escape: Optional[Filter]
+) -> Tuple[str, Callable[[Mapping[str, Any]], str]]:
+    """
+    Compile a field expression into its root key and a render function
+    """
+    name, *specs = [part.strip() for part in expr.split("|")]
+    if not name:
+        raise ValueError(f"Empty field in template: {{{expr}}}")
+
+    filters = []
+    for spec in specs:
+        filter_name, _, args = spec.partition(":")
+        try:
+            factory = FILTERS[filter_name]
+        except KeyError:
+            raise ValueError(f"Unknown template filter: {filter_name}")
+        try:
+            filters.append(factory(*(args.split(",") if args else ())))
+        except (TypeError, ValueError) as e:
+            raise ValueError(f"Invalid arguments for filter {spec}: {e}")
+    if escape is not None:
+        filters.append(escape)
+
+    path = name.split(".")
+    get = _getter(path)
+
+    def render(values: Mapping[str, Any]) -> str:
+        value = get(values)
+        for filter_ in filters:
+            if value is None and not getattr(filter_, "handles_missing", False):
+                raise KeyError(name)
+            value = filter_(value)
+        if value is None:
+            raise KeyError(name)
+        return str(value)
+
+    return path[0], render
+
+
+class Template:
+    """
+    A format string compiled once into a render function
+
+    Fields are written as ``{key}``, ``{key.attr}`` or with filters such as
+    ``{episode|pad:2}`` and ``{title|default:Unknown|lower}``. Every field is
+    passed through ``escape`` after its filters, e.g. to make file names safe.
+
+    :param escape: filter applied to the value of every field
+    :raises ValueError: if the template is malformed or uses unknown filters
+    """
+
+    def __init__(self, fmt: str, escape: Optional[Filter] = None):
+        self.fmt = fmt
+        self.fields: List[str] = []
+        parts: List[Callable[[Mapping[str, Any]], str]] = []
+
+        literal = []
+        pos = 0
+        for match in FIELD_RE.finditer(fmt):
+            literal.append(fmt[pos : match.start()])
+            pos = match.end()
+            if match.group(1) is None:
+                literal.append(match.group(0)[0])
+                continue
+            if literal:
+                parts.append(_constant("".join(literal)))
+                literal = []
+            root, render = _field(match.group(1), escape)
+            if root not in self.fields:
+                self.fields.append(root)
+            parts.append(render)
+        rest = fmt[pos:]
+        if "{" in rest or "}" in rest:
+            raise ValueError(f"Unbalanced braces in template: {fmt}")
+        literal.append(rest)
+        if "".join(literal):
+            parts.append(_constant("".join(literal)))
+        self._parts = parts
+
+    def __repr__(self):
+        return f"Template({self.fmt!r})"
+
+    def render(self, values: Mapping[str, Any]) -> str:
+        """
+        Render the template with the values of its fields
+
+        :raises KeyError: if a field has no value and no default
+        """
+        return "".join([part(values) for part in self._parts])
+
+    def render_many(
+        self,
+        items: Mapping[Any, Mapping[str, Any]],
+        base: Optional[Mapping[str, Any]] = None,
+    ) -> Dict[Any, str]:
+        """
+        Render the template for many items at once
+
+        Only the fields of the template are looked up, first in the item and
+        then in ``base``, so the shared values are resolved once for the whole
+        batch. Items that are missing a field are logged and left out.
+
+        :param items: values of each item, e.g. the episode metadata of a file
+        :param base: values shared by every item, e.g. a pool snapshot
+        """
+        base = {key: value for key, value in (base or {}).items() if key in self.fields}
+        rendered = {}
+        for key, item in items.items():
+            values = dict(base)
+            for field in self.fields:
+                value = item.get(field)
+                if value is not None:
+                    values[field] = value
+            try:
+                rendered[key] = self.render(values)
+            except KeyError as e:
+                logger.warning(f"Cannot render {self.fmt!r} for {key}: missing {e}")
+        return rendered
+
+
+def _constant(text: str) -> Callable[[Mapping[str, Any]], str]:
+    return lambda values: text
+
+
+@lru_cache(maxsize=256)
+def compile_template(fmt: str, escape: Optional[Filter] = None) -> Template:
+    """
+    Compile a format string, reusing the template of a format seen before
+    """
+    return Template(fmt, escape)
+
+
+def render_files(
+    template: Template,
+    episodes: Mapping[Any, Mapping[str, Mapping[str, Any]]],
+    base: Optional[Mapping[str, Any]] = None,
+    files: Optional[Mapping[Any, Mapping[str, Any]]] = None,
+) -> Dict[Any, str]:
+    """
+    Render a template for every file given its episode metadata by source
+
+    :param files: other values of each file, e.g. its probed metadata, which
+        the episode metadata takes precedence over
+    """
+    files = files or {}
+    return template.render_many(
+        {
+            path: {**files.get(path, {}), **merge_sources(data)}
+            for path, data in episodes.items()
+        },
+        base,
+    )
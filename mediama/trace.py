@@ -0,0 +1,329 @@
+import os
+import sys
+import json
+import time
+import threading
+from collections import deque
+from contextlib import contextmanager
+from logging import getLogger
+from pathlib import Path
+from typing import Any, Deque, Dict, Generator, Iterable, List, Optional, Tuple
+
+logger = getLogger(__name__)
+
+FORMATS = ("json", "chrome")
+# Most spans a tracer keeps, so that long-running modes stay bounded
+MAX_SPANS = 100000
+
+# Open spans of each thread or greenlet, innermost last
+_active: Dict[int, List["Span"]] = {}
+_ids = iter(range(1, sys.maxsize))
+
+
+def _thread_id() -> int:
+    # Sources run in greenlets that share a thread, so each greenlet gets its
+    # own track once gevent is in use
+    greenlet = sys.modules.get("greenlet")
+    if greenlet is not None:
+        return id(greenlet.getcurrent())
+    return threading.get_ident()
+
+
+class Span:
+    """
+    A timed operation of the pipeline
+
+    Counters such as bytes transferred or cache hits are added with ``add``
+    and other details are set in ``attrs``.
+    """
+
+    __slots__ = (
+        "id",
+        "parent",
+        "name",
+        "category",
+        "task",
+        "tid",
+        "start",
+        "duration",
+        "status",
+        "error",
+        "attrs",
+        "counters",
+    )
+
+    def __init__(self, name: str, category: str, task: Optional[str] = None):
+        self.id = next(_ids)
+        self.parent: Optional[int] = None
+        self.name = name
+        self.category = category
+        self.task = task
+        self.tid = 0
+        self.start = 0.0
+        self.duration = 0.0
+        self.status = "ok"
+        self.error: Optional[str] = None
+        self.attrs: Dict[str, Any] = {}
+        self.counters: Dict[str, float] = {}
+
+    @property
+    def label(self) -> str:
+        return f"{self.task}.{self.name}" if self.task else self.name
+
+    def add(self, **counters: float):
+        for key, value in counters.items():
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "id": self.id,
+            "parent": self.parent,
+            "name": self.name,
+            "category": self.category,
+            "task": self.task,
+            "tid": self.tid,
+            "start": self.start,
+            "duration": self.duration,
+            "status": self.status,
+            "error": self.error,
+            "attrs": self.attrs,
+            "counters": self.counters,
+        }
+
+
+def current_span() -> Optional[Span]:
+    """
+    Return the innermost open span of the current thread or greenlet
+    """
+    stack = _active.get(_thread_id())
+    return stack[-1] if stack else None
+
+
+class Metrics:
+    """
+    Totals of the spans of every run, exported in the Prometheus text format
+
+    Spans are totalled by category, name and task. The metrics outlive the
+    engine, so they are kept when the config is reloaded.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._seconds: Dict[Tuple[str, str, str], List[float]] = {}
+        self._counters: Dict[str, Dict[Tuple[str, str, str], float]] = {}
+        # The flow control of the sources of the current engine, if any
+        self.health: Optional[Any] = None
+
+    def record(self, span: Span):
+        key = (span.category, span.name, span.task or "")
+        with self._lock:
+            totals = self._seconds.setdefault(key, [0.0, 0, 0])
+            totals[0] += span.duration
+            totals[1] += 1
+            totals[2] += span.status == "error"
+            for name, value in span.counters.items():
+                counter = self._counters.setdefault(name, {})
+                counter[key] = counter.get(key, 0) + value
+
+    def render(self) -> str:
+        def labels(key: Tuple[str, str, str]) -> str:
+            category, name, task = key
+            return f'{{stage="{category}",span="{name}",task="{task}"}}'
+
+        with self._lock:
+            lines = [
+                "# HELP mediama_span_seconds Time spent in each span",
+                "# TYPE mediama_span_seconds summary",
+            ]
+            for key, (seconds, count, _) in sorted(self._seconds.items()):
+                lines.append(f"mediama_span_seconds_sum{labels(key)} {seconds:.6f}")
+                lines.append(f"mediama_span_seconds_count{labels(key)} {count}")
+            lines += [
+                "# HELP mediama_span_errors_total Spans that raised an error",
+                "# TYPE mediama_span_errors_total counter",
+            ]
+            for key, (_, _, errors) in sorted(self._seconds.items()):
+                lines.append(f"mediama_span_errors_total{labels(key)} {errors}")
+            for name, counter in sorted(self._counters.items()):
+                lines.append(f"# TYPE mediama_{name}_total counter")
+                for key, value in sorted(counter.items()):
+                    lines.append(f"mediama_{name}_total{labels(key)} {value:g}")
+        if self.health is not None:
+            lines += self._render_health(self.health.stats())
+        return "\n".join(lines) + "\n"
+
+    @staticmethod
+    def _render_health(stats: Dict[str, Dict[str, Any]]) -> List[str]:
+        gauges = [
+            ("source_limit", "Calls of each source that may run at once", "limit"),
+            ("source_inflight", "Calls of each source that are running", "inflight"),
+            ("source_open", "Whether the circuit breaker of a source is open", None),
+        ]
+        lines = []
+        for name, help_, key in gauges:
+            lines += [f"# HELP mediama_{name} {help_}", f"# TYPE mediama_{name} gauge"]
+            for id_, source in sorted(stats.items()):
+                value = source[key] if key else int(source["state"] != "closed")
+                lines.append(f'mediama_{name}{{task="{id_}"}} {value}')
+        for key in ("rejected", "timeouts"):
+            lines.append(f"# TYPE mediama_source_{key}_total counter")
+            for id_, source in sorted(stats.items()):
+                lines.append(
+                    f'mediama_source_{key}_total{{task="{id_}"}} {source[key]}'
+                )
+        return lines
+
+
+class Tracer:
+    """
+    Record spans of the pipeline
+
+    Spans are only kept if ``keep`` is set, e.g. to be written to a trace file;
+    otherwise they are only totalled into the metrics, if any.
+    """
+
+    def __init__(self, keep: bool = False, metrics: Optional[Metrics] = None):
+        self.keep = keep
+        self.metrics = metrics
+        self.spans: Deque[Span] = deque(maxlen=MAX_SPANS)
+        # Span times are relative to the performance counter, so they are
+        # converted to wall-clock times with the offset at creation
+        self._epoch = time.time() - time.perf_counter()
+
+    @contextmanager
+    def span(
+        self, name: str, category: str, task: Optional[str] = None, **attrs: Any
+    ) -> Generator[Span, None, None]:
+        """
+        Time the block as a span and mark the span failed if the block raises
+        """
+        span = Span(name, category, task)
+        span.attrs.update(attrs)
+        span.tid = _thread_id()
+        stack = _active.setdefault(span.tid, [])
+        if stack:
+            span.parent = stack[-1].id
+        stack.append(span)
+        span.start = time.perf_counter()
+        try:
+            yield span
+        except Exception as e:
+            span.status = "error"
+            span.error = f"{type(e).__name__}: {e}"
+            raise
+        except BaseException:
+            # Generators closed early and killed greenlets are not errors
+            span.status = "cancelled"
+            raise
+        finally:
+            span.duration = time.perf_counter() - span.start
+            stack.remove(span)
+            if not stack:
+                _active.pop(span.tid, None)
+            self._finish(span)
+
+    def iterate(
+        self, items: Iterable[Any], name: str, category: str, **kwargs: Any
+    ) -> Generator[Any, None, None]:
+        """
+        Time the consumption of an iterable as a span that counts its items
+        """
+        with self.span(name, category, **kwargs) as span:
+            for item in items:
+                span.add(items=1)
+                yield item
+
+    def _finish(self, span: Span):
+        if self.metrics is not None:
+            self.metrics.record(span)
+        if self.keep:
+            self.spans.append(span)
+
+    def to_json(self) -> Dict[str, Any]:
+        spans = []
+        for span in list(self.spans):
+            data = span.to_dict()
+            data["start"] = self._epoch + span.start
+            spans.append(data)
+        return {"pid": os.getpid(), "spans": spans}
+
+    def to_chrome(self) -> Dict[str, Any]:
+        """
+        Return the spans in the Chrome trace event format, which can be opened
+        in chrome://tracing or Perfetto
+        """
+        pid = os.getpid()
+        events = []
+        for span in list(self.spans):
+            args = {**span.attrs, **span.counters, "status": span.status}
+            if span.error:
+                args["error"] = span.error
+            events.append(
+                {
+                    "name": span.label,
+                    "cat": span.category,
+                    "ph": "X",
+                    "ts": (self._epoch + span.start) * 1e6,
+                    "dur": span.duration * 1e6,
+                    "pid": pid,
+                    "tid": span.tid,
+                    "args": args,
+                }
+            )
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def save(self, path: Path, format: str = "json"):
+        """
+        Write the kept spans to a file atomically
+
+        :raises ValueError: if the format is not supported
+        """
+        if format not in FORMATS:
+            raise ValueError(f"Unsupported trace format: {format}")
+        data = self.to_chrome() if format == "chrome" else self.to_json()
+        path = Path(path)
+        # Server workers may save at the same time
+        part = path.with_name(f".{path.name}.{os.getpid()}.{threading.get_ident()}")
+        with open(part, "w") as f:
+            json.dump(data, f, default=str)
+        os.replace(part, path)
+        logger.debug(
+            f"Wrote {len(data.get('spans', data.get('traceEvents')))} spans to {path}"
+        )
+
+
+def record_response(response: Any, *args: Any, **kwargs: Any) -> Any:
+    """
+    Response hook that adds an HTTP response to the current span
+    """
+    span = current_span()
+    # requests_cache runs the hooks of the responses it fetches twice, first
+    # before it has marked whether they came from the cache
+    if span is None or not hasattr(response, "from_cache"):
+        return response
+    size = response.headers.get("Content-Length")
+    if size is None:
+        # Only count bodies that were already read, so that streamed
+        # responses are not consumed here
+        content = response.__dict__.get("_content")
+        size = len(content) if isinstance(content, bytes) else 0
+    cached = bool(response.from_cache)
+    span.add(
+        requests=1,
+        bytes=int(size),
+        cache_hits=int(cached),
+        cache_misses=int(not cached),
+    )
+    return response
+
+
+def send_metrics(handler: Any, metrics: Metrics):
+    """
+    Answer an HTTP request handler with the metrics
+    """
+    data = metrics.render().encode()
+    handler.send_response(200)
+    handler.send_header("Content-Type", "text/plain; version=0.0.4")
+    handler.send_header("Content-Length", str(len(data)))
+    handler.end_headers()
+    handler.wfile.write(data)
@@ -1,14 +1,49 @@
 from types import ModuleType
-from typing import Generator, Generic, Any, Union, List
+from typing import (
+    Generator,
+    Generic,
+    Any,
+    Union,
+    List,
+    Iterable,
+    AsyncIterable,
+    Dict,
+    Mapping,
+    Optional,
+    Tuple,
+)
 from pathlib import Path
 import sys
+import pkgutil
+from logging import getLogger
 from importlib import import_module
 
-from appdirs import AppDirs  # type: ignore[import]
-
 from .__about__ import __author__
 
-dirs = AppDirs("mediama", __author__)
+logger = getLogger(__name__)
+
+
+class LazyAppDirs:
+    """
+    The folders of appdirs.AppDirs, which is only imported once a folder is
+    first needed
+    """
+
+    def __init__(self, appname: str, appauthor: str):
+        self._args = (appname, appauthor)
+        self._dirs = None
+
+    def __getattr__(self, name: str) -> Any:
+        if name.startswith("_"):
+            raise AttributeError(name)
+        if self._dirs is None:
+            from appdirs import AppDirs  # type: ignore[import]
+
+            self._dirs = AppDirs(*self._args)
+        return getattr(self._dirs, name)
+
+
+dirs = LazyAppDirs("mediama", __author__)
 
 
 def get_project_root() -> Path:
@@ -47,6 +82,18 @@ def import_module_from_path(module: Path) -> ModuleType:
         sys.path.pop(0)  # lets not pollute sys.path!!
 
 
+def import_package_modules(package: str) -> Generator[ModuleType, None, None]:
+    """
+    Import every module of a package, skipping those that fail to import
+    """
+    pkg = import_module(package)
+    for info in pkgutil.iter_modules(pkg.__path__, f"{package}."):
+        try:
+            yield import_module(info.name)
+        except Exception as e:
+            logger.debug(f"Failed to import {info.name} because {e}")
+
+
 """
 Untested, too hard to write test without hackery
 """
@@ -87,13 +134,154 @@ def get_subclasses_from_module(
             pass
 
 
-def normalize_ranking(ranking: List, num_rank):
-    raise NotImplementedError
+def iter_pages(
+    result: Union[None, List, Iterable, AsyncIterable]
+) -> Generator[List, None, None]:
+    """
+    Normalize the return value of a paginated task into a generator of pages
+
+    A list is treated as a single page. Any other iterable or async iterable is
+    expected to produce pages (lists), although a bare item is accepted as a
+    page of one. Pages are pulled lazily, so only the current page needs to be
+    held in memory.
+    """
+    if result is None:
+        return
+    if isinstance(result, (list, tuple)):
+        if result:
+            yield list(result)
+        return
+    if hasattr(result, "__aiter__"):
+        pages: Iterable = _iter_async(result)  # type: ignore[arg-type]
+    else:
+        pages = result  # type: ignore[assignment]
+    for page in pages:
+        if isinstance(page, dict):
+            yield [page]
+        elif page:
+            yield list(page)
+
+
+def _iter_async(aiterable: AsyncIterable) -> Generator[Any, None, None]:
+    """
+    Drive an async iterable from synchronous code, one item at a time
+    """
+    import asyncio
+
+    loop = asyncio.new_event_loop()
+    aiterator = aiterable.__aiter__()
+    try:
+        while True:
+            try:
+                yield loop.run_until_complete(aiterator.__anext__())
+            except StopAsyncIteration:
+                return
+    finally:
+        loop.run_until_complete(loop.shutdown_asyncgens())
+        loop.close()
+
+
+def wait_event(event: Any, timeout: Optional[float] = None) -> bool:
+    """
+    Wait for a threading event set by another thread and return whether it
+    was set
+
+    Sources run in greenlets, which must not block the others while they
+    wait, so under gevent the wait is moved to a thread of the hub.
+    """
+    if "gevent" in sys.modules:
+        import gevent
+
+        return gevent.get_hub().threadpool.apply(event.wait, (timeout,))
+    return event.wait(timeout)
+
+
+def merge_sources(data: Mapping[str, Mapping[str, Any]]) -> Dict[str, Any]:
+    """
+    Merge the metadata of an item from every source, the first source taking
+    precedence
+
+    :param data: metadata of the item keyed by source id, in priority order
+    """
+    values: Dict[str, Any] = {}
+    for metadata in reversed(list(data.values())):
+        values.update(metadata)
+    return values
+
+
+def normalize_ranking(
+    ranking: Union[None, Mapping[str, Any], Iterable[Mapping[str, Any]]],
+    num_rank: int,
+) -> List[Dict[str, Any]]:
+    """
+    Keep the num_rank best results of a source, best first
+
+    A source may return a single result instead of a list.
+    """
+    if ranking is None:
+        return []
+    if isinstance(ranking, Mapping):
+        return [dict(ranking)]
+    return [dict(result) for result in ranking][:num_rank]
+
 
+def merge_ranking_metadata(
+    names: List[str], metadata: List[Tuple[str, List[Mapping[str, Any]]]]
+) -> List[Dict[str, Any]]:
+    """
+    Merge the results of every source for each name
+
+    :param names: aggregated ranking of the names
+    :param metadata: (id, ranking) of each source, in priority order
+    :returns: the merged metadata of each name in the order of names
+    """
+    by_name: Dict[str, Dict[str, Mapping[str, Any]]] = {}
+    for id_, ranking in metadata:
+        for result in ranking:
+            by_name.setdefault(result["name"], {}).setdefault(id_, result)
+    return [merge_sources(by_name[name]) for name in names if name in by_name]
+
+
+def _borda_scores(ranks: List[List[str]], weights: List[float]) -> Dict[str, float]:
+    """
+    Return the weighted Borda score of every name, in the order they were
+    first seen
+    """
+    length = max(map(len, ranks), default=0)
+    scores: Dict[str, float] = {}
+    for ranking, weight in zip(ranks, weights):
+        seen = set()
+        for position, name in enumerate(ranking):
+            if name in seen:
+                continue
+            seen.add(name)
+            scores[name] = scores.get(name, 0) + weight * (length - position)
+    return scores
 
-def merge_ranking_metadata(names: List[str], metadata: List):
-    raise NotImplementedError
+
+def rank_aggregation(ranks: List[List[str]], weights: List[float]) -> List[str]:
+    """
+    Combine the rankings of many sources with a weighted Borda count
+
+    A name scores ``weight * (length - position)`` in each ranking it is in,
+    where length is that of the longest ranking. Ties keep the order in which
+    the names were first seen.
+    """
+    scores = _borda_scores(ranks, weights)
+    return sorted(scores, key=lambda name: -scores[name])
 
 
-def rank_aggregation(ranks, weights):
-    raise NotImplementedError
+def rank_certainty(ranks: List[List[str]], weights: List[float]) -> float:
+    """
+    Return the lead of the best name of rank_aggregation over the runner-up,
+    as a share of the most a name could score
+
+    A single ranking with a single name is certain (1.0), while rankings whose
+    best names tie are not (0.0).
+    """
+    total = sum(weights) * max(map(len, ranks), default=0)
+    if not total:
+        return 0.0
+    scores = _borda_scores(ranks, weights)
+    best = sorted(scores.values(), reverse=True)[:2] + [0.0]
+    return (best[0] - best[1]) / total
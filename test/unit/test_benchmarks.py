@@ -0,0 +1,38 @@
+import os
+import sys
+import json
+import subprocess
+import unittest
+from pathlib import Path
+
+BENCHMARKS = Path(__file__).resolve().parents[2] / "benchmarks"
+SUITE = BENCHMARKS / "suite.py"
+
+
+class TestBenchmarkSuite(unittest.TestCase):
+    def test_every_case_runs(self):
+        out = subprocess.run(
+            [sys.executable, str(SUITE), "--sizes", "48", "--repeat", "1"],
+            capture_output=True,
+            text=True,
+        )
+        self.assertEqual(0, out.returncode, out.stderr)
+
+        results = json.loads(out.stdout)["results"]
+        for key in ("discovery", "varpool/48", "end_to_end/48"):
+            self.assertGreater(results[key]["ops"], 0, key)
+
+
+class TestStartup(unittest.TestCase):
+    def test_scaled_budgets(self):
+        out = subprocess.run(
+            [sys.executable, str(BENCHMARKS / "startup.py"), "--runs", "1", "--json"],
+            capture_output=True,
+            text=True,
+            env={**os.environ, "MEDIAMA_STARTUP_SCALE": "100"},
+        )
+
+        self.assertEqual(0, out.returncode, out.stdout)
+        for name, result in json.loads(out.stdout).items():
+            self.assertListEqual([], result["forbidden"], name)
+            self.assertGreaterEqual(result["budget"], 100, name)
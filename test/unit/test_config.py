@@ -1,4 +1,6 @@
 import unittest
+import unittest.mock as mock
+import tempfile
 from pathlib import Path
 
 import mediama.config as config
@@ -271,26 +273,148 @@ class TestDuplicateIdFilter(unittest.TestCase):
         self.assertListEqual(expected, tasks)
 
 
-class TestConfigDiscovery(unittest.TestCase):
+class ConfigTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.root = Path(self.dir.name)
+        self.user = self.root / "user"
+        self.system = self.root / "system"
+        self.user.mkdir()
+        self.system.mkdir()
+
+        patcher = mock.patch("mediama.config.dirs")
+        dirs = patcher.start()
+        dirs.user_config_dir = str(self.user)
+        dirs.site_config_dir = str(self.system)
+        dirs.user_cache_dir = str(self.root / "cache")
+        self.addCleanup(patcher.stop)
+        self.addCleanup(config._loaded.clear)
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def write(self, path, text):
+        path.write_text(text)
+        return path
+
+
+class TestConfigDiscovery(ConfigTestCase):
     def test_user_specified_config(self):
-        self.fail()
+        self.write(self.system / "config.json", "{}")
+        path = self.write(self.user / "config.json", "{}")
+        self.assertEqual(path, config.discover_config())
 
     def test_system_specified_config(self):
-        self.fail()
+        path = self.write(self.system / "config.jsonc", "{}")
+        self.assertEqual(path, config.discover_config())
 
     def test_no_config(self):
-        expected = utils.get_project_root().joinpath(
-            "mediama", "default_config.json"
-        )
+        expected = utils.get_project_root().joinpath("mediama", "default_config.json")
         self.assertEqual(expected, config.discover_config())
 
     def test_python_config(self):
-        self.fail()
+        path = self.write(self.user / "config.py", "config = {}")
+        self.assertEqual(path, config.discover_config())
 
-class TestConfigLoader(unittest.TestCase):
+
+class TestConfigLoader(ConfigTestCase):
     def test_json(self):
-        self.fail()
+        path = self.write(self.root / "cfg.json", '{"name": "test", "pres": ["p"]}')
+        cfg = config.load_config(path)
+
+        self.assertEqual("test", cfg["name"])
+        self.assertListEqual([{"name": "p", "id": "pre_0", "kwargs": {}}], cfg["pres"])
+        # Unspecified settings are taken from the defaults
+        self.assertEqual(config.default_config()["limit"], cfg["limit"])
+
     def test_json_with_comments(self):
-        self.fail()
+        text = """
+        {
+            // The profile name
+            "name": "test", /* inline */
+            "limit": 3
+        }
+        """
+        for name in ("cfg.json", "cfg.jsonc"):
+            with self.subTest(name=name):
+                cfg = config.load_config(self.write(self.root / name, text))
+                self.assertEqual(("test", 3), (cfg["name"], cfg["limit"]))
+
     def test_python(self):
-        self.fail()
+        text = "limit = 2 * 5\nconfig = {'name': 'py', 'limit': limit}\n"
+        cfg = config.load_config(self.write(self.root / "cfg.py", text))
+        self.assertEqual(("py", 10), (cfg["name"], cfg["limit"]))
+
+    def test_python_without_config(self):
+        path = self.write(self.root / "cfg.py", "name = 'py'\n")
+        with self.assertRaises(ValueError):
+            config.load_config(path)
+
+    def test_invalid(self):
+        cases = [
+            '{"limit": "5"}',
+            '{"limit": true}',
+            '{"pres": [{"id": "x"}]}',
+            '{"aliases": {"name": "title"}}',
+            '{"watch": {"debounce": "soon"}}',
+            "[]",
+        ]
+        for text in cases:
+            with self.subTest(text=text), self.assertRaises(ValueError):
+                config._loaded.clear()
+                config.load_config(self.write(self.root / "cfg.json", text))
+
+    def test_merged_sections(self):
+        path = self.write(self.root / "cfg.json", '{"watch": {"debounce": 1}}')
+        cfg = config.load_config(path)
+        self.assertEqual(1, cfg["watch"]["debounce"])
+        self.assertEqual(60, cfg["watch"]["max_wait"])
+
+    def test_disabled_sections(self):
+        path = self.write(self.root / "cfg.json", '{"cache": null, "state": {}}')
+        cfg = config.load_config(path)
+        self.assertIsNone(cfg["cache"])
+        self.assertDictEqual({}, cfg["state"])
+
+    def test_memory_cache(self):
+        path = self.write(self.root / "cfg.json", '{"name": "a"}')
+        config.load_config(path)
+        with mock.patch("mediama.config.read_config") as read_config_mock:
+            cfg = config.load_config(path)
+        read_config_mock.assert_not_called()
+        # Callers get their own copy
+        cfg["name"] = "changed"
+        self.assertEqual("a", config.load_config(path)["name"])
+
+    def test_disk_cache(self):
+        path = self.write(self.root / "cfg.json", '{"name": "a"}')
+        config.load_config(path)
+        config._loaded.clear()
+        with mock.patch("mediama.config.read_config") as read_config_mock:
+            self.assertEqual("a", config.load_config(path)["name"])
+        read_config_mock.assert_not_called()
+
+    def test_changed_file(self):
+        path = self.write(self.root / "cfg.json", '{"name": "a"}')
+        config.load_config(path)
+        self.write(path, '{"name": "bb"}')
+        self.assertEqual("bb", config.load_config(path)["name"])
+
+
+class TestConfigReloader(ConfigTestCase):
+    def test_poll(self):
+        path = self.write(self.root / "cfg.json", '{"name": "a"}')
+        reloader = config.ConfigReloader(path, config.load_config(path))
+        self.assertIsNone(reloader.poll())
+
+        self.write(path, '{"name": "bb"}')
+        self.assertEqual("bb", reloader.poll()["name"])
+        self.assertIsNone(reloader.poll())
+
+    def test_invalid_keeps_config(self):
+        path = self.write(self.root / "cfg.json", '{"name": "a"}')
+        reloader = config.ConfigReloader(path, config.load_config(path))
+
+        self.write(path, '{"name": 1}')
+        self.assertIsNone(reloader.poll())
+        self.assertEqual("a", reloader.cfg["name"])
@@ -0,0 +1,313 @@
+import unittest
+import unittest.mock as mock
+import time
+import tempfile
+from pathlib import Path
+
+import mediama.core as core
+from mediama.config import normalize_config
+from mediama.managers import PostProcess, PreProcess, Source, SourceManager
+from mediama.memory import SeriesMemory
+from mediama.metadata import VariablePool
+from mediama.trace import Tracer
+
+
+class FakeSource(Source):
+    def fetch_series(self, num_ranks, series="Show", **kwargs):
+        return [{"name": "Other"}, {"name": series, "source": series}]
+
+    def fetch_episodes(self, pages=2, **kwargs):
+        for page in range(pages):
+            yield [{"episode": page * 2 + 1}, {"episode": page * 2 + 2}]
+
+
+class SlowSource(FakeSource):
+    def fetch_series(self, num_ranks, delay=0, **kwargs):
+        import gevent
+
+        gevent.sleep(delay)
+        return [{"name": "Show", "source": "slow"}]
+
+
+class BrokenSource(Source):
+    def fetch_series(self, **kwargs):
+        raise RuntimeError("down")
+
+    def fetch_episodes(self, **kwargs):
+        raise RuntimeError("down")
+
+
+class Title(PreProcess):
+    calls = 0
+
+    def main(self, **kwargs):
+        Title.calls += 1
+        return {"title": "Show"}
+
+
+class TitledSource(FakeSource):
+    # The titles that the source saw
+    titles: list = []
+
+    def fetch_series(self, num_ranks, **kwargs):
+        self.titles.append(self.metadata.get("title", "pre_0"))
+        return super().fetch_series(num_ranks, **kwargs)
+
+
+class Destinations(PostProcess):
+    def main(self, **kwargs):
+        return {
+            "destinations": {
+                path: path.with_name(f"Show - S01E{i:02d}.mkv")
+                for i, path in enumerate(self.metadata["filepaths"], 1)
+            }
+        }
+
+
+class TestRunSources(unittest.TestCase):
+    def setUp(self):
+        self.files = [Path(f"Show - {i:02d}.mkv") for i in range(1, 5)]
+
+    def run_sources(self, sources, memory=None, tracer=None, **settings):
+        cfg = normalize_config({"sources": sources, "prompt": False, **settings})
+        varpool = VariablePool(cfg, id_="mediama")
+        mgr = SourceManager(cfg, None).bind(varpool)
+        if tracer is not None:
+            mgr.tracer = tracer
+        mgr._tasks = {
+            "FakeSource": FakeSource,
+            "SlowSource": SlowSource,
+            "BrokenSource": BrokenSource,
+        }
+        mgr.disambiguate_series = lambda ranking: [
+            result["name"] for result in ranking
+        ].index("Show")
+        files = {i: path for i, path in enumerate(self.files, 1)}
+        mgr.disambiguate_episodes = lambda page: {
+            files[episode["episode"]]: episode for episode in page
+        }
+        varpool["filepaths"] = self.files
+        core.run_sources(mgr, varpool, self.files, cfg, memory)
+        return varpool
+
+    def test_sources(self):
+        varpool = self.run_sources(
+            [
+                {"name": "FakeSource", "id": "a"},
+                {"name": "FakeSource", "id": "b", "kwargs": {"pages": 1}},
+            ]
+        )
+
+        self.assertEqual("Show", varpool.get("name", id_="a"))
+        self.assertEqual("Show", varpool.get("source", id_="b"))
+        episodes = varpool.files("episodes")
+        self.assertSetEqual(set(self.files), set(episodes))
+        self.assertDictEqual(
+            {"a": {"episode": 1}, "b": {"episode": 1}}, episodes[self.files[0]]
+        )
+        self.assertDictEqual({"a": {"episode": 4}}, episodes[self.files[3]])
+
+    def test_traced(self):
+        tracer = Tracer(keep=True)
+        self.run_sources(
+            [{"name": "FakeSource", "id": "a"}, {"name": "FakeSource", "id": "b"}],
+            tracer=tracer,
+        )
+
+        pages = {
+            span.task: span for span in tracer.spans if span.name == "episode_pages"
+        }
+        self.assertSetEqual({"a", "b"}, set(pages))
+        self.assertEqual("sources", pages["a"].category)
+        self.assertEqual(2, pages["a"].counters["items"])
+
+    def test_failed_source(self):
+        varpool = self.run_sources(
+            [{"name": "BrokenSource", "id": "a"}, {"name": "FakeSource", "id": "b"}]
+        )
+
+        with self.assertRaises(KeyError):
+            varpool.get("name", id_="a")
+        self.assertDictEqual(
+            {"b": {"episode": 2}}, varpool.files("episodes")[self.files[1]]
+        )
+
+    def test_early_exit(self):
+        sources = [
+            {"name": "SlowSource", "id": "a"},
+            {"name": "SlowSource", "id": "b", "kwargs": {"delay": 0.5}},
+        ]
+        early_exit = {"margin": 0.5, "background": False}
+
+        start = time.monotonic()
+        varpool = self.run_sources(sources, early_exit=early_exit)
+        self.assertLess(time.monotonic() - start, 0.5)
+        self.assertEqual("slow", varpool.get("source", id_="a"))
+        # The slow source was cancelled
+        with self.assertRaises(KeyError):
+            varpool.get("name", id_="b")
+
+    def test_early_exit_background(self):
+        sources = [
+            {"name": "SlowSource", "id": "a"},
+            {"name": "SlowSource", "id": "b", "kwargs": {"delay": 0.1}},
+        ]
+
+        varpool = self.run_sources(sources, early_exit={"margin": 0.5})
+        # The slow source added its series before fetching its episodes
+        self.assertEqual("slow", varpool.get("source", id_="b"))
+        self.assertDictEqual(
+            {"a": {"episode": 1}, "b": {"episode": 1}},
+            varpool.files("episodes")[self.files[0]],
+        )
+
+    def test_early_exit_priority(self):
+        # A lower priority source cannot decide before the sources above it
+        sources = [
+            {"name": "SlowSource", "id": "a", "kwargs": {"delay": 0.1}},
+            {"name": "SlowSource", "id": "b"},
+        ]
+
+        varpool = self.run_sources(
+            sources, early_exit={"margin": 0.5, "background": False}
+        )
+        self.assertEqual("Show", varpool.get("name", id_="a"))
+
+    def test_exact_title(self):
+        sources = [
+            {"name": "SlowSource", "id": "a"},
+            {"name": "SlowSource", "id": "b", "kwargs": {"delay": 0.5}},
+        ]
+
+        start = time.monotonic()
+        self.run_sources(sources, early_exit={"exact": True, "background": False})
+        self.assertLess(time.monotonic() - start, 0.5)
+
+    def test_memory(self):
+        sources = [{"name": "FakeSource", "id": "a"}]
+        with tempfile.TemporaryDirectory() as tmp:
+            memory = SeriesMemory(Path(tmp, "memory.db"), confidence=1)
+            self.run_sources(sources, memory)
+
+            # The series is recalled without asking the sources
+            with mock.patch.object(core, "fetch_series") as fetch_series:
+                varpool = self.run_sources(sources, memory)
+        fetch_series.assert_not_called()
+        self.assertEqual("Show", varpool.get("source", id_="a"))
+        self.assertEqual(4, len(varpool.files("episodes")))
+
+
+class TestDecisions(unittest.TestCase):
+    def setUp(self):
+        self.files = [Path(f"Show - {i:02d}.mkv") for i in range(1, 3)]
+        cfg = normalize_config(
+            {
+                "sources": [{"name": "FakeSource", "id": "a", "kwargs": {"pages": 1}}],
+                "cache": None,
+                "state": None,
+                "memory": None,
+                "episodes": None,
+                "misses": None,
+            }
+        )
+        self.engine = core.Engine(cfg)
+        self.engine.src_mgr._tasks = {"FakeSource": FakeSource}
+
+    def test_park_and_resolve(self):
+        # Neither the series nor the episodes can be chosen automatically
+        self.assertIsNone(self.engine.run(self.files))
+        (series,) = self.engine.decisions.pending()
+        self.assertEqual("series", series.kind)
+        names = [candidate["name"] for candidate in series.candidates]
+
+        with self.assertRaises(ValueError):
+            self.engine.resolve(series.id, len(names))
+        varpool = self.engine.resolve(series.id, names.index("Show"))
+        self.assertEqual("Show", varpool.get("source", id_="a"))
+        (episodes,) = self.engine.decisions.pending()
+        self.assertEqual("episodes", episodes.kind)
+        self.assertListEqual(self.files, episodes.files)
+
+        varpool = self.engine.resolve(episodes.id, {str(self.files[1]): 1})
+        self.assertDictEqual(
+            {self.files[1]: {"a": {"episode": 2}}}, varpool.files("episodes")
+        )
+        self.assertEqual(0, len(self.engine.decisions))
+
+    def test_prompt(self):
+        self.engine.run(self.files)
+        names = [c["name"] for c in self.engine.decisions.pending()[0].candidates]
+        # The episodes are parked once the series is chosen and asked next
+        answers = iter([str(names.index("Show")), "", "0"])
+
+        with mock.patch("builtins.input", lambda question: next(answers)):
+            with mock.patch("sys.stderr"):
+                core.prompt_decisions(self.engine)
+                core.prompt_decisions(self.engine)
+
+        self.assertEqual(0, len(self.engine.decisions))
+
+
+class TestState(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.root = Path(tmp.name)
+        self.file = self.root / "Show - 01.mkv"
+        self.file.write_bytes(b"data")
+        patcher = mock.patch("mediama.postprocessors.rename.dirs")
+        patcher.start().user_data_dir = str(self.root)
+        self.addCleanup(patcher.stop)
+        Title.calls = 0
+        TitledSource.titles = []
+
+    def make_engine(self, posts=(), pages=1):
+        from mediama.postprocessors.rename import Rename
+
+        cfg = normalize_config(
+            {
+                "pres": [{"name": "Title", "id": "pre_0"}],
+                "sources": [
+                    {"name": "TitledSource", "id": "a", "kwargs": {"pages": pages}}
+                ],
+                "posts": [
+                    {"name": name, "id": f"post_{i}"} for i, name in enumerate(posts)
+                ],
+                "prompt": False,
+                "cache": None,
+                "state": {"path": str(self.root / "state.db")},
+                "memory": None,
+                "episodes": None,
+                "misses": None,
+            }
+        )
+        engine = core.Engine(cfg)
+        engine.pre_mgr._tasks = {"Title": Title}
+        engine.src_mgr._tasks = {"TitledSource": TitledSource}
+        engine.src_mgr.disambiguate_series = lambda ranking: 1
+        engine.src_mgr.disambiguate_episodes = lambda page: {self.file: page[0]}
+        engine.post_mgr._tasks = {"Destinations": Destinations, "Rename": Rename}
+        return engine
+
+    def test_renamed(self):
+        self.engine = self.make_engine(["Destinations", "Rename"])
+        self.engine.run([self.file])
+
+        destination = self.root / "Show - S01E01.mkv"
+        self.assertTrue(destination.exists())
+        # The state follows the file to its destination
+        state = self.engine.state
+        self.assertIsNone(state.stage(destination, self.engine.fingerprints))
+        self.assertIn(
+            ("mediama", "episodes", {"a": {"episode": 1}}, str(destination)),
+            state.pool(destination),
+        )
+        self.assertIsNone(self.engine.run([destination]))
+
+    def test_resume_sources(self):
+        self.make_engine().run([self.file])
+        # Only the settings of the source changed
+        self.make_engine(pages=2).run([self.file])
+
+        self.assertEqual(1, Title.calls)
+        self.assertListEqual(["Show", "Show"], TitledSource.titles)
@@ -0,0 +1,139 @@
+import unittest
+import tempfile
+import sys
+from pathlib import Path
+
+import mediama.daemon as daemon
+
+
+class TestSeriesKey(unittest.TestCase):
+    def test_season_episode(self):
+        self.assertEqual("show name", daemon.series_key(Path("Show.Name.S01E02.mkv")))
+
+    def test_absolute_episode(self):
+        self.assertEqual(
+            "frieren",
+            daemon.series_key(Path("[Group] Frieren - 05 (1080p) [ABCD1234].mkv")),
+        )
+
+    def test_same_series(self):
+        self.assertEqual(
+            daemon.series_key(Path("Show Name - S01E01 - Pilot.mkv")),
+            daemon.series_key(Path("Show Name - S01E02 - Second.mkv")),
+        )
+
+    def test_number_in_title(self):
+        self.assertEqual(
+            "show 2 name", daemon.series_key(Path("Show 2 Name S01E01.mkv"))
+        )
+
+
+class TestDebouncer(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.root = Path(self.dir.name)
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def make(self, name, data=b"data"):
+        path = self.root / name
+        path.write_bytes(data)
+        return path
+
+    def test_debounce(self):
+        path = self.make("Show S01E01.mkv")
+        debouncer = daemon.Debouncer(debounce=5, max_wait=60)
+        debouncer.add(path, now=0)
+
+        self.assertListEqual([], debouncer.ready(now=1))
+        self.assertListEqual([[path]], debouncer.ready(now=5))
+        self.assertEqual(0, len(debouncer))
+
+    def test_event_resets_debounce(self):
+        path = self.make("Show S01E01.mkv")
+        debouncer = daemon.Debouncer(debounce=5, max_wait=60)
+        debouncer.add(path, now=0)
+        debouncer.add(path, now=4)
+
+        self.assertListEqual([], debouncer.ready(now=5))
+        self.assertListEqual([[path]], debouncer.ready(now=9))
+
+    def test_growing_file(self):
+        path = self.make("Show S01E01.mkv")
+        debouncer = daemon.Debouncer(debounce=5, max_wait=60)
+        debouncer.add(path, now=0)
+        path.write_bytes(b"more data")
+
+        self.assertListEqual([], debouncer.ready(now=5))
+        self.assertListEqual([[path]], debouncer.ready(now=10))
+
+    def test_batch_by_series(self):
+        a1 = self.make("A S01E01.mkv")
+        a2 = self.make("A S01E02.mkv")
+        b1 = self.make("B S01E01.mkv")
+        debouncer = daemon.Debouncer(debounce=5, max_wait=60)
+        debouncer.add(a1, now=0)
+        debouncer.add(b1, now=0)
+        debouncer.add(a2, now=3)
+
+        # A is held until all of its files settle
+        self.assertListEqual([[b1]], debouncer.ready(now=5))
+        self.assertListEqual([[a1, a2]], debouncer.ready(now=8))
+
+    def test_max_wait(self):
+        a1 = self.make("A S01E01.mkv")
+        a2 = self.make("A S01E02.mkv")
+        debouncer = daemon.Debouncer(debounce=5, max_wait=10)
+        debouncer.add(a1, now=0)
+        debouncer.add(a2, now=9)
+
+        self.assertListEqual([], debouncer.ready(now=8))
+        self.assertListEqual([[a1]], debouncer.ready(now=10))
+        self.assertListEqual([[a2]], debouncer.ready(now=14))
+
+    def test_deleted_file(self):
+        path = self.make("Show S01E01.mkv")
+        debouncer = daemon.Debouncer(debounce=5, max_wait=60)
+        debouncer.add(path, now=0)
+        path.unlink()
+
+        self.assertListEqual([], debouncer.ready(now=5))
+        self.assertEqual(0, len(debouncer))
+
+
+class TestWatchers(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.root = Path(self.dir.name)
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    @unittest.skipUnless(sys.platform.startswith("linux"), "requires inotify")
+    def test_inotify(self):
+        watcher = daemon.InotifyWatcher([self.root])
+        try:
+            file = self.root / "a.mkv"
+            file.write_bytes(b"data")
+            self.assertSetEqual({file}, watcher.poll(1))
+
+            # Files in new folders are found and the folder is watched
+            season = self.root / "Season 1"
+            season.mkdir()
+            self.assertSetEqual(set(), watcher.poll(1))
+            file = season / "b.mkv"
+            file.write_bytes(b"data")
+            self.assertSetEqual({file}, watcher.poll(1))
+        finally:
+            watcher.close()
+
+    def test_polling(self):
+        existing = self.root / "a.mkv"
+        existing.write_bytes(b"data")
+        watcher = daemon.PollingWatcher([self.root], interval=0)
+
+        file = self.root / "b.mkv"
+        file.write_bytes(b"data")
+        self.assertSetEqual({file}, watcher.poll(0))
+        self.assertSetEqual(set(), watcher.poll(0))
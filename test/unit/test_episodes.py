@@ -0,0 +1,161 @@
+import time
+import unittest
+import unittest.mock as mock
+import tempfile
+from pathlib import Path
+
+from mediama.config import normalize_config
+from mediama.episodes import EpisodeCache, EpisodeDelta, air_time, merge_episodes
+from mediama.managers import Source, SourceManager
+from mediama.metadata import VariablePool
+from mediama.prefetch import Prefetcher
+from mediama.trace import Tracer
+
+
+class AiringSource(Source):
+    # The provider's list, which gains an episode on each fetch
+    calls: list = []
+
+    def fetch_episodes_delta(self, validator=None, **kwargs):
+        self.calls.append(validator)
+        count = len(self.calls) + 1
+        if validator is None:
+            episodes = [{"episode": i} for i in range(1, count + 1)]
+            return EpisodeDelta(episodes, count, full=True)
+        episodes = [{"episode": i} for i in range(validator + 1, count + 1)]
+        return EpisodeDelta(episodes, count)
+
+
+class ScheduledSource(Source):
+    # A series whose next episode airs in an hour
+    calls: list = []
+    next_air = 0.0
+
+    def fetch_episodes_delta(self, validator=None, **kwargs):
+        self.calls.append(self.metadata.get("name", "src"))
+        episodes = [
+            {"episode": 1, "air_date": "2020-01-01"},
+            {"episode": 2, "air_date": self.next_air},
+        ]
+        return EpisodeDelta(episodes, None, full=True)
+
+
+class TestAirTime(unittest.TestCase):
+    def test_formats(self):
+        self.assertEqual(1577836800, air_time({"air_date": "2020-01-01"}))
+        self.assertEqual(1577840400, air_time({"aired": "2020-01-01T02:00:00+01:00"}))
+        self.assertEqual(5, air_time({"first_aired": 5}))
+        self.assertIsNone(air_time({"air_date": "soon"}))
+        self.assertIsNone(air_time({"episode": 1}))
+
+
+class TestMergeEpisodes(unittest.TestCase):
+    def test_merge(self):
+        episodes = [{"id": 1, "name": "a"}, {"id": 2, "name": "b"}]
+        delta = [
+            {"id": 2, "name": "B"},
+            {"id": 3, "name": "c"},
+            {"id": 1, "deleted": True},
+        ]
+
+        self.assertListEqual(
+            [{"id": 2, "name": "B"}, {"id": 3, "name": "c"}],
+            merge_episodes(episodes, delta),
+        )
+
+    def test_season_and_number(self):
+        episodes = [{"season": 1, "episode": 1}, {"season": 2, "episode": 1}]
+        delta = [{"season": 2, "episode": 1, "name": "x"}]
+
+        self.assertListEqual(
+            [{"season": 1, "episode": 1}, {"season": 2, "episode": 1, "name": "x"}],
+            merge_episodes(episodes, delta),
+        )
+
+
+class TestEpisodeCache(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.cache = EpisodeCache(Path(tmp.name, "episodes.db"))
+        self.cfg = normalize_config({"cache": None, "state": None})
+        self.pool = VariablePool(self.cfg, id_="mediama")
+        self.pool.set_({"name": "Show"}, "src")
+        self.mgr = SourceManager(self.cfg, None).bind(self.pool)
+        self.mgr._tasks = {"AiringSource": AiringSource}
+        self.mgr.episode_cache = self.cache
+        AiringSource.calls = []
+
+    def fetch(self):
+        pages = self.mgr.execute_task(
+            AiringSource(self.pool), "fetch_episodes", task_id="src"
+        )
+        return [episode["episode"] for page in pages for episode in page]
+
+    def test_revalidate(self):
+        self.assertListEqual([1, 2], self.fetch())
+        # Fresh lists are used as they are
+        self.assertListEqual([1, 2], self.fetch())
+        self.assertListEqual([None], AiringSource.calls)
+
+        self.cache.refresh = 0
+        self.assertListEqual([1, 2, 3], self.fetch())
+        self.assertListEqual([None, 2], AiringSource.calls)
+
+    def test_settings(self):
+        self.cache.put("src", "series", {"limit": 1}, [{"episode": 1}], "etag")
+
+        self.assertEqual("etag", self.cache.get("src", "series", {"limit": 1})[1])
+        self.assertIsNone(self.cache.get("src", "series", {"limit": 2}))
+
+    def test_without_cache(self):
+        self.mgr.episode_cache = None
+
+        # Sources that only fetch deltas still return every episode
+        self.assertListEqual([1, 2], self.fetch())
+        self.assertListEqual([1, 2, 3], self.fetch())
+
+
+class TestPrefetcher(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.cache = EpisodeCache(Path(tmp.name, "episodes.db"))
+        self.cfg = normalize_config(
+            {
+                "cache": None,
+                "state": None,
+                "sources": [{"name": "ScheduledSource", "id": "src", "kwargs": {}}],
+            }
+        )
+        src_mgr = SourceManager(self.cfg, None)
+        src_mgr._tasks = {"ScheduledSource": ScheduledSource}
+        src_mgr.episode_cache = self.cache
+        src_mgr.tracer = Tracer(False)
+        self.engine = mock.Mock(cfg=self.cfg, episodes=self.cache, src_mgr=src_mgr)
+        self.prefetcher = Prefetcher(self.engine, lead=2 * 60 * 60)
+        ScheduledSource.calls = []
+        ScheduledSource.next_air = time.time() + 60 * 60
+
+        pool = VariablePool(self.cfg, id_="mediama")
+        pool.set_({"name": "Show"}, "src")
+        src_mgr.bind(pool).fetch_revalidated(ScheduledSource(pool), "src")
+
+    def test_prefetch(self):
+        self.assertEqual(1, self.prefetcher.run_once())
+        # The pool the list was fetched with is rebuilt for the source
+        self.assertListEqual(["Show", "Show"], ScheduledSource.calls)
+
+        # Series are prefetched once per episode
+        self.assertEqual(0, self.prefetcher.run_once())
+        self.assertEqual(2, len(ScheduledSource.calls))
+
+    def test_lead(self):
+        self.prefetcher.lead = 60
+        self.assertEqual(0, self.prefetcher.run_once())
+        self.assertEqual(1, len(ScheduledSource.calls))
+
+    def test_removed_source(self):
+        self.cfg["sources"] = []
+        self.assertEqual(0, self.prefetcher.run_once())
+        self.assertEqual(1, len(ScheduledSource.calls))
@@ -0,0 +1,109 @@
+import unittest
+import unittest.mock as mock
+import threading
+
+from mediama.health import CircuitOpen, Health
+from mediama.trace import Metrics
+
+
+def fail():
+    raise RuntimeError("provider is down")
+
+
+class TestHealth(unittest.TestCase):
+    def setUp(self):
+        self.health = Health(failures=2, cooldown=60, initial=2, maximum=4)
+
+    def test_breaker(self):
+        for _ in range(2):
+            with self.assertRaises(RuntimeError):
+                self.health.call("src_0", fail, 5)
+
+        func = mock.Mock()
+        with self.assertRaises(CircuitOpen):
+            self.health.call("src_0", func, 5)
+        func.assert_not_called()
+        stats = self.health.stats()["src_0"]
+        self.assertEqual("open", stats["state"])
+        self.assertEqual(1, stats["rejected"])
+
+        # Other sources are not affected
+        self.assertEqual(1, self.health.call("src_1", lambda: 1, 5))
+
+    @mock.patch("mediama.health.time.monotonic")
+    def test_cooldown(self, monotonic):
+        monotonic.return_value = 0
+        for _ in range(2):
+            with self.assertRaises(RuntimeError):
+                self.health.call("src_0", fail, 5)
+
+        # A single trial is let through once the breaker cools down
+        monotonic.return_value = 61
+        with self.assertRaises(RuntimeError):
+            self.health.call("src_0", fail, 5)
+        self.assertEqual("open", self.health.stats()["src_0"]["state"])
+
+        monotonic.return_value = 122
+        self.assertEqual(1, self.health.call("src_0", lambda: 1, 5))
+        self.assertEqual("closed", self.health.stats()["src_0"]["state"])
+
+    def test_aimd(self):
+        self.health.call("src_0", lambda: 1, 5)
+        self.health.call("src_0", lambda: 1, 5)
+        self.assertEqual(4, self.health.stats()["src_0"]["limit"])
+
+        with self.assertRaises(RuntimeError):
+            self.health.call("src_0", fail, 5)
+        self.assertEqual(2, self.health.stats()["src_0"]["limit"])
+
+        self.health.timed_out("src_0")
+        stats = self.health.stats()["src_0"]
+        self.assertEqual(1, stats["limit"])
+        self.assertEqual(1, stats["timeouts"])
+
+    def test_limit(self):
+        self.health = Health(initial=1, maximum=1)
+        started = threading.Event()
+        release = threading.Event()
+
+        def slow():
+            started.set()
+            release.wait(5)
+            return 1
+
+        thread = threading.Thread(target=self.health.call, args=("src_0", slow, 5))
+        thread.start()
+        started.wait(5)
+
+        with self.assertRaises(TimeoutError):
+            self.health.call("src_0", lambda: 2, 0.05)
+        release.set()
+        thread.join()
+        self.assertEqual(2, self.health.call("src_0", lambda: 2, 5))
+        self.assertEqual(0, self.health.stats()["src_0"]["inflight"])
+
+    def test_stream(self):
+        pages = self.health.call("src_0", lambda: iter([[1], [2]]), 5)
+        self.assertEqual(1, self.health.stats()["src_0"]["inflight"])
+
+        self.assertListEqual([[1], [2]], list(pages))
+        stats = self.health.stats()["src_0"]
+        self.assertEqual(0, stats["inflight"])
+        self.assertEqual(1, stats["calls"])
+
+        # A stream closed early gives its slot back without counting
+        pages = self.health.call("src_0", lambda: iter([[1], [2]]), 5)
+        next(pages)
+        pages.close()
+        stats = self.health.stats()["src_0"]
+        self.assertEqual(0, stats["inflight"])
+        self.assertEqual(1, stats["calls"])
+
+    def test_metrics(self):
+        metrics = Metrics()
+        metrics.health = self.health
+        self.health.call("src_0", lambda: 1, 5)
+
+        body = metrics.render()
+        self.assertIn('mediama_source_limit{task="src_0"} 3', body)
+        self.assertIn('mediama_source_open{task="src_0"} 0', body)
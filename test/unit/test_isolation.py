@@ -0,0 +1,148 @@
+import os
+import sys
+import unittest
+import tempfile
+from pathlib import Path
+
+from mediama.config import normalize_config
+from mediama.core import execute_process
+from mediama.isolation import WorkerPool
+from mediama.managers import PreProcessManager, SourceManager
+from mediama.metadata import VariablePool
+
+PLUGINS = """
+import os
+
+from mediama.managers import PreProcess, Source
+
+
+class Tag(PreProcess):
+    def main(self, value=1):
+        self.metadata["tagged"] = value
+        return {"pid": os.getpid(), "files": len(self.metadata["filepaths"])}
+
+
+class Fail(PreProcess):
+    def main(self):
+        raise ValueError("bad plugin")
+
+
+class Crash(PreProcess):
+    def main(self):
+        os._exit(3)
+
+
+class Pages(Source):
+    def fetch_episodes(self, pages=3):
+        for i in range(pages):
+            yield [{"episode": i, "pid": os.getpid()}]
+"""
+
+
+class TestWorkerPool(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp = tempfile.TemporaryDirectory()
+        Path(cls.tmp.name, "isolated_plugins.py").write_text(PLUGINS)
+        cls.cfg = normalize_config(
+            {
+                "pres": [
+                    {"name": "Tag", "id": "tag"},
+                    {"name": "Fail", "id": "fail"},
+                    {"name": "Crash", "id": "crash"},
+                ],
+                "sources": [{"name": "Pages", "id": "pages"}],
+                "search_dirs": [cls.tmp.name],
+                "cache": None,
+                "state": None,
+            }
+        )
+
+    @classmethod
+    def tearDownClass(cls):
+        sys.modules.pop("isolated_plugins", None)
+        cls.tmp.cleanup()
+
+    def setUp(self):
+        self.workers = WorkerPool(self.cfg, workers=1, max_tasks=3)
+        self.addCleanup(self.workers.close)
+        self.pool = VariablePool(self.cfg, id_="mediama")
+        self.pool["filepaths"] = [Path("a.mkv"), Path("b.mkv")]
+        self.mgr = PreProcessManager(self.cfg, self.pool)
+        self.mgr.workers = self.workers
+
+    def run_task(self, index: int):
+        return execute_process(self.mgr, self.cfg["pres"][index])
+
+    def test_call(self):
+        data = self.run_task(0)
+
+        self.assertNotEqual(data["pid"], os.getpid())
+        self.assertEqual(2, data["files"])
+        # Results and the values the task wrote are back in the pool
+        self.assertEqual(data, self.pool.snapshot(["pid", "files"]))
+        self.assertEqual(1, self.pool["tagged"])
+
+    def test_warm(self):
+        self.workers.start()
+        pids = {self.run_task(0)["pid"] for _ in range(3)}
+
+        self.assertEqual(1, len(pids))
+
+    def test_error(self):
+        pid = self.run_task(0)["pid"]
+        with self.assertRaisesRegex(ValueError, "bad plugin"):
+            self.run_task(1)
+
+        # The worker survives errors of its plugins
+        self.assertEqual(pid, self.run_task(0)["pid"])
+
+    def test_crash(self):
+        with self.assertRaisesRegex(RuntimeError, "exited with code 3"):
+            self.run_task(2)
+
+        self.assertEqual(2, self.run_task(0)["files"])
+
+    def test_recycle(self):
+        pids = [self.run_task(0)["pid"] for _ in range(4)]
+
+        self.assertEqual(1, len(set(pids[:3])))
+        self.assertNotEqual(pids[2], pids[3])
+        self.assertEqual(1, self.workers.recycled)
+
+    def test_pages(self):
+        mgr = SourceManager(self.cfg, self.pool)
+        mgr.workers = self.workers
+        task = self.cfg["sources"][0]
+
+        pages = execute_process(mgr, task, name="fetch_episodes", set_metadata=False)
+        self.assertListEqual([0, 1, 2], [page[0]["episode"] for page in pages])
+
+        # A stream closed early hands its worker back
+        pages = execute_process(mgr, task, name="fetch_episodes", set_metadata=False)
+        pid = next(pages)[0]["pid"]
+        pages.close()
+        self.assertEqual(pid, self.run_task(0)["pid"])
+
+    def test_concurrent(self):
+        mgr = SourceManager(self.cfg, self.pool)
+        mgr.workers = self.workers
+        task = self.cfg["sources"][0]
+
+        def producer():
+            return execute_process(mgr, task, name="fetch_episodes", set_metadata=False)
+
+        pages = [
+            page
+            for _, page in mgr.stream_episodes({"a": producer, "b": producer}, 60)
+            if page
+        ]
+        # Busy workers do not block each other and extra workers are started
+        self.assertEqual(6, len(pages))
+        self.assertEqual(2, len({page[0]["pid"] for page in pages}))
+
+    def test_builtins(self):
+        from mediama.preprocessors.metadata import Metadata
+
+        self.assertFalse(self.workers.isolates(Metadata))
+        self.assertTrue(WorkerPool(self.cfg, builtins=True).isolates(Metadata))
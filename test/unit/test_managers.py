@@ -1,11 +1,14 @@
 import unittest
 import unittest.mock as mock
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 import importlib
 from textwrap import dedent
 
 
 import mediama.managers as managers
+from mediama.config import normalize_config
+from mediama.metadata import VariablePool, PerFile
 
 
 @mock.patch("mediama.managers.discover_modules")
@@ -132,3 +135,251 @@ class TestBaseTaskManager_discover_tasks(unittest.TestCase):
         discover_modules_mock.assert_called_once()
         import_module_from_path_mock.assert_called_once()
         get_subclasses_from_module_mock.assert_called_once()
+
+
+class TestSourceManager_episodes(unittest.TestCase):
+    def setUp(self):
+        cfg = normalize_config({"search_dirs": [], "ranks": 5})
+        self.mgr = managers.SourceManager(cfg, mock.Mock())
+        # Match a page of episodes by the file they name
+        self.mgr.disambiguate_episodes = lambda page: {
+            Path(ep["file"]): ep for ep in page if "file" in ep
+        }
+
+    def test_stream_episodes(self):
+        producers = {
+            "src_0": lambda: iter([[{"name": "e1"}], [{"name": "e2"}]]),
+            "src_1": lambda: iter([[{"name": "e3"}]]),
+        }
+        results = list(self.mgr.stream_episodes(producers, 5))
+
+        self.assertListEqual(
+            [[{"name": "e1"}], [{"name": "e2"}], None],
+            [page for id_, page in results if id_ == "src_0"],
+        )
+        self.assertListEqual(
+            [[{"name": "e3"}], None], [page for id_, page in results if id_ == "src_1"]
+        )
+
+    def test_stream_episodes_source_error(self):
+        def failing():
+            yield [{"name": "e1"}]
+            raise RuntimeError
+
+        results = list(self.mgr.stream_episodes({"src_0": failing}, 5))
+        self.assertListEqual([("src_0", [{"name": "e1"}]), ("src_0", None)], results)
+
+    def test_match_resolves_before_stream_ends(self):
+        def pages():
+            yield "src_0", [{"file": "a.mkv"}]
+            yield "src_0", [{"file": "b.mkv"}]
+            raise AssertionError("Stream should have been closed")
+
+        results = self.mgr.match_episodes(
+            pages(), [Path("a.mkv"), Path("b.mkv")], ["src_0"]
+        )
+        self.assertEqual((Path("a.mkv"), {"src_0": {"file": "a.mkv"}}), next(results))
+        self.assertEqual((Path("b.mkv"), {"src_0": {"file": "b.mkv"}}), next(results))
+        with self.assertRaises(StopIteration):
+            next(results)
+
+    def test_match_waits_for_active_sources(self):
+        pages = [
+            ("src_0", [{"file": "a.mkv", "src": 0}]),
+            ("src_1", [{"file": "b.mkv", "src": 1}]),
+            ("src_0", None),
+            ("src_1", [{"file": "a.mkv", "src": 1}]),
+            ("src_1", None),
+        ]
+        results = list(
+            self.mgr.match_episodes(
+                iter(pages), [Path("a.mkv"), Path("b.mkv")], ["src_0", "src_1"]
+            )
+        )
+        expected = [
+            (Path("b.mkv"), {"src_1": {"file": "b.mkv", "src": 1}}),
+            (
+                Path("a.mkv"),
+                {
+                    "src_0": {"file": "a.mkv", "src": 0},
+                    "src_1": {"file": "a.mkv", "src": 1},
+                },
+            ),
+        ]
+        self.assertListEqual(expected, results)
+
+    def test_unmatched_files_are_not_yielded(self):
+        pages = [("src_0", [{"file": "a.mkv"}]), ("src_0", None)]
+        results = list(
+            self.mgr.match_episodes(
+                iter(pages), [Path("a.mkv"), Path("b.mkv")], ["src_0"]
+            )
+        )
+        self.assertListEqual([(Path("a.mkv"), {"src_0": {"file": "a.mkv"}})], results)
+
+    def test_ambiguous_candidates(self):
+        self.mgr.disambiguate_episodes = mock.Mock(side_effect=ValueError)
+        pages = [
+            ("src_0", [{"episode": i} for i in range(1, 51)]),
+            ("src_0", [{"episode": i} for i in range(51, 101)]),
+            ("src_0", None),
+        ]
+        ambiguous = []
+        files = [Path("Show - 05.mkv"), Path("Show - 60.mkv")]
+        list(self.mgr.match_episodes(iter(pages), files, ["src_0"], ambiguous))
+
+        # Only the episodes around the numbers of the files are kept
+        self.assertListEqual(
+            [4, 5, 6, 59, 60, 61], [episode["episode"] for _, episode in ambiguous]
+        )
+
+        ambiguous = []
+        pages = [("src_0", [{"title": str(i)} for i in range(100)]), ("src_0", None)]
+        list(self.mgr.match_episodes(iter(pages), files, ["src_0"], ambiguous))
+        self.assertEqual(2 * managers.CANDIDATES_PER_FILE, len(ambiguous))
+
+
+class TestSourceManager_route(unittest.TestCase):
+    class Anime(managers.Source):
+        capabilities = {"kinds": ["anime"], "languages": ["ja", "en"]}
+
+        def fetch_series(self):
+            return []
+
+        def fetch_episodes(self):
+            return []
+
+    class Movies(managers.Source):
+        capabilities = {"kinds": ["movie"]}
+
+        def fetch_series(self):
+            return []
+
+    class Any(managers.Source):
+        def fetch_series(self):
+            return []
+
+        def fetch_episodes(self):
+            return []
+
+    def setUp(self):
+        cfg = normalize_config({"cache": None, "state": None})
+        self.pool = VariablePool(cfg, id_="mediama")
+        self.mgr = managers.SourceManager(cfg, self.pool)
+        self.mgr._tasks = {
+            "Anime": self.Anime,
+            "Movies": self.Movies,
+            "Any": self.Any,
+        }
+        self.tasks = [
+            {"name": name, "id": name.lower(), "kwargs": {}}
+            for name in ("Anime", "Movies", "Any", "Unknown")
+        ]
+
+    def route(self, lookup: str):
+        return [task["id"] for task in self.mgr.route(self.tasks, lookup)]
+
+    def test_no_features(self):
+        self.assertListEqual(
+            ["anime", "movies", "any", "unknown"], self.route("fetch_series")
+        )
+        # Lookups default to the methods the source implements
+        self.assertListEqual(["anime", "any", "unknown"], self.route("fetch_episodes"))
+
+    def test_kind(self):
+        self.pool["kind"] = "anime"
+
+        self.assertListEqual(["anime", "any", "unknown"], self.route("fetch_series"))
+
+    def test_probed_languages(self):
+        probe = {"a.mkv": {"audio_languages": ["fr", "und"]}, "b.mkv": None}
+        self.pool.set_({"probe": PerFile(probe)}, "mediama")
+
+        self.assertDictEqual({"languages": {"fr"}}, self.mgr.features())
+        self.assertListEqual(["movies", "any", "unknown"], self.route("fetch_series"))
+
+    def test_declared_lookups(self):
+        self.Any.capabilities = {"lookups": ["fetch_episodes"]}
+        self.addCleanup(setattr, self.Any, "capabilities", {})
+
+        self.assertListEqual(["anime", "movies", "unknown"], self.route("fetch_series"))
+
+
+class TestSourceManager_lookup(unittest.TestCase):
+    class Batched(managers.Source):
+        calls: list = []
+
+        def fetch_series(self, num_ranks):
+            self.calls.append(1)
+            return [{"name": self.metadata["title"]}]
+
+        def fetch_series_many(self, pools, num_ranks):
+            self.calls.append(len(pools))
+            return [[{"name": pool["title"]}] for pool in pools]
+
+    def setUp(self):
+        self.cfg = normalize_config({"cache": None, "state": None})
+        self.mgr = managers.SourceManager(self.cfg, None)
+        self.mgr._tasks = {"Batched": self.Batched}
+        self.Batched.calls = []
+
+    def lookup(self, title: str):
+        pool = VariablePool(self.cfg, id_="mediama")
+        pool["title"] = title
+        mgr = self.mgr.bind(pool)
+        return mgr.execute_task(self.Batched(pool), "fetch_series", task_id="src")
+
+    def lookup_all(self, titles):
+        with ThreadPoolExecutor(len(titles)) as executor:
+            return list(executor.map(self.lookup, titles))
+
+    def test_coalesce(self):
+        self.mgr.coalesce = {"window": 0.5, "max_size": 3}
+        results = self.lookup_all(["a", "b", "c"])
+
+        self.assertListEqual(
+            ["a", "b", "c"], [ranking[0]["name"] for ranking in results]
+        )
+        # The batch is called as soon as it is full
+        self.assertListEqual([3], self.Batched.calls)
+
+    def test_fallback(self):
+        def fail(self, pools, num_ranks):
+            raise RuntimeError("batch endpoint is down")
+
+        self.mgr.coalesce = {"window": 0.05, "max_size": 2}
+        with mock.patch.object(self.Batched, "fetch_series_many", fail):
+            results = self.lookup_all(["a", "b"])
+
+        self.assertListEqual(["a", "b"], [ranking[0]["name"] for ranking in results])
+        self.assertListEqual([1, 1], self.Batched.calls)
+
+    def test_disabled(self):
+        self.mgr.coalesce = {"window": None, "max_size": 2}
+        self.lookup_all(["a", "b"])
+
+        self.assertListEqual([1, 1], self.Batched.calls)
+
+
+class TestBaseTaskManager_bind(unittest.TestCase):
+    def test_bind_shares_tasks(self):
+        cfg = {"search_dirs": []}
+        mgr = managers.BaseTaskManager(cfg, None)
+        mgr._tasks = {"SomeTask": managers.Task}
+        varpool = mock.Mock()
+
+        bound = mgr.bind(varpool)
+
+        self.assertIs(varpool, bound.metadata)
+        self.assertIsNone(mgr.metadata)
+        self.assertIs(mgr._tasks, bound._tasks)
+
+
+class TestBuiltinTasks(unittest.TestCase):
+    def test_builtin_postprocessors(self):
+        mgr = managers.PostProcessManager({"search_dirs": []}, None)
+        self.assertIn("Rename", mgr.discover_tasks())
+
+    def test_builtin_preprocessors(self):
+        mgr = managers.PreProcessManager({"search_dirs": []}, None)
+        self.assertIn("Metadata", mgr.discover_tasks())
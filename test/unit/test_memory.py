@@ -0,0 +1,83 @@
+import time
+import unittest
+import unittest.mock as mock
+import tempfile
+from pathlib import Path
+
+from mediama.config import normalize_config
+from mediama.memory import SeriesMemory, release_key
+
+
+class TestReleaseKey(unittest.TestCase):
+    def test_scene(self):
+        self.assertTupleEqual(
+            ("show name", "grp", "/tv/show name/season #"),
+            release_key(Path("/tv/Show Name/Season 1/Show.Name.S01E02.720p-GRP.mkv")),
+        )
+
+    def test_fansub(self):
+        self.assertTupleEqual(
+            ("show name", "subs", "/dl"),
+            release_key(Path("/dl/[Subs] Show Name - 05 (1080p) [ABCD].mkv")),
+        )
+
+    def test_seasons_share_pattern(self):
+        self.assertEqual(
+            release_key(Path("/tv/Show/Season 1/Show 1x01.mkv")),
+            release_key(Path("/tv/Show/Season 2/Show 2x05.mkv")),
+        )
+
+    def test_batch(self):
+        self.assertIsNone(
+            SeriesMemory.key([Path("/tv/A - S01E01.mkv"), Path("/tv/B - S01E01.mkv")])
+        )
+        self.assertIsNone(SeriesMemory.key([Path("/tv/S01E01.mkv")]))
+
+
+class TestSeriesMemory(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.memory = SeriesMemory(Path(self.tmp.name, "memory.db"), 2, 30)
+        self.sources = normalize_config(
+            {"sources": [{"name": "FakeSource", "id": "a"}]}
+        )["sources"]
+        self.key = ("show", "", "/tv")
+        self.rankings = [("a", [{"name": "Other"}, {"name": "Show", "id": 7}])]
+
+    def test_confidence(self):
+        self.memory.learn(self.key, "Show", self.rankings, self.sources)
+        self.assertIsNone(self.memory.recall(self.key, self.sources))
+
+        self.memory.learn(self.key, "Show", self.rankings, self.sources)
+        self.assertDictEqual(
+            {"a": {"name": "Show", "id": 7}}, self.memory.recall(self.key, self.sources)
+        )
+
+        # Another choice replaces the series
+        self.memory.learn(self.key, "Other", self.rankings, self.sources)
+        self.assertIsNone(self.memory.recall(self.key, self.sources))
+
+    def test_answered(self):
+        self.memory.learn(self.key, "Show", self.rankings, self.sources, answered=True)
+
+        self.assertIsNotNone(self.memory.recall(self.key, self.sources))
+
+    def test_expiry(self):
+        self.memory.learn(self.key, "Show", self.rankings, self.sources, answered=True)
+
+        later = time.time() + 31 * 24 * 60 * 60
+        with mock.patch("mediama.memory.time.time", return_value=later):
+            self.assertIsNone(self.memory.recall(self.key, self.sources))
+
+    def test_source_settings(self):
+        self.memory.learn(self.key, "Show", self.rankings, self.sources, answered=True)
+        sources = [{**self.sources[0], "kwargs": {"language": "fr"}}]
+
+        self.assertIsNone(self.memory.recall(self.key, sources))
+
+    def test_persistent(self):
+        self.memory.learn(self.key, "Show", self.rankings, self.sources, answered=True)
+        memory = SeriesMemory(self.memory.path, 2, 30)
+
+        self.assertIsNotNone(memory.recall(self.key, self.sources))
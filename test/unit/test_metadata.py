@@ -0,0 +1,84 @@
+import unittest
+from pathlib import Path
+
+from mediama.metadata import VariablePool, PerFile
+
+
+def make_cfg():
+    return {
+        "pres": [{"name": "Probe", "id": "pre_0"}],
+        "sources": [
+            {"name": "Source", "id": "src_0"},
+            {"name": "Source", "id": "src_1"},
+        ],
+        "posts": [],
+        "key_sources": {},
+    }
+
+
+class TestVariablePool(unittest.TestCase):
+    def setUp(self):
+        self.pool = VariablePool(make_cfg(), id_="mediama")
+        self.a = Path("a.mkv")
+        self.b = Path("b.mkv")
+        self.pool.set_({"title": "Show", "resolution": "?"}, "src_1")
+        self.pool.set_({"resolution": "1080p"}, "pre_0", self.a)
+        self.pool.set_({"resolution": "720p"}, "pre_0", self.b)
+        self.pool.set_({"resolution": "2160p"}, "src_0", self.b)
+
+    def test_scoped(self):
+        a = self.pool.scoped(self.a)
+        self.assertEqual("1080p", a["resolution"])
+        # Keys the file does not have fall back to the batch
+        self.assertEqual("Show", a["title"])
+        self.assertEqual("?", self.pool["resolution"])
+
+        self.assertEqual("2160p", self.pool.get("resolution", file=self.b))
+        self.assertEqual("720p", self.pool.get("resolution", "pre_0", self.b))
+        self.assertEqual("?", self.pool.scoped(self.b).get("resolution", "src_1"))
+        with self.assertRaises(KeyError):
+            self.pool.scoped(Path("c.mkv"))["episode"]
+
+    def test_scoped_set(self):
+        self.pool.scoped(self.a)["episode"] = 1
+
+        self.assertEqual(1, self.pool.get("episode", "mediama", self.a))
+        with self.assertRaises(KeyError):
+            self.pool["episode"]
+
+    def test_files(self):
+        self.assertDictEqual(
+            {self.a: "1080p", self.b: "2160p"}, self.pool.files("resolution")
+        )
+        self.assertDictEqual(
+            {self.a: "1080p", self.b: "720p"}, self.pool.files("resolution", "pre_0")
+        )
+        self.assertDictEqual({}, self.pool.files("title"))
+
+    def test_per_file(self):
+        self.pool.set_({"probe": PerFile({self.a: {"height": 1080}}), "n": 1}, "pre_0")
+
+        self.assertEqual({"height": 1080}, self.pool.get("probe", "pre_0", self.a))
+        self.assertEqual(1, self.pool["n"])
+        with self.assertRaises(KeyError):
+            self.pool["probe"]
+        self.assertDictEqual(
+            {self.a: {"resolution": "1080p"}, self.b: {"resolution": "2160p"}},
+            self.pool.file_snapshots(["resolution"]),
+        )
+
+    def test_snapshot(self):
+        self.assertDictEqual({"title": "Show", "resolution": "?"}, self.pool.snapshot())
+        self.assertDictEqual(
+            {"title": "Show", "resolution": "1080p"},
+            self.pool.scoped(self.a).snapshot(),
+        )
+
+    def test_dump_and_load(self):
+        rows = self.pool.dump()
+        self.assertIn(("pre_0", "resolution", "1080p", "a.mkv"), rows)
+        self.assertIn(("src_1", "title", "Show"), rows)
+
+        pool = VariablePool(make_cfg(), id_="mediama")
+        pool.load(rows)
+        self.assertCountEqual(rows, pool.dump())
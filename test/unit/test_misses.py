@@ -0,0 +1,67 @@
+import unittest
+import tempfile
+from pathlib import Path
+
+from mediama.config import normalize_config
+from mediama.managers import Source, SourceManager
+from mediama.metadata import VariablePool
+from mediama.misses import MissCache
+
+
+class EmptySource(Source):
+    calls: list = []
+
+    def fetch_series(self, num_ranks, **kwargs):
+        self.calls.append("series")
+        return []
+
+    def fetch_episodes(self, **kwargs):
+        self.calls.append("episodes")
+        yield []
+
+
+class TestMissCache(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.misses = MissCache(Path(tmp.name, "misses.db"), ttl=60)
+
+        cfg = normalize_config({"cache": None, "state": None})
+        self.pool = VariablePool(cfg, id_="mediama")
+        self.pool["filepaths"] = [Path("[Subs] Rare Special - 01.mkv")]
+        self.mgr = SourceManager(cfg, None).bind(self.pool)
+        self.mgr._tasks = {"EmptySource": EmptySource}
+        self.mgr.misses = self.misses
+        EmptySource.calls = []
+
+    def fetch(self, name: str):
+        result = self.mgr.execute_task(EmptySource(self.pool), name, task_id="src")
+        return list(result)
+
+    def test_series(self):
+        self.assertListEqual([], self.fetch("fetch_series"))
+        self.assertListEqual([], self.fetch("fetch_series"))
+
+        self.assertListEqual(["series"], EmptySource.calls)
+
+    def test_episodes(self):
+        self.fetch("fetch_episodes")
+        self.fetch("fetch_episodes")
+
+        self.assertListEqual(["episodes"], EmptySource.calls)
+
+    def test_ttl(self):
+        self.fetch("fetch_series")
+        self.misses.ttl = 0
+        self.fetch("fetch_series")
+
+        self.assertListEqual(["series", "series"], EmptySource.calls)
+
+    def test_forget(self):
+        self.fetch("fetch_series")
+        self.fetch("fetch_episodes")
+
+        self.assertEqual(0, self.misses.forget(["other"]))
+        self.assertEqual(2, self.misses.forget(["rare special"], "src"))
+        self.fetch("fetch_series")
+        self.assertListEqual(["series", "episodes", "series"], EmptySource.calls)
@@ -0,0 +1,157 @@
+import unittest
+import unittest.mock as mock
+import tempfile
+import json
+from pathlib import Path
+
+import mediama.plan as plan
+from mediama.core import plan_posts, apply_posts
+from mediama.metadata import VariablePool, PerFile
+
+
+def make_cfg():
+    return {
+        "pres": [],
+        "sources": [
+            {"name": "Source", "id": "src_0"},
+            {"name": "Source", "id": "src_1"},
+        ],
+        "posts": [
+            {"name": "Format", "id": "post_0", "kwargs": {}},
+            {"name": "Rename", "id": "post_1", "kwargs": {}},
+            {"name": "Other", "id": "post_2", "kwargs": {}},
+        ],
+        "key_sources": {},
+    }
+
+
+class Pure:
+    side_effects = False
+
+
+class Effectful:
+    side_effects = True
+
+
+TASKS = {"Format": Pure, "Rename": Effectful, "Other": Effectful}
+
+
+class TestCodec(unittest.TestCase):
+    def test_roundtrip(self):
+        value = {Path("a"): (1, [Path("b"), None]), "x": {"y": {1, 2}}, "z": 1.5}
+        encoded = json.loads(json.dumps(plan._encode(value)))
+        self.assertEqual(value, plan._decode(encoded))
+
+    def test_unsupported(self):
+        with self.assertRaises(TypeError):
+            plan._encode({"x": object()})
+
+    def test_pickle_not_loaded(self):
+        # Hand-written plans cannot make apply run code
+        value = {"__pickle__": "gASVAAAAAAAAAAA="}
+        self.assertEqual(value, plan._decode(value))
+
+
+class TestPlan(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.root = Path(self.dir.name)
+        self.a = self.root / "a.mkv"
+        self.b = self.root / "b.mkv"
+        self.c = self.root / "c.mkv"
+        for path in (self.a, self.b, self.c):
+            path.write_bytes(b"data")
+
+        self.cfg = make_cfg()
+        self.varpool = VariablePool(self.cfg, id_="mediama")
+        episodes = {
+            self.a: {"src_0": {"title": "Pilot"}, "src_1": {"title": "Pilot"}},
+            self.b: {"src_0": {"title": "Second"}},
+        }
+        self.varpool.set_({"episodes": PerFile(episodes)}, "mediama")
+        self.varpool.set_({"destinations": {self.a: self.root / "A.mkv"}}, "post_0")
+        self.varpool.set_({"height": 1080}, "src_0", self.a)
+        self.varpool.set_({"height": 720}, "src_0", self.b)
+        changes = {"post_1": {self.a: str(self.root / "A.mkv")}}
+        self.plan = plan.build_plan(
+            self.varpool,
+            [self.a, self.b, self.c],
+            self.cfg,
+            changes,
+            ["post_2"],
+            {"posts": "x"},
+        )
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_files(self):
+        files = self.plan["files"]
+        self.assertListEqual([str(self.a), str(self.b)], list(files))
+        self.assertListEqual([str(self.c)], self.plan["unmatched"])
+        self.assertEqual(1, files[str(self.a)]["confidence"])
+        self.assertEqual(0.5, files[str(self.b)]["confidence"])
+        self.assertDictEqual(
+            {"post_1": str(self.root / "A.mkv")}, files[str(self.a)]["changes"]
+        )
+        self.assertDictEqual({}, files[str(self.b)]["changes"])
+
+    def test_save_and_load(self):
+        path = self.root / "plan.json"
+        plan.save_plan(self.plan, path)
+        self.assertEqual(self.plan, plan.load_plan(path))
+
+    def test_load_incompatible(self):
+        path = self.root / "plan.json"
+        path.write_text(json.dumps({"version": 0}))
+        with self.assertRaises(ValueError):
+            plan.load_plan(path)
+
+    def test_pool(self):
+        rows = plan.plan_pool(self.plan, [self.a])
+        pool = VariablePool(self.cfg, id_="mediama")
+        pool.load(rows)
+        self.assertListEqual([self.a], list(pool.files("episodes")))
+        self.assertEqual(self.root / "A.mkv", pool["destinations"][self.a])
+        # Only the values scoped to the files are kept
+        self.assertDictEqual({self.a: 1080}, pool.files("height"))
+
+    def test_reviewed_changes(self):
+        # A reviewer removed the rename of a
+        del self.plan["files"][str(self.a)]["changes"]["post_1"]
+        self.assertDictEqual({}, plan.plan_changes(self.plan, [self.a, self.b]))
+
+    def test_unchanged_files(self):
+        self.b.write_bytes(b"modified")
+        self.assertListEqual([self.a], plan.unchanged_files(self.plan))
+
+
+@mock.patch("mediama.core.execute_process")
+class TestPlanPosts(unittest.TestCase):
+    def test_plan(self, execute_process_mock):
+        execute_process_mock.side_effect = lambda mgr, task, name="main", **_: (
+            None if task["id"] == "post_2" else {"planned": name}
+        )
+        changes, deferred, ok = plan_posts(None, make_cfg(), TASKS)
+
+        self.assertDictEqual({"post_1": {"planned": "plan"}}, changes)
+        self.assertListEqual(["post_2"], deferred)
+        self.assertTrue(ok)
+        # Tasks without side effects run normally
+        self.assertEqual(
+            "main", execute_process_mock.call_args_list[0][1].get("name", "main")
+        )
+
+    def test_apply(self, execute_process_mock):
+        changes = {"post_1": {Path("a"): "b"}}
+        ok = apply_posts(None, make_cfg(), TASKS, changes, ["post_2"])
+
+        self.assertTrue(ok)
+        calls = execute_process_mock.call_args_list
+        self.assertEqual(2, len(calls))
+        self.assertEqual("post_1", calls[0][0][1]["id"])
+        self.assertDictEqual(
+            {"name": "apply", "changes": changes["post_1"]}, calls[0][1]
+        )
+        self.assertEqual("post_2", calls[1][0][1]["id"])
+        self.assertDictEqual({}, calls[1][1])
@@ -0,0 +1,193 @@
+import unittest
+import unittest.mock as mock
+import tempfile
+import struct
+from pathlib import Path
+
+import mediama.probe as probe
+import mediama.tags as tags
+from mediama.tags import ebml, atom
+
+
+def uint(id_, value, width=1):
+    return ebml(id_, value.to_bytes(width, "big"))
+
+
+def string(id_, value):
+    return ebml(id_, value.encode())
+
+
+def track(type_, codec, language=None, **children):
+    payload = uint(probe.EBML_TRACKTYPE, type_) + string(probe.EBML_CODECID, codec)
+    if language:
+        payload += string(probe.EBML_LANGUAGE, language)
+    for id_, child in children.items():
+        payload += ebml(int(id_[1:], 16), child)
+    return ebml(probe.EBML_TRACKENTRY, payload)
+
+
+TRACKS = ebml(
+    probe.EBML_TRACKS,
+    track(
+        1,
+        "V_MPEGH/ISO/HEVC",
+        x0E0=uint(probe.EBML_PIXELWIDTH, 1920, 2)
+        + uint(probe.EBML_PIXELHEIGHT, 1080, 2),
+    )
+    + track(
+        2,
+        "A_AAC",
+        "jpn",
+        x0E1=uint(probe.EBML_CHANNELS, 2)
+        + ebml(probe.EBML_SAMPLINGFREQUENCY, struct.pack(">f", 48000)),
+    )
+    + track(2, "A_AC3")
+    + track(17, "S_TEXT/ASS", "eng"),
+)
+CLUSTER = ebml(probe.EBML_CLUSTER, bytes(1024))
+
+
+def cues(time):
+    point = ebml(probe.EBML_CUEPOINT, uint(probe.EBML_CUETIME, time, 4))
+    return ebml(probe.EBML_CUES, point + point[:-4] + time.to_bytes(4, "big"))
+
+
+def matroska(info, tail=b""):
+    # Cues at the end are only reachable through the SeekHead
+    def seekhead(position):
+        seek = ebml(
+            tags.EBML_SEEK,
+            ebml(tags.EBML_SEEKID, probe.EBML_CUES.to_bytes(4, "big"))
+            + ebml(tags.EBML_SEEKPOSITION, position.to_bytes(4, "big")),
+        )
+        return ebml(tags.EBML_SEEKHEAD, seek)
+
+    body = info + TRACKS + CLUSTER
+    payload = seekhead(len(seekhead(0)) + len(body)) + body + tail
+    segment = tags.EBML_SEGMENT.to_bytes(4, "big") + tags.encode_size(len(payload), 8)
+    return ebml(0x1A45DFA3, b"") + segment + payload
+
+
+def full_box(type_, payload, version=0):
+    return atom(type_, bytes([version, 0, 0, 0]) + payload)
+
+
+def mp4_trak(handler, entry, language="eng", version=0):
+    code = sum((ord(c) - 0x60) << shift for c, shift in zip(language, (10, 5, 0)))
+    if version:
+        mdhd = full_box(
+            b"mdhd", bytes(16) + struct.pack(">IQH", 1000, 0, code) + bytes(2), 1
+        )
+    else:
+        mdhd = full_box(
+            b"mdhd", bytes(8) + struct.pack(">IIH", 1000, 0, code) + bytes(2)
+        )
+    hdlr = full_box(b"hdlr", bytes(4) + handler + bytes(13))
+    stsd = full_box(b"stsd", struct.pack(">I", 1) + entry)
+    stbl = atom(b"stbl", stsd)
+    return atom(b"trak", atom(b"mdia", mdhd + hdlr + atom(b"minf", stbl)))
+
+
+VIDEO_ENTRY = atom(b"avc1", bytes(24) + struct.pack(">HH", 1280, 720) + bytes(50))
+AUDIO_ENTRY = atom(
+    b"mp4a",
+    bytes(16) + struct.pack(">HH", 6, 16) + bytes(4) + struct.pack(">I", 44100 << 16),
+)
+
+
+def mp4():
+    mvhd = full_box(b"mvhd", bytes(8) + struct.pack(">II", 600, 600 * 1425) + bytes(80))
+    moov = atom(
+        b"moov",
+        mvhd
+        + mp4_trak(b"vide", VIDEO_ENTRY, "und")
+        + mp4_trak(b"soun", AUDIO_ENTRY, "ger", version=1),
+    )
+    return atom(b"ftyp", b"isom" + bytes(4)) + atom(b"mdat", bytes(1024)) + moov
+
+
+class ProbeTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.root = Path(self.dir.name)
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def write(self, name, data):
+        path = self.root / name
+        path.write_bytes(data)
+        return path
+
+
+class TestProbeMatroska(ProbeTestCase):
+    def test_tracks(self):
+        info = ebml(
+            probe.EBML_INFO,
+            uint(probe.EBML_TIMECODESCALE, 1000000, 3)
+            + ebml(probe.EBML_DURATION, struct.pack(">d", 1425500.0)),
+        )
+        result = probe.probe(self.write("a.mkv", matroska(info)))
+
+        self.assertEqual("matroska", result["container"])
+        self.assertEqual(1425.5, result["duration"])
+        self.assertEqual((1920, 1080), (result["width"], result["height"]))
+        self.assertEqual("1080p", result["resolution"])
+        self.assertEqual("hevc", result["video_codec"])
+        self.assertListEqual(["aac", "ac3"], result["audio_codecs"])
+        # Tracks without a language are English
+        self.assertListEqual(["jpn", "eng"], result["audio_languages"])
+        self.assertListEqual(["eng"], result["subtitle_languages"])
+        audio = result["tracks"][1]
+        self.assertEqual((2, 48000), (audio["channels"], audio["sample_rate"]))
+
+    def test_duration_from_cues(self):
+        info = ebml(probe.EBML_INFO, uint(probe.EBML_TIMECODESCALE, 1000000, 3))
+        result = probe.probe(self.write("a.mkv", matroska(info, cues(1400000))))
+        self.assertEqual(1400, result["duration"])
+
+    def test_clusters_are_not_read(self):
+        info = ebml(probe.EBML_INFO, b"")
+        buf = matroska(info)
+        with mock.patch("mediama.probe.read_element", wraps=probe.read_element) as m:
+            probe.probe_matroska(buf)
+        positions = [call[0][1] for call in m.call_args_list]
+        self.assertNotIn(buf.index(CLUSTER) + len(CLUSTER), positions)
+
+
+class TestProbeMP4(ProbeTestCase):
+    def test_tracks(self):
+        result = probe.probe(self.write("a.mp4", mp4()))
+
+        self.assertEqual("mp4", result["container"])
+        self.assertEqual(1425, result["duration"])
+        self.assertEqual("720p", result["resolution"])
+        self.assertEqual("h264", result["video_codec"])
+        self.assertListEqual(["aac"], result["audio_codecs"])
+        self.assertListEqual(["ger"], result["audio_languages"])
+        audio = result["tracks"][1]
+        self.assertEqual((6, 44100), (audio["channels"], audio["sample_rate"]))
+
+
+class TestProbeAll(ProbeTestCase):
+    def test_cache(self):
+        a = self.write("a.mp4", mp4())
+        b = self.write("b.mp4", mp4())
+        bad = self.write("c.mkv", b"garbage")
+        cache = probe.ProbeCache(self.root / "probe.db")
+
+        with mock.patch("mediama.probe.probe", wraps=probe.probe) as probe_mock:
+            first = probe.probe_all([a, b, bad, self.root / "missing.mkv"], 2, cache)
+            self.assertEqual(3, probe_mock.call_count)
+            # Renamed files keep their fingerprint
+            renamed = a.rename(self.root / "renamed.mp4")
+            second = probe.probe_all([renamed, b], 2, cache)
+            self.assertEqual(3, probe_mock.call_count)
+
+        self.assertListEqual([a, b], list(first))
+        self.assertEqual(first[a], second[renamed])
+        cache.close()
+
+    def test_unsupported(self):
+        with self.assertRaises(ValueError):
+            probe.probe(self.write("a.avi", b"RIFF"))
@@ -0,0 +1,168 @@
+import unittest
+import unittest.mock as mock
+import tempfile
+import threading
+from pathlib import Path
+
+import mediama.profiling as profiling
+from mediama.trace import Tracer
+
+
+def work(n=1000, pages=0):
+    if pages:
+        return (list(range(n)) for _ in range(pages))
+    return sum(range(n))
+
+
+class TestProfiler(unittest.TestCase):
+    def test_call(self):
+        profiler = profiling.Profiler()
+        self.assertEqual(sum(range(10)), profiler.call("pre_0", work, n=10))
+        profiler.call("pre_0", work)
+
+        usage = profiler.stats()["pre_0"]
+        self.assertEqual(2, usage["calls"])
+        self.assertGreater(usage["wall"], 0)
+        self.assertEqual(0, usage["errors"])
+
+    def test_error(self):
+        profiler = profiling.Profiler()
+        with self.assertRaises(TypeError):
+            profiler.call("pre_0", work, unknown=1)
+
+        self.assertEqual(1, profiler.stats()["pre_0"]["errors"])
+
+    def test_generator(self):
+        profiler = profiling.Profiler()
+        pages = profiler.call("src_0", work, n=3, pages=2)
+
+        self.assertListEqual([[0, 1, 2], [0, 1, 2]], list(pages))
+        # The call, both pages and the end of the pages are accounted
+        self.assertEqual(4, profiler.stats()["src_0"]["calls"])
+
+    def test_network(self):
+        profiler = profiling.Profiler()
+
+        def fetch():
+            span.add(requests=2, bytes=100)
+
+        with Tracer().span("fetch_series", "sources") as span:
+            span.add(requests=1)
+            profiler.call("src_0", fetch)
+
+        usage = profiler.stats()["src_0"]
+        self.assertEqual(2, usage["requests"])
+        self.assertEqual(100, usage["bytes"])
+
+    def test_memory(self):
+        profiler = profiling.Profiler(memory=True)
+        profiler.call("post_0", lambda: bytearray(2**20))
+
+        self.assertGreaterEqual(profiler.stats()["post_0"]["memory_peak"], 2**20)
+
+    @mock.patch("mediama.profiling.tracemalloc.reset_peak", create=True)
+    def test_memory_without_reset_peak(self, reset_peak):
+        # Python 3.8 cannot reset the peak
+        del profiling.tracemalloc.reset_peak
+        profiler = profiling.Profiler(memory=True)
+        profiler.call("post_0", lambda: bytearray(2**20))
+
+        self.assertTrue(profiling.tracemalloc.is_tracing())
+        self.assertGreaterEqual(profiler.stats()["post_0"]["memory_peak"], 2**20)
+
+    def test_cprofile_threads(self):
+        profiler = profiling.Profiler(cprofile=True)
+        started = threading.Event()
+        release = threading.Event()
+
+        def wait():
+            started.set()
+            release.wait(5)
+
+        thread = threading.Thread(target=profiler.call, args=("src_0", wait))
+        thread.start()
+        started.wait(5)
+        # The other thread is being profiled, so this call is only accounted
+        profiler.call("src_1", work)
+        release.set()
+        thread.join(5)
+
+        self.assertEqual(1, profiler.stats()["src_1"]["calls"])
+        self.assertListEqual(["src_0"], list(profiler.profiles))
+
+    def test_budget_warn(self):
+        profiler = profiling.Profiler(budgets={"*": {"cpu": -1}})
+        with self.assertLogs("mediama.profiling", "WARNING"):
+            self.assertEqual(0, profiler.call("pre_0", work, n=0))
+        self.assertEqual(1, profiler.stats()["pre_0"]["over_budget"])
+
+    def test_budget_cancel(self):
+        profiler = profiling.Profiler(
+            budgets={"src_0": {"wall": -1, "action": "cancel"}}
+        )
+        with self.assertRaises(RuntimeError):
+            profiler.call("src_0", work)
+        # Other tasks have no budget
+        profiler.call("src_1", work)
+
+    def test_budget_cancel_pages(self):
+        profiler = profiling.Profiler(
+            budgets={"src_0": {"wall": -1, "action": "cancel"}}
+        )
+        pages = profiler.iterate("src_0", iter([[1], [2]]))
+        with self.assertRaises(RuntimeError):
+            next(pages)
+
+    def test_invalid_budget(self):
+        with self.assertRaises(ValueError):
+            profiling.Profiler(budgets={"src_0": {"time": 1}})
+        with self.assertRaises(ValueError):
+            profiling.Profiler(budgets={"src_0": {"wall": 1, "action": "kill"}})
+
+    def test_report(self):
+        profiler = profiling.Profiler(cprofile=True)
+        profiler.call("slow", work, n=100000)
+        profiler.call("fast", work, n=1)
+
+        report = profiler.report(top=1)
+        self.assertIn("slow", report)
+        self.assertNotIn("fast", report)
+        self.assertIn("Top functions of slow", report)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            profiler.dump(Path(tmp))
+            self.assertTrue(Path(tmp, "slow.prof").exists())
+
+        profiler.reset()
+        self.assertDictEqual({}, profiler.stats())
+
+    def test_from_config(self):
+        config = {
+            "enabled": False,
+            "cprofile": True,
+            "memory": False,
+            "budgets": {},
+        }
+        self.assertIsNone(profiling.Profiler.from_config(config))
+
+        config["budgets"] = {"*": {"memory": 100}}
+        profiler = profiling.Profiler.from_config(config)
+        self.assertFalse(profiler.cprofile)
+        self.assertTrue(profiler.memory)
+
+
+class TestExecuteTask(unittest.TestCase):
+    def test_profiled(self):
+        from mediama.managers import BaseTaskManager, Process
+
+        class Task(Process):
+            def main(self, value):
+                return {"value": value}
+
+        mgr = BaseTaskManager({"search_dirs": []}, mock.Mock())
+        mgr.profiler = profiling.Profiler()
+        data = mgr.execute_task(Task(None), id_="pre_0", value=1)
+
+        self.assertDictEqual({"value": 1}, data)
+        mgr.metadata.set_.assert_called_once_with({"value": 1}, id_="pre_0")
+        self.assertEqual(1, mgr.profiler.stats()["pre_0"]["calls"])
@@ -0,0 +1,169 @@
+import unittest
+import unittest.mock as mock
+import tempfile
+from pathlib import Path
+
+import mediama.rename as rename
+
+
+class RenameTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.root = Path(self.dir.name)
+        self.journal = self.root / "journal.jsonl"
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def make(self, name, data=None):
+        path = self.root / name
+        path.write_bytes(data if data is not None else name.encode())
+        return path
+
+
+class TestPlanMoves(RenameTestCase):
+    def test_independent_moves(self):
+        a, b = self.make("a"), self.make("b")
+        steps = rename.plan_moves([(a, self.root / "x"), (b, self.root / "y")])
+        self.assertListEqual([[(a, self.root / "x"), (b, self.root / "y")]], steps)
+
+    def test_identity_moves_are_dropped(self):
+        a = self.make("a")
+        self.assertListEqual([], rename.plan_moves([(a, a)]))
+
+    def test_chain(self):
+        a, b = self.make("a"), self.make("b")
+        c = self.root / "c"
+        steps = rename.plan_moves([(a, b), (b, c)])
+        self.assertListEqual([[(b, c)], [(a, b)]], steps)
+
+    def test_cycle(self):
+        a, b = self.make("a"), self.make("b")
+        steps = rename.plan_moves([(a, b), (b, a)])
+        tmp = self.root / f".a{rename.TMP_SUFFIX}"
+        self.assertListEqual([[(a, tmp)], [(b, a)], [(tmp, b)]], steps)
+
+    def test_same_destination(self):
+        a, b = self.make("a"), self.make("b")
+        with self.assertRaises(ValueError):
+            rename.plan_moves([(a, self.root / "x"), (b, self.root / "x")])
+
+    def test_existing_destination(self):
+        a, x = self.make("a"), self.make("x")
+        with self.assertRaises(ValueError):
+            rename.plan_moves([(a, x)])
+
+    def test_conflicting_sources(self):
+        a = self.make("a")
+        with self.assertRaises(ValueError):
+            rename.plan_moves([(a, self.root / "x"), (a, self.root / "y")])
+
+    def test_missing_source(self):
+        with self.assertRaises(FileNotFoundError):
+            rename.plan_moves([(self.root / "a", self.root / "x")])
+
+
+class TestExecuteMoves(RenameTestCase):
+    def test_swap(self):
+        a, b = self.make("a"), self.make("b")
+        rename.execute_moves(rename.plan_moves([(a, b), (b, a)]), self.journal)
+
+        self.assertEqual(b"b", a.read_bytes())
+        self.assertEqual(b"a", b.read_bytes())
+        self.assertFalse(self.journal.exists())
+
+    def test_creates_folders(self):
+        a = self.make("a")
+        dst = self.root / "Show" / "Season 1" / "a"
+        rename.execute_moves(rename.plan_moves([(a, dst)]), self.journal)
+
+        self.assertEqual(b"a", dst.read_bytes())
+        self.assertFalse(a.exists())
+
+    @mock.patch("mediama.rename.same_filesystem", return_value=False)
+    def test_copy_across_filesystems(self, same_filesystem_mock):
+        data = bytes(range(256)) * 100
+        a = self.make("a", data)
+        dst = self.root / "x"
+        rename.execute_moves(
+            rename.plan_moves([(a, dst)]), self.journal, workers=4, chunk_size=1000
+        )
+
+        self.assertEqual(data, dst.read_bytes())
+        self.assertFalse(a.exists())
+        self.assertListEqual(
+            [dst], [p for p in self.root.iterdir() if p.name != "journal.jsonl"]
+        )
+
+    def test_rollback_on_failure(self):
+        a, b = self.make("a"), self.make("b")
+        x, y = self.root / "x", self.root / "y"
+        steps = [[(a, x)], [(b, y)]]
+
+        real_rename = rename.os.rename
+
+        def failing_rename(src, dst):
+            if Path(src) == b:
+                raise OSError("boom")
+            real_rename(src, dst)
+
+        with mock.patch("mediama.rename.os.rename", side_effect=failing_rename):
+            with self.assertRaises(OSError):
+                rename.execute_moves(steps, self.journal)
+
+        self.assertEqual(b"a", a.read_bytes())
+        self.assertEqual(b"b", b.read_bytes())
+        self.assertFalse(x.exists())
+        self.assertFalse(self.journal.exists())
+
+    def test_rollback_copy(self):
+        a = self.make("a")
+        dst = self.root / "x"
+        with mock.patch("mediama.rename.same_filesystem", return_value=False):
+            journal = rename.Journal(self.journal)
+            with rename.ThreadPoolExecutor(2) as executor:
+                rename._execute_step([(a, dst)], executor, 2, journal)
+            journal.close()
+        self.assertFalse(a.exists())
+
+        rename.rollback(self.journal)
+        self.assertEqual(b"a", a.read_bytes())
+        self.assertFalse(dst.exists())
+
+
+class TestRenamePostProcess(RenameTestCase):
+    def test_plan_and_apply(self):
+        from mediama.postprocessors.rename import Rename
+
+        a = self.make("a")
+        b = self.make("b")
+        metadata = mock.Mock()
+        metadata.get_all.return_value = {
+            "post_0": {a: self.root / "x" / "a", b: b},
+        }
+        task = Rename(metadata)
+
+        changes = task.plan()
+        self.assertDictEqual({a: self.root / "x" / "a"}, changes)
+        self.assertTrue(a.exists())
+
+        # Applying takes the changes as written to the plan
+        with mock.patch("mediama.postprocessors.rename.dirs") as dirs_mock:
+            dirs_mock.user_data_dir = str(self.root)
+            result = task.apply({str(a): str(self.root / "x" / "a")})
+
+        self.assertDictEqual({"moved": {a: self.root / "x" / "a"}}, result)
+        self.assertEqual(b"a", (self.root / "x" / "a").read_bytes())
+
+    def test_plan_collision(self):
+        from mediama.postprocessors.rename import Rename
+
+        a = self.make("a")
+        b = self.make("b")
+        metadata = mock.Mock()
+        metadata.get_all.return_value = {
+            "post_0": {a: self.root / "x", b: self.root / "x"}
+        }
+
+        with self.assertRaises(ValueError):
+            Rename(metadata).plan()
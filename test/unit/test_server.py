@@ -0,0 +1,197 @@
+import unittest
+import unittest.mock as mock
+import threading
+import queue
+import json
+import urllib.request
+import urllib.error
+from pathlib import Path
+
+import mediama.server as server
+from mediama.decisions import Decision, Decisions
+from mediama.health import Health
+from mediama.trace import Metrics, Span
+
+
+class TestJobQueue(unittest.TestCase):
+    def test_run_job(self):
+        varpool = mock.Mock()
+        varpool.files.return_value = {Path("a.mkv"): {"src_0": {"name": "Pilot"}}}
+        engine = mock.Mock()
+        engine.decisions = Decisions()
+        engine.run.return_value = varpool
+        jobs = server.JobQueue(engine, workers=1)
+
+        job = jobs.submit([Path("a.mkv")])
+        job.done.wait(5)
+        jobs.close()
+
+        engine.run.assert_called_once_with([Path("a.mkv")])
+        self.assertEqual("done", job.status)
+        self.assertDictEqual(
+            {"skipped": False, "episodes": {"a.mkv": {"src_0": {"name": "Pilot"}}}},
+            job.result,
+        )
+        self.assertIs(job, jobs.get(job.id))
+
+    def test_failed_job(self):
+        engine = mock.Mock()
+        engine.run.side_effect = RuntimeError("boom")
+        jobs = server.JobQueue(engine, workers=1)
+
+        job = jobs.submit([Path("a.mkv")])
+        job.done.wait(5)
+        jobs.close()
+
+        self.assertEqual("failed", job.status)
+        self.assertEqual("boom", job.error)
+
+    def test_reload(self):
+        old, new = mock.Mock(), mock.Mock()
+        old.run.return_value = new.run.return_value = None
+        engines = iter([None, new])
+        jobs = server.JobQueue(old, workers=1, reload=lambda: next(engines, None))
+
+        first = jobs.submit([Path("a.mkv")])
+        first.done.wait(5)
+        second = jobs.submit([Path("b.mkv")])
+        second.done.wait(5)
+        jobs.close()
+
+        old.run.assert_called_once_with([Path("a.mkv")])
+        new.run.assert_called_once_with([Path("b.mkv")])
+
+    def test_queue_full(self):
+        release = threading.Event()
+        engine = mock.Mock()
+        engine.run.side_effect = lambda files: release.wait(5)
+        jobs = server.JobQueue(engine, workers=1, size=1)
+
+        running = jobs.submit([Path("a.mkv")])
+        # Wait for the worker to take the first job off the queue
+        while running.status == "queued":
+            pass
+        jobs.submit([Path("b.mkv")])
+        with self.assertRaises(queue.Full):
+            jobs.submit([Path("c.mkv")])
+
+        release.set()
+        jobs.close()
+
+    def test_history(self):
+        engine = mock.Mock()
+        engine.decisions = Decisions()
+        engine.run.return_value = None
+        jobs = server.JobQueue(engine, workers=1, history=1)
+
+        first = jobs.submit([Path("a.mkv")])
+        second = jobs.submit([Path("b.mkv")])
+        second.done.wait(5)
+        jobs.close()
+
+        with self.assertRaises(KeyError):
+            jobs.get(first.id)
+        self.assertEqual({"skipped": True, "episodes": {}}, jobs.get(second.id).result)
+
+
+class TestServer(unittest.TestCase):
+    def setUp(self):
+        self.engine = mock.Mock()
+        self.engine.decisions = Decisions()
+        self.engine.health = None
+        self.engine.run.return_value = None
+        self.jobs = server.JobQueue(self.engine, workers=1)
+        self.server = server.Server(("127.0.0.1", 0), self.jobs)
+        self.url = "http://127.0.0.1:{}".format(self.server.server_address[1])
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+        self.jobs.close()
+
+    def test_submit_and_wait(self):
+        job = server.submit([Path("a.mkv")], self.url)
+
+        self.assertEqual("done", job["status"])
+        self.assertListEqual(["a.mkv"], job["files"])
+
+    def test_get_job(self):
+        job = server.submit([Path("a.mkv")], self.url, wait=False)
+        self.jobs.get(job["id"]).done.wait(5)
+
+        with urllib.request.urlopen(f"{self.url}/jobs/{job['id']}") as response:
+            self.assertEqual("done", json.loads(response.read())["status"])
+
+    def test_unknown_job(self):
+        with self.assertRaises(urllib.error.HTTPError) as cm:
+            urllib.request.urlopen(f"{self.url}/jobs/unknown")
+        self.assertEqual(404, cm.exception.code)
+
+    def test_invalid_request(self):
+        request = urllib.request.Request(f"{self.url}/jobs", data=b"{}")
+        with self.assertRaises(urllib.error.HTTPError) as cm:
+            urllib.request.urlopen(request)
+        self.assertEqual(400, cm.exception.code)
+
+    def post(self, path, body):
+        request = urllib.request.Request(
+            f"{self.url}{path}", data=json.dumps(body).encode()
+        )
+        with urllib.request.urlopen(request) as response:
+            return json.loads(response.read())
+
+    def test_decisions(self):
+        decision = self.engine.decisions.park(
+            Decision("series", [Path("a.mkv")], [{"name": "A"}, {"name": "B"}], [])
+        )
+        self.engine.resolve.return_value = None
+
+        with urllib.request.urlopen(f"{self.url}/decisions") as response:
+            (listed,) = json.loads(response.read())
+        self.assertEqual(decision.id, listed["id"])
+        self.assertListEqual(["A", "B"], [c["name"] for c in listed["candidates"]])
+
+        with self.assertRaises(urllib.error.HTTPError) as cm:
+            self.post(f"/decisions/{decision.id}", {"choice": 2})
+        self.assertEqual(400, cm.exception.code)
+
+        job = self.post(f"/decisions/{decision.id}", {"choice": 1, "wait": True})
+        self.assertEqual("done", job["status"])
+        self.engine.resolve.assert_called_once_with(decision.id, 1)
+
+    def test_unknown_decision(self):
+        with self.assertRaises(urllib.error.HTTPError) as cm:
+            self.post("/decisions/unknown", {"choice": 0})
+        self.assertEqual(404, cm.exception.code)
+
+    def test_health(self):
+        self.engine.health = Health()
+        with self.assertRaises(RuntimeError):
+            self.engine.health.call("src_0", mock.Mock(side_effect=RuntimeError), 5)
+
+        with urllib.request.urlopen(f"{self.url}/health") as response:
+            body = json.loads(response.read())
+        self.assertEqual("ok", body["status"])
+        self.assertEqual(1, body["sources"]["src_0"]["errors"])
+        self.assertEqual("closed", body["sources"]["src_0"]["state"])
+
+    def test_metrics_disabled(self):
+        with self.assertRaises(urllib.error.HTTPError) as cm:
+            urllib.request.urlopen(f"{self.url}/metrics")
+        self.assertEqual(404, cm.exception.code)
+
+    def test_metrics(self):
+        self.server.metrics = Metrics()
+        span = Span("main", "posts", "post_0")
+        span.duration = 0.5
+        self.server.metrics.record(span)
+
+        with urllib.request.urlopen(f"{self.url}/metrics") as response:
+            body = response.read().decode()
+        self.assertIn(
+            'mediama_span_seconds_count{stage="posts",span="main",task="post_0"} 1',
+            body,
+        )
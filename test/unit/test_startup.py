@@ -0,0 +1,37 @@
+import sys
+import json
+import subprocess
+import unittest
+
+# Modules that are slow to import and only needed once files are processed
+HEAVY_MODULES = ("gevent", "requests", "requests_cache", "asyncio")
+
+
+def imported_modules(statement: str):
+    code = f"{statement}\nimport sys, json\nprint(json.dumps(sorted(sys.modules)))"
+    out = subprocess.run(
+        [sys.executable, "-c", code], capture_output=True, check=True, text=True
+    )
+    return set(json.loads(out.stdout))
+
+
+class TestStartupImports(unittest.TestCase):
+    def assertNotImported(self, statement: str):
+        modules = imported_modules(statement)
+        for name in HEAVY_MODULES:
+            self.assertNotIn(name, modules, f"{statement} imports {name}")
+
+    def test_cli(self):
+        self.assertNotImported("import mediama.cli")
+
+    def test_package(self):
+        self.assertNotImported("import mediama")
+
+    def test_core(self):
+        self.assertNotImported("import mediama.core")
+
+    def test_dirs_are_lazy(self):
+        modules = imported_modules("import mediama.utils")
+        self.assertNotIn("appdirs", modules)
+        modules = imported_modules("import mediama.utils as u; u.dirs.user_cache_dir")
+        self.assertIn("appdirs", modules)
@@ -0,0 +1,97 @@
+import unittest
+import tempfile
+import os
+from pathlib import Path
+
+import mediama.state as state
+
+
+class Plugin:
+    pass
+
+
+def make_cfg(**kwargs):
+    cfg = {
+        "pres": [{"name": "Plugin", "id": "pre_0", "kwargs": {}}],
+        "sources": [{"name": "Plugin", "id": "src_0", "kwargs": {}}],
+        "posts": [{"name": "Plugin", "id": "post_0", "kwargs": {}}],
+        "key_sources": {},
+        "aliases": {},
+        "limit": 5,
+    }
+    cfg.update(kwargs)
+    return cfg
+
+
+TASKS = {stage: {"Plugin": Plugin} for stage in state.STAGES}
+
+
+class TestStageFingerprints(unittest.TestCase):
+    def test_deterministic(self):
+        self.assertDictEqual(
+            state.stage_fingerprints(make_cfg(), TASKS),
+            state.stage_fingerprints(make_cfg(), TASKS),
+        )
+
+    def test_posts_change(self):
+        old = state.stage_fingerprints(make_cfg(), TASKS)
+        posts = [{"name": "Plugin", "id": "post_0", "kwargs": {"format": "{x}"}}]
+        new = state.stage_fingerprints(make_cfg(posts=posts), TASKS)
+
+        self.assertEqual(old["pres"], new["pres"])
+        self.assertEqual(old["sources"], new["sources"])
+        self.assertNotEqual(old["posts"], new["posts"])
+
+    def test_change_invalidates_downstream(self):
+        old = state.stage_fingerprints(make_cfg(), TASKS)
+        new = state.stage_fingerprints(make_cfg(aliases={"name": ["title"]}), TASKS)
+
+        self.assertEqual(old["pres"], new["pres"])
+        self.assertNotEqual(old["sources"], new["sources"])
+        self.assertNotEqual(old["posts"], new["posts"])
+
+
+class TestRunState(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.file = Path(self.dir.name) / "episode.mkv"
+        self.file.write_bytes(b"data")
+        self.store = state.RunState(Path(self.dir.name) / "state.db")
+        self.fingerprints = state.stage_fingerprints(make_cfg(), TASKS)
+
+    def tearDown(self):
+        self.store.conn.close()
+        self.dir.cleanup()
+
+    def test_new_file(self):
+        self.assertEqual("pres", self.store.stage(self.file, self.fingerprints))
+
+    def test_unchanged_file(self):
+        self.store.record(self.file, self.fingerprints, [], [])
+        self.assertIsNone(self.store.stage(self.file, self.fingerprints))
+
+    def test_modified_file(self):
+        self.store.record(self.file, self.fingerprints, [], [])
+        st = self.file.stat()
+        os.utime(self.file, ns=(st.st_atime_ns, st.st_mtime_ns + 1))
+        self.assertEqual("pres", self.store.stage(self.file, self.fingerprints))
+
+    def test_changed_stage(self):
+        self.store.record(self.file, self.fingerprints, [], [])
+        fingerprints = {**self.fingerprints, "posts": "changed"}
+        self.assertEqual("posts", self.store.stage(self.file, fingerprints))
+
+    def test_snapshots(self):
+        pool = [("src_0", "title", "Pilot")]
+        outputs = [("post_0", "renamed", "S01E01.mkv")]
+        self.store.record(self.file, self.fingerprints, pool, outputs)
+
+        self.assertListEqual(pool, self.store.pool(self.file))
+        self.assertListEqual(outputs, self.store.outputs(self.file))
+
+    def test_forget(self):
+        self.store.record(self.file, self.fingerprints, [], [])
+        self.store.forget([self.file])
+        self.assertEqual("pres", self.store.stage(self.file, self.fingerprints))
+        with self.assertRaises(KeyError):
+            self.store.pool(self.file)
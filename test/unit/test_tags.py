@@ -0,0 +1,279 @@
+import unittest
+import tempfile
+import struct
+import unittest.mock as mock
+from pathlib import Path
+
+import mediama.tags as tags
+from mediama.tags import ebml, atom
+
+EBML_HEADER = ebml(0x1A45DFA3, ebml(0x4282, b"matroska"))
+CLUSTER = ebml(0x1F43B675, bytes(range(256)) * 4)
+INFO = ebml(0x1549A966, ebml(0x2AD7B1, b"\x0f\x42\x40"))
+
+
+def simple_tags(**values):
+    return ebml(
+        tags.EBML_TAGS,
+        ebml(
+            tags.EBML_TAG,
+            ebml(tags.EBML_TARGETS, ebml(tags.EBML_TARGETTYPEVALUE, b"\x32"))
+            + b"".join(
+                ebml(
+                    tags.EBML_SIMPLETAG,
+                    ebml(tags.EBML_TAGNAME, name.encode())
+                    + ebml(tags.EBML_TAGSTRING, value.encode()),
+                )
+                for name, value in values.items()
+            ),
+        ),
+    )
+
+
+def seekhead(position):
+    seek = ebml(
+        tags.EBML_SEEK,
+        ebml(tags.EBML_SEEKID, tags.EBML_TAGS.to_bytes(4, "big"))
+        + ebml(tags.EBML_SEEKPOSITION, position.to_bytes(4, "big")),
+    )
+    return ebml(tags.EBML_SEEKHEAD, seek)
+
+
+def segment(payload, width=8, size=True):
+    return (
+        tags.EBML_SEGMENT.to_bytes(4, "big")
+        + tags.encode_size(len(payload) if size else None, width)
+        + payload
+    )
+
+
+class TagsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.root = Path(self.dir.name)
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+
+class TestMatroska(TagsTestCase):
+    def make(self, void=64, width=8, size=True, trailer=b""):
+        # SeekHead has a fixed size, so its own length is known up front
+        head_len = len(seekhead(0))
+        position = head_len + len(INFO) + len(CLUSTER)
+        payload = (
+            seekhead(position)
+            + INFO
+            + CLUSTER
+            + simple_tags(TITLE="Old", ENCODER="x")
+            + (ebml(tags.EBML_VOID, bytes(void - 2)) if void else b"")
+        )
+        path = self.root / "episode.mkv"
+        path.write_bytes(EBML_HEADER + segment(payload, width, size) + trailer)
+        return path
+
+    def assertSeekHead(self, path):
+        data = path.read_bytes()
+        layout = tags.matroska_layout(data)
+        position = tags._seek_position(data, layout, tags.EBML_TAGS)
+        relative = int.from_bytes(data[position.data : position.end], "big")
+        element = tags.read_element(data, layout.segment.data + relative)
+        self.assertEqual(tags.EBML_TAGS, element.id)
+
+    def test_read(self):
+        path = self.make()
+        self.assertDictEqual({"TITLE": "Old", "ENCODER": "x"}, tags.read_tags(path))
+
+    def test_in_place(self):
+        path = self.make()
+        size = path.stat().st_size
+        result = tags.write_tags(path, {"title": "New", "show": "Show"})
+
+        self.assertEqual("in-place", result)
+        self.assertEqual(size, path.stat().st_size)
+        self.assertDictEqual(
+            {"TITLE": "New", "SHOW": "Show", "ENCODER": "x"}, tags.read_tags(path)
+        )
+        self.assertIn(CLUSTER, path.read_bytes())
+
+    def test_unchanged(self):
+        path = self.make()
+        self.assertEqual("unchanged", tags.write_tags(path, {"title": "Old"}))
+
+    def test_appended(self):
+        path = self.make(void=0)
+        result = tags.write_tags(path, {"title": "A much longer title than before"})
+
+        self.assertEqual("appended", result)
+        self.assertDictEqual(
+            {"TITLE": "A much longer title than before", "ENCODER": "x"},
+            tags.read_tags(path),
+        )
+        data = path.read_bytes()
+        layout = tags.matroska_layout(data)
+        self.assertEqual(len(data), layout.end)
+        self.assertSeekHead(path)
+
+    def test_appended_unknown_size(self):
+        path = self.make(void=0, size=False)
+        tags.write_tags(path, {"title": "A much longer title than before"})
+        self.assertEqual(
+            "A much longer title than before", tags.read_tags(path)["TITLE"]
+        )
+
+    def test_rewritten(self):
+        # A second segment follows so the first cannot grow in place
+        path = self.make(void=0, trailer=segment(INFO))
+        result = tags.write_tags(path, {"title": "A much longer title than before"})
+
+        self.assertEqual("rewritten", result)
+        self.assertEqual(
+            "A much longer title than before", tags.read_tags(path)["TITLE"]
+        )
+        self.assertTrue(path.read_bytes().endswith(segment(INFO)))
+        self.assertSeekHead(path)
+
+    def test_track_tags_are_kept(self):
+        track = ebml(
+            tags.EBML_TAG,
+            ebml(tags.EBML_TARGETS, ebml(0x63C5, b"\x01"))
+            + ebml(
+                tags.EBML_SIMPLETAG,
+                ebml(tags.EBML_TAGNAME, b"TITLE") + ebml(tags.EBML_TAGSTRING, b"Track"),
+            ),
+        )
+        payload = INFO + ebml(tags.EBML_TAGS, track) + ebml(tags.EBML_VOID, bytes(200))
+        path = self.root / "episode.mkv"
+        path.write_bytes(EBML_HEADER + segment(payload))
+
+        tags.write_tags(path, {"title": "New"})
+        self.assertIn(track, path.read_bytes())
+        self.assertEqual("New", tags.read_tags(path)["TITLE"])
+
+
+def mp4_item(type_, value):
+    return atom(type_, atom(b"data", struct.pack(">II", 1, 0) + value.encode()))
+
+
+class TestMP4(TagsTestCase):
+    MDAT = atom(b"mdat", bytes(range(256)) * 4)
+
+    def make(self, free=64, moov_last=False, ilst=True):
+        cover = atom(b"covr", atom(b"data", struct.pack(">II", 13, 0) + b"\xff\xd8"))
+        items = mp4_item(b"\xa9nam", "Old") + cover
+        meta_payload = bytes(4) + atom(b"hdlr", bytes(8) + b"mdir" + bytes(13))
+        if ilst:
+            meta_payload += atom(b"ilst", items)
+        if free:
+            meta_payload += atom(b"free", bytes(free - 8))
+        moov = atom(
+            b"moov",
+            atom(b"mvhd", bytes(100)) + atom(b"udta", atom(b"meta", meta_payload)),
+        )
+        ftyp = atom(b"ftyp", b"isom" + bytes(4))
+        data = ftyp + self.MDAT + moov if moov_last else ftyp + moov + self.MDAT
+        path = self.root / "episode.mp4"
+        path.write_bytes(data)
+        return path
+
+    def test_read(self):
+        path = self.make()
+        self.assertDictEqual({"TITLE": "Old"}, tags.read_tags(path))
+
+    def test_in_place(self):
+        path = self.make()
+        data = path.read_bytes()
+        mdat = data.index(self.MDAT)
+        result = tags.write_tags(path, {"title": "New", "season": "2"})
+
+        self.assertEqual("in-place", result)
+        self.assertEqual(len(data), path.stat().st_size)
+        self.assertEqual(mdat, path.read_bytes().index(self.MDAT))
+        self.assertDictEqual({"TITLE": "New", "SEASON": "2"}, tags.read_tags(path))
+        # Items that are not written, such as the cover, are kept
+        self.assertIn(b"covr", path.read_bytes())
+
+    def test_appended(self):
+        path = self.make(free=0)
+        mdat = path.read_bytes().index(self.MDAT)
+        result = tags.write_tags(path, {"title": "A much longer title", "foo": "bar"})
+
+        self.assertEqual("appended", result)
+        data = path.read_bytes()
+        self.assertEqual(mdat, data.index(self.MDAT))
+        self.assertDictEqual(
+            {"TITLE": "A much longer title", "FOO": "bar"}, tags.read_tags(path)
+        )
+        top = [a.type for a in tags.atoms(data, 0, len(data))]
+        self.assertListEqual([b"ftyp", b"free", b"mdat", b"moov"], top)
+
+    def test_moov_last(self):
+        path = self.make(free=0, moov_last=True)
+        tags.write_tags(path, {"title": "A much longer title"})
+
+        data = path.read_bytes()
+        top = [a.type for a in tags.atoms(data, 0, len(data))]
+        self.assertListEqual([b"ftyp", b"mdat", b"moov"], top)
+        self.assertEqual("A much longer title", tags.read_tags(path)["TITLE"])
+
+    def test_no_ilst(self):
+        path = self.make(free=0, ilst=False)
+        tags.write_tags(path, {"title": "New"})
+        self.assertDictEqual({"TITLE": "New"}, tags.read_tags(path))
+
+
+class TestResolve(unittest.TestCase):
+    def test_file_snapshot(self):
+        snapshot = {"series": "Show", "title": "Series title"}
+        episodes = {"src_0": {"title": "Pilot"}, "src_1": {"title": "x", "air": 1}}
+        expected = {"series": "Show", "title": "Pilot", "air": 1}
+        self.assertDictEqual(expected, tags.file_snapshot(snapshot, episodes))
+
+    def test_resolve_tags(self):
+        values = {"series": "Show", "episode": 3, "title": None}
+        mapping = {"show": "series", "episode": "episode", "title": "title"}
+        self.assertDictEqual(
+            {"show": "Show", "episode": "3"}, tags.resolve_tags(values, mapping)
+        )
+
+    def test_unsupported(self):
+        with self.assertRaises(ValueError):
+            tags.write_tags(Path("episode.avi"), {"title": "x"})
+
+
+class TestTagPostProcess(TagsTestCase):
+    def test_main(self):
+        from mediama.postprocessors.tag import Tag
+
+        old = self.root / "old.mkv"
+        new = TestMatroska.make(self)
+        metadata = mock.Mock()
+        metadata.snapshot.return_value = {"series": "Show"}
+        metadata.files.return_value = {old: {"src_0": {"title": "Pilot"}}}
+        metadata.file_snapshots.return_value = {old: {"series": "Show S01"}}
+        metadata.get_all.return_value = {"post_0": {old: new}}
+
+        result = Tag(metadata).main({"show": "series", "title": "title"})
+
+        self.assertDictEqual({"tagged": {new: "in-place"}}, result)
+        self.assertEqual("Show S01", tags.read_tags(new)["SHOW"])
+        self.assertEqual("Pilot", tags.read_tags(new)["TITLE"])
+
+    def test_plan_and_apply(self):
+        from mediama.postprocessors.tag import Tag
+
+        path = TestMatroska.make(self)
+        metadata = mock.Mock()
+        metadata.snapshot.return_value = {"series": "Show", "name": "Old"}
+        metadata.files.return_value = {path: {"src_0": {}}}
+        metadata.file_snapshots.return_value = {}
+        metadata.get_all.return_value = {}
+        task = Tag(metadata)
+
+        changes = task.plan({"show": "series", "title": "name"})
+        self.assertDictEqual({path: {"SHOW": [None, "Show"]}}, changes)
+        self.assertNotIn("SHOW", tags.read_tags(path))
+
+        result = task.apply({str(path): {"SHOW": [None, "Edited"]}})
+        self.assertDictEqual({"tagged": {path: "in-place"}}, result)
+        self.assertEqual("Edited", tags.read_tags(path)["SHOW"])
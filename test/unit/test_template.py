@@ -0,0 +1,95 @@
+import unittest
+import unittest.mock as mock
+from pathlib import Path
+
+from mediama.template import Template, compile_template, render_files, sanitize
+
+
+class TestTemplate(unittest.TestCase):
+    def test_fields(self):
+        template = Template("{series} - S{season|pad:2}E{episode|pad}{series}")
+        self.assertListEqual(["series", "season", "episode"], template.fields)
+
+    def test_render(self):
+        template = Template("{series} - S{season|pad:2}E{episode|pad:3} - {title}")
+        values = {"series": "Show", "season": 1, "episode": 2, "title": "Pilot"}
+        self.assertEqual("Show - S01E002 - Pilot", template.render(values))
+
+    def test_filters(self):
+        template = Template("{a|lower}{b|upper}{c|title}{d|replace:.,_}{e|truncate:3}")
+        values = {"a": "A", "b": "b", "c": "the end", "d": "a.b", "e": "abcdef"}
+        self.assertEqual("aBThe Enda_babc", template.render(values))
+
+    def test_default(self):
+        template = Template("{title|default:Unknown|lower}")
+        self.assertEqual("unknown", template.render({}))
+        self.assertEqual("pilot", template.render({"title": "Pilot"}))
+
+    def test_missing(self):
+        with self.assertRaises(KeyError):
+            Template("{title|lower}").render({})
+
+    def test_nested(self):
+        template = Template("{series.name} {genres.0}")
+        values = {"series": {"name": "Show"}, "genres": ["Drama"]}
+        self.assertEqual("Show Drama", template.render(values))
+
+    def test_escaped_braces(self):
+        self.assertEqual("{x} 1", Template("{{x}} {x}").render({"x": 1}))
+
+    def test_invalid(self):
+        for fmt in ["{x|nope}", "{x|pad:a}", "{}", "{x", "x}"]:
+            with self.subTest(fmt=fmt), self.assertRaises(ValueError):
+                Template(fmt)
+
+    def test_escape(self):
+        template = Template("{series}/{title}", escape=sanitize)
+        values = {"series": "Show", "title": "What? A/B"}
+        self.assertEqual("Show/What_ A_B", template.render(values))
+
+    def test_compile_cache(self):
+        self.assertIs(compile_template("{x}"), compile_template("{x}"))
+
+    def test_render_many(self):
+        template = Template("{series} {episode|pad}")
+        items = {"a": {"episode": 1}, "b": {"episode": 2, "series": "Other"}, "c": {}}
+        self.assertDictEqual(
+            {"a": "Show 01", "b": "Other 02"},
+            template.render_many(items, {"series": "Show", "unused": object()}),
+        )
+
+    def test_render_files(self):
+        template = Template("{title}")
+        episodes = {
+            Path("a.mkv"): {"src_0": {"title": "Pilot"}, "src_1": {"title": "x"}},
+            Path("b.mkv"): {"src_0": {}, "src_1": {"title": "Second"}},
+        }
+        self.assertDictEqual(
+            {Path("a.mkv"): "Pilot", Path("b.mkv"): "Second"},
+            render_files(template, episodes),
+        )
+
+
+class TestFormatPostProcess(unittest.TestCase):
+    def test_main(self):
+        from mediama.postprocessors.format import Format
+
+        metadata = mock.Mock()
+        metadata.snapshot.return_value = {"series": "Show"}
+        metadata.files.side_effect = lambda key, id_=None: {
+            "episodes": {Path("/in/a.mkv"): {"src_0": {"season": 1, "episode": 2}}},
+            "probe": {Path("/in/a.mkv"): {"resolution": "1080p"}},
+        }[key]
+        metadata.file_snapshots.return_value = {}
+
+        result = Format(metadata).main(
+            "{series}/S{season|pad}E{episode|pad} {resolution}", root="/out"
+        )
+
+        metadata.snapshot.assert_called_once_with(
+            ["series", "season", "episode", "resolution"]
+        )
+        self.assertDictEqual(
+            {"destinations": {Path("/in/a.mkv"): Path("/out/Show/S01E02 1080p.mkv")}},
+            result,
+        )
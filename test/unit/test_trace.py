@@ -0,0 +1,127 @@
+import unittest
+import unittest.mock as mock
+import tempfile
+import json
+from pathlib import Path
+
+import mediama.trace as trace
+
+
+class TestTracer(unittest.TestCase):
+    def setUp(self):
+        self.tracer = trace.Tracer(keep=True)
+
+    def test_span(self):
+        with self.tracer.span("fetch_series", "sources", "src_0", plugin="Src") as span:
+            span.add(requests=1, bytes=10)
+            span.add(requests=1)
+
+        self.assertListEqual([span], list(self.tracer.spans))
+        self.assertEqual("ok", span.status)
+        self.assertEqual("src_0.fetch_series", span.label)
+        self.assertDictEqual({"plugin": "Src"}, span.attrs)
+        self.assertDictEqual({"requests": 2, "bytes": 10}, span.counters)
+        self.assertGreaterEqual(span.duration, 0)
+
+    def test_error(self):
+        with self.assertRaises(ValueError):
+            with self.tracer.span("main", "pres", "pre_0"):
+                raise ValueError("bad")
+
+        span = self.tracer.spans[0]
+        self.assertEqual("error", span.status)
+        self.assertEqual("ValueError: bad", span.error)
+
+    def test_nesting(self):
+        with self.tracer.span("run", "run") as outer:
+            self.assertIs(outer, trace.current_span())
+            with self.tracer.span("main", "posts") as inner:
+                self.assertIs(inner, trace.current_span())
+        self.assertIsNone(trace.current_span())
+
+        self.assertIsNone(outer.parent)
+        self.assertEqual(outer.id, inner.parent)
+
+    def test_iterate(self):
+        items = list(self.tracer.iterate(iter("abc"), "episode_pages", "sources"))
+
+        self.assertListEqual(["a", "b", "c"], items)
+        self.assertDictEqual({"items": 3}, self.tracer.spans[0].counters)
+
+    def test_iterate_closed(self):
+        items = self.tracer.iterate(iter("abc"), "episode_pages", "sources")
+        next(items)
+        items.close()
+
+        self.assertEqual("cancelled", self.tracer.spans[0].status)
+
+    def test_not_kept(self):
+        metrics = mock.Mock()
+        tracer = trace.Tracer(metrics=metrics)
+        with tracer.span("main", "posts") as span:
+            pass
+
+        self.assertEqual(0, len(tracer.spans))
+        metrics.record.assert_called_once_with(span)
+
+    def test_save(self):
+        with self.tracer.span("main", "posts", "post_0"):
+            pass
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = Path(tmp) / "trace.json"
+            self.tracer.save(path)
+            data = json.loads(path.read_text())
+            self.assertEqual("post_0", data["spans"][0]["task"])
+
+            self.tracer.save(path, "chrome")
+            event = json.loads(path.read_text())["traceEvents"][0]
+            self.assertEqual("post_0.main", event["name"])
+            self.assertEqual("X", event["ph"])
+            self.assertEqual("ok", event["args"]["status"])
+
+            with self.assertRaises(ValueError):
+                self.tracer.save(path, "xml")
+
+
+class TestMetrics(unittest.TestCase):
+    def test_render(self):
+        metrics = trace.Metrics()
+        for status in ("ok", "error"):
+            span = trace.Span("fetch_series", "sources", "src_0")
+            span.duration = 0.25
+            span.status = status
+            span.add(bytes=100)
+            metrics.record(span)
+
+        text = metrics.render()
+        labels = '{stage="sources",span="fetch_series",task="src_0"}'
+        self.assertIn(f"mediama_span_seconds_sum{labels} 0.500000", text)
+        self.assertIn(f"mediama_span_seconds_count{labels} 2", text)
+        self.assertIn(f"mediama_span_errors_total{labels} 1", text)
+        self.assertIn(f"mediama_bytes_total{labels} 200", text)
+
+
+class TestRecordResponse(unittest.TestCase):
+    def response(self, from_cache, headers=None):
+        response = mock.Mock(from_cache=from_cache, headers=headers or {})
+        response._content = b"12345"
+        return response
+
+    def test_counts(self):
+        tracer = trace.Tracer()
+        with tracer.span("fetch_series", "sources") as span:
+            trace.record_response(self.response(False, {"Content-Length": "10"}))
+            trace.record_response(self.response(True))
+
+        self.assertDictEqual(
+            {"requests": 2, "bytes": 15, "cache_hits": 1, "cache_misses": 1},
+            span.counters,
+        )
+
+    def test_unmarked_response(self):
+        tracer = trace.Tracer()
+        with tracer.span("fetch_series", "sources") as span:
+            trace.record_response(mock.Mock(spec=["headers"]))
+
+        self.assertDictEqual({}, span.counters)
@@ -310,3 +310,85 @@ class TestGetSubclassFromModule(unittest.TestCase):
 
         expected = {"SubClass1", "SubClassA"}
         self.assertSetEqual(expected, results)
+
+
+class TestIterPages(unittest.TestCase):
+    def test_none(self):
+        self.assertListEqual([], list(utils.iter_pages(None)))
+
+    def test_list_is_single_page(self):
+        page = [{"name": "e1"}, {"name": "e2"}]
+        self.assertListEqual([page], list(utils.iter_pages(page)))
+
+    def test_empty_list(self):
+        self.assertListEqual([], list(utils.iter_pages([])))
+
+    def test_generator_of_pages(self):
+        def pages():
+            yield [{"name": "e1"}, {"name": "e2"}]
+            yield []
+            yield [{"name": "e3"}]
+
+        expected = [[{"name": "e1"}, {"name": "e2"}], [{"name": "e3"}]]
+        self.assertListEqual(expected, list(utils.iter_pages(pages())))
+
+    def test_generator_of_items(self):
+        def items():
+            yield {"name": "e1"}
+            yield {"name": "e2"}
+
+        expected = [[{"name": "e1"}], [{"name": "e2"}]]
+        self.assertListEqual(expected, list(utils.iter_pages(items())))
+
+    def test_pages_are_lazy(self):
+        fetched = []
+
+        def pages():
+            for i in range(3):
+                fetched.append(i)
+                yield [{"name": f"e{i}"}]
+
+        gen = utils.iter_pages(pages())
+        next(gen)
+        self.assertListEqual([0], fetched)
+
+    def test_async_generator(self):
+        async def pages():
+            yield [{"name": "e1"}]
+            yield [{"name": "e2"}]
+
+        expected = [[{"name": "e1"}], [{"name": "e2"}]]
+        self.assertListEqual(expected, list(utils.iter_pages(pages())))
+
+
+class TestRankings(unittest.TestCase):
+    def test_normalize_ranking(self):
+        ranking = [{"name": str(i)} for i in range(10)]
+        self.assertListEqual(ranking[:3], utils.normalize_ranking(ranking, 3))
+        self.assertListEqual([], utils.normalize_ranking(None, 3))
+        self.assertListEqual([{"name": "a"}], utils.normalize_ranking({"name": "a"}, 3))
+
+    def test_rank_aggregation(self):
+        ranks = [["a", "b", "c"], ["b", "a"], ["b"]]
+        self.assertListEqual(["b", "a", "c"], utils.rank_aggregation(ranks, [1, 1, 1]))
+        self.assertListEqual(["a", "b", "c"], utils.rank_aggregation(ranks, [5, 1, 1]))
+        self.assertListEqual([], utils.rank_aggregation([], []))
+
+    def test_rank_aggregation_ties(self):
+        self.assertListEqual(["a", "b"], utils.rank_aggregation([["a"], ["b"]], [1, 1]))
+
+    def test_rank_certainty(self):
+        self.assertEqual(1.0, utils.rank_certainty([["a"]], [1]))
+        self.assertEqual(0.0, utils.rank_certainty([["a"], ["b"]], [1, 1]))
+        self.assertAlmostEqual(1 / 3, utils.rank_certainty([["a", "b", "c"]], [1]))
+        self.assertEqual(0.0, utils.rank_certainty([], []))
+
+    def test_merge_ranking_metadata(self):
+        metadata = [
+            ("src_0", [{"name": "a", "year": 2000}]),
+            ("src_1", [{"name": "b"}, {"name": "a", "year": 2001, "id": 1}]),
+        ]
+        self.assertListEqual(
+            [{"name": "b"}, {"name": "a", "year": 2000, "id": 1}],
+            utils.merge_ranking_metadata(["b", "a", "c"], metadata),
+        )